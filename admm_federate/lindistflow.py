@@ -3,6 +3,7 @@ import numpy as np
 import cvxpy as cp
 import math
 import logging
+from incidence import bus_incidence
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -157,6 +158,8 @@ def optimal_power_flow(branch_info: dict, bus_info: dict, source_bus: str, contr
 
     # sum(Sij) - sum(Sjk) == -sj
 
+    incidence = bus_incidence(branch_info, bus_info, 'kv', PRIMARY_V)
+    branch_keys = list(branch_info)
     counteq = 0
     for keyb, val_bus in bus_info.items():
         if keyb != source_bus:
@@ -168,17 +171,12 @@ def optimal_power_flow(branch_info: dict, bus_info: dict, source_bus: str, contr
             k_to_1p = []
 
             # Find bus idx in "from" of branch_sw_data
-            ind_frm = 0
-            ind_to = 0
+            incident = incidence[val_bus['idx']]
             if val_bus['kv'] < PRIMARY_V:
-                for key, val_br in branch_info.items():
-                    if val_bus['idx'] == val_br['from']:
-                        k_frm_1p.append(ind_frm - nbranch_ABC)
-
-                    if val_bus['idx'] == val_br['to']:
-                        k_to_1p.append(ind_to - nbranch_ABC)
-                    ind_to += 1
-                    ind_frm += 1
+                for ind_frm in incident['from_pri'] + incident['from_sec']:
+                    k_frm_1p.append(ind_frm - nbranch_ABC)
+                for ind_to in incident['to_pri'] + incident['to_sec']:
+                    k_to_1p.append(ind_to - nbranch_ABC)
                 loc = (nbus_ABC * 3 + nbus_s1s2) + \
                     (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 6
                 A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_1p, k_to_1p, counteq, loc,
@@ -188,34 +186,27 @@ def optimal_power_flow(branch_info: dict, bus_info: dict, source_bus: str, contr
                                            val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5 + nbus_s1s2)
                 counteq += 1
             else:
-                for key, val_br in branch_info.items():
-                    if val_bus['idx'] == val_br['from']:
-                        if bus_info[val_br['to_bus']]['kv'] > PRIMARY_V:
-                            k_frm_3p.append(ind_frm)
-                        else:
-                            if key[-1] == 'a':
-                                k_frm_1pa.append(
-                                    nbranch_ABC * 6 + ind_frm - nbranch_ABC)
-                                k_frm_1qa.append(
-                                    nbranch_ABC * 3 + ind_frm - nbranch_ABC + nbranch_s1s2)
-                            if key[-1] == 'b':
-                                k_frm_1pb.append(
-                                    nbranch_ABC * 5 + ind_frm - nbranch_ABC)
-                                k_frm_1qb.append(
-                                    nbranch_ABC * 2 + ind_frm - nbranch_ABC + nbranch_s1s2)
-                            if key[-1] == 'c':
-                                k_frm_1pc.append(
-                                    nbranch_ABC * 4 + ind_frm - nbranch_ABC)
-                                k_frm_1qc.append(
-                                    nbranch_ABC * 1 + ind_frm - nbranch_ABC + nbranch_s1s2)
-
-                    if val_bus['idx'] == val_br['to']:
-                        if bus_info[val_br['fr_bus']]['kv'] > PRIMARY_V:
-                            k_to_3p.append(ind_to)
-                        else:
-                            k_to_1p.append(ind_to - nbranch_ABC)
-                    ind_to += 1
-                    ind_frm += 1
+                k_frm_3p = list(incident['from_pri'])
+                for ind_frm in incident['from_sec']:
+                    key = branch_keys[ind_frm]
+                    if key[-1] == 'a':
+                        k_frm_1pa.append(
+                            nbranch_ABC * 6 + ind_frm - nbranch_ABC)
+                        k_frm_1qa.append(
+                            nbranch_ABC * 3 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                    if key[-1] == 'b':
+                        k_frm_1pb.append(
+                            nbranch_ABC * 5 + ind_frm - nbranch_ABC)
+                        k_frm_1qb.append(
+                            nbranch_ABC * 2 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                    if key[-1] == 'c':
+                        k_frm_1pc.append(
+                            nbranch_ABC * 4 + ind_frm - nbranch_ABC)
+                        k_frm_1qc.append(
+                            nbranch_ABC * 1 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                k_to_3p = list(incident['to_pri'])
+                for ind_to in incident['to_sec']:
+                    k_to_1p.append(ind_to - nbranch_ABC)
                 loc = (nbus_ABC * 3 + nbus_s1s2) + \
                     (nbus_ABC * 6 + nbus_s1s2 * 2)
                 # Finding the kfrms
@@ -14,6 +14,7 @@ from oedisi.types.data_types import (
 )
 import adapter
 import lindistflow
+from payload import MissingIds, decode
 from area import area_info
 
 logger = logging.getLogger(__name__)
@@ -118,15 +119,21 @@ class OPFFederate(object):
             area_branch, area_bus = area_info(
                 branch_info, bus_info, slack_bus)
 
-            voltages_mag = VoltagesMagnitude.parse_obj(
-                self.sub.voltages_mag.json)
+            try:
+                voltages_mag = decode(self.sub.voltages_mag, VoltagesMagnitude)
+                injection = decode(self.sub.injections, Injection)
+            except MissingIds as e:
+                logger.warning(f"Skipping time step {granted_time}: {e}")
+                granted_time = h.helicsFederateRequestTime(
+                    self.fed, h.HELICS_TIME_MAXTIME
+                )
+                continue
 
             area_bus = adapter.extract_voltages(area_bus, voltages_mag)
 
             time = voltages_mag.time
             logger.info(time)
 
-            injection = Injection.parse_obj(self.sub.injections.json)
             area_bus = adapter.extract_injection(area_bus, injection)
 
             voltages, power_flow, control, conversion = lindistflow.optimal_power_flow(
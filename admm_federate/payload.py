@@ -0,0 +1,253 @@
+"""Binary encoding of the pydantic payloads exchanged over HELICS.
+
+A binary payload is MAGIC, a one line JSON header and the raw float64 bytes
+of every numeric list. The header names the oedisi type and describes each
+field. String lists such as ids form a versioned id dictionary: payloads
+refer to them by version (a hash of the list) and decoders keep them in a
+cache. A publication includes a list the first time it sends it and again
+every ``resend_interval`` payloads, so a subscriber that missed it, since
+HELICS inputs only keep the latest value, can decode again after at most
+that many payloads. Until then ``decode`` raises ``MissingIds`` and the
+subscriber skips the time step. Decoded id lists are IdList instances that
+carry this version, so consumers can cache index maps keyed by
+``ids_version``.
+
+Binary payloads are published with the HELICS raw data type and JSON ones
+as strings, so ``decode`` picks the encoding from the type of the connected
+publication and subscribers do not need to know which one is used.
+
+The federates import copies of this module kept identical by
+``shared/sync.py``; edit it in shared/ and run that script.
+"""
+
+import hashlib
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import helics as h
+import numpy as np
+from oedisi.types import data_types
+from pydantic import BaseModel
+
+MAGIC = b"OEDISI-BIN1\n"
+
+TYPES = {
+    name: cls
+    for name, cls in vars(data_types).items()
+    if isinstance(cls, type) and issubclass(cls, BaseModel)
+}
+
+# String lists received so far, by key
+STRINGS = {}
+
+# Payloads between two inclusions of the same id list
+RESEND_INTERVAL = 10
+
+
+def strings_key(strings: List[str]) -> str:
+    return hashlib.blake2b("\n".join(strings).encode(), digest_size=8).hexdigest()
+
+
+class IdList(list):
+    """List of ids that knows the version of the id dictionary it came from."""
+
+    def __init__(self, ids, version: Optional[str] = None):
+        super().__init__(ids)
+        # pydantic copies lists through their class, with the ids only
+        self.version = strings_key(self) if version is None else version
+
+
+def versioned(ids: List[str]) -> IdList:
+    """Tag an id list, such as the ids of the topology, with its version."""
+    return IdList(ids, strings_key(ids))
+
+
+def ids_version(ids: List[str]) -> str:
+    """Version of an id list, without hashing it again when it was decoded."""
+    if isinstance(ids, IdList):
+        return ids.version
+    return strings_key(ids)
+
+
+class MissingIds(ValueError):
+    """A payload refers to an id list that has not been received yet."""
+
+
+class PayloadEncoder:
+    """Binary encoder for the payloads of one publication.
+
+    Each id list is included when it is new and again every resend_interval
+    payloads.
+    """
+
+    def __init__(self, resend_interval: int = RESEND_INTERVAL):
+        self.resend_interval = resend_interval
+        self.count = 0
+        # payload count at which each id list was last included
+        self.sent = {}
+
+    def encode(self, payload: BaseModel) -> bytes:
+        arrays = []
+        strings = {}
+        header = {
+            "type": type(payload).__name__,
+            "fields": self.fields(payload, arrays, strings),
+            "strings": strings,
+        }
+        body = np.concatenate(arrays) if arrays else np.empty(0)
+        self.count += 1
+        return MAGIC + json.dumps(header).encode() + b"\n" + body.tobytes()
+
+    def fields(self, payload: BaseModel, arrays: list, strings: dict) -> dict:
+        fields = {}
+        for name, field in payload.__fields__.items():
+            value = getattr(payload, name)
+            if isinstance(value, dict) and isinstance(field.type_, type) \
+                    and issubclass(field.type_, BaseModel):
+                # defaults of nested models are plain dicts
+                value = field.type_.parse_obj(value)
+            if value is None:
+                fields[name] = {"value": None}
+            elif isinstance(value, BaseModel):
+                fields[name] = {"model": self.fields(value, arrays, strings)}
+            elif field.outer_type_ == List[float]:
+                arrays.append(np.asarray(value, dtype=np.float64))
+                fields[name] = {"array": len(value)}
+            elif field.outer_type_ == List[Tuple[float, float]]:
+                arrays.append(np.asarray(value, dtype=np.float64).ravel())
+                fields[name] = {"pairs": len(value)}
+            elif field.outer_type_ == List[str]:
+                key = strings_key(value)
+                last = self.sent.get(key)
+                if last is None or self.count - last >= self.resend_interval:
+                    strings[key] = value
+                    self.sent[key] = self.count
+                fields[name] = {"strings": key}
+            elif isinstance(value, datetime):
+                fields[name] = {"time": value.isoformat()}
+            else:
+                fields[name] = {"value": value}
+        return fields
+
+
+class PayloadPublication:
+    """Publication of pydantic payloads, as JSON or binary when binary is set."""
+
+    def __init__(
+        self,
+        vfed,
+        name: str,
+        binary: bool = False,
+        resend_interval: int = RESEND_INTERVAL,
+    ):
+        data_type = h.HELICS_DATA_TYPE_RAW if binary else h.HELICS_DATA_TYPE_STRING
+        self.pub = vfed.register_publication(name, data_type, "")
+        self.encoder = PayloadEncoder(resend_interval) if binary else None
+
+    def publish(self, payload: BaseModel):
+        if self.encoder is None:
+            self.pub.publish(payload.json())
+        else:
+            self.pub.publish(self.encoder.encode(payload))
+
+
+def is_binary(sub) -> bool:
+    return h.helicsInputGetPublicationType(sub) == "raw"
+
+
+def decode(sub, cls):
+    """Read the payload of a HELICS input as cls, whichever its encoding.
+
+    Binary payloads are built with ``construct``, skipping validation, and
+    have the type the publisher sent, which is cls or a subclass of it.
+    Raises MissingIds when the payload refers to an id list that was not
+    received yet, which is included again within resend_interval payloads.
+    """
+    if is_binary(sub):
+        return decode_bytes(sub.bytes)
+    return cls.parse_obj(sub.json)
+
+
+def decode_bytes(raw: bytes):
+    """Build the payload of a binary message.
+
+    The header is checked against the body before anything is built, and
+    the body must be used up exactly, so a truncated or inconsistent
+    message raises ValueError instead of giving a malformed payload.
+    """
+    if not raw.startswith(MAGIC):
+        raise ValueError("Payload is not in the binary format")
+    end = raw.index(b"\n", len(MAGIC))
+    header = json.loads(raw[len(MAGIC):end])
+    if header["type"] not in TYPES:
+        raise ValueError(f"Payload has unknown type {header['type']}")
+    if (len(raw) - end - 1) % 8:
+        raise ValueError("Payload body is not a whole number of float64 values")
+    body = np.frombuffer(raw, dtype=np.float64, offset=end + 1)
+    cls = TYPES[header["type"]]
+    size = body_size(cls, header["fields"])
+    if size != len(body):
+        raise ValueError(
+            f"{cls.__name__} header describes {size} values, body has {len(body)}")
+    STRINGS.update(header["strings"])
+    payload, position = build(cls, header["fields"], body, 0)
+    if position != len(body):
+        raise ValueError(
+            f"{cls.__name__} used {position} of {len(body)} body values")
+    return payload
+
+
+def body_size(cls, fields: dict) -> int:
+    """Number of body values the fields describe, checking them against cls."""
+    size = 0
+    for name, field in fields.items():
+        if name not in cls.__fields__:
+            raise ValueError(f"{cls.__name__} has no field {name}")
+        if "model" in field:
+            size += body_size(cls.__fields__[name].type_, field["model"])
+        elif "array" in field:
+            size += field["array"]
+        elif "pairs" in field:
+            size += 2 * field["pairs"]
+    return size
+
+
+def check_lengths(cls, values: dict):
+    """Lists of a model with ids, such as values, must have one entry per id."""
+    if not isinstance(values.get("ids"), list):
+        return
+    for name, value in values.items():
+        if isinstance(value, list) and len(value) != len(values["ids"]):
+            raise ValueError(
+                f"{cls.__name__}.{name} has {len(value)} entries "
+                f"for {len(values['ids'])} ids")
+
+
+def build(cls, fields: dict, body: np.ndarray, position: int):
+    values = {}
+    for name, field in fields.items():
+        if "model" in field:
+            values[name], position = build(
+                cls.__fields__[name].type_, field["model"], body, position)
+        elif "array" in field:
+            n = field["array"]
+            values[name] = body[position:position + n].tolist()
+            position += n
+        elif "pairs" in field:
+            n = field["pairs"]
+            values[name] = [
+                tuple(pair) for pair in
+                body[position:position + 2 * n].reshape(n, 2).tolist()]
+            position += 2 * n
+        elif "strings" in field:
+            if field["strings"] not in STRINGS:
+                raise MissingIds(
+                    f"{cls.__name__}.{name} refers to ids that were not received yet")
+            values[name] = IdList(STRINGS[field["strings"]], field["strings"])
+        elif "time" in field:
+            values[name] = datetime.fromisoformat(field["time"])
+        else:
+            values[name] = field["value"]
+    check_lengths(cls, values)
+    return cls.construct(**values), position
@@ -0,0 +1,160 @@
+"""Check that gauss_newton recovers the state of a noise-free feeder.
+
+Builds a small three-phase feeder with every node measured, calculates exact
+measurements from known states and estimates them from the flat start and,
+for a new state, from the state of the previous time step. It exits with an
+error when an estimate is off::
+
+    python estimator_federate/validate_gauss_newton.py
+"""
+
+import argparse
+import logging
+import sys
+
+import numpy as np
+from oedisi.types.data_types import (
+    AdmittanceSparse,
+    Injection,
+    PowersImaginary,
+    PowersReal,
+    Topology,
+    VoltagesAngle,
+    VoltagesMagnitude,
+)
+from wsl_federate import AlgorithmParameters, EstimatorModel, state_estimator
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# phase impedance of a line section in ohms
+LINE_IMPEDANCE = 0.1 * np.array(
+    [
+        [0.4576 + 1.078j, 0.1560 + 0.5017j, 0.1535 + 0.3849j],
+        [0.1560 + 0.5017j, 0.4666 + 1.0482j, 0.1580 + 0.4236j],
+        [0.1535 + 0.3849j, 0.1580 + 0.4236j, 0.4615 + 1.0651j],
+    ]
+)
+BASE_VOLTAGE = 2401.8
+PHASE_ANGLES = np.array([0, -2 * np.pi / 3, 2 * np.pi / 3])
+
+
+def feeder(num_bus=4):
+    """Topology of a chain of three-phase buses, the first one the slack."""
+    ids = [f"{bus}.{phase}" for bus in range(num_bus) for phase in (1, 2, 3)]
+    Y_line = np.linalg.inv(LINE_IMPEDANCE)
+    Y = np.zeros((len(ids), len(ids)), dtype=complex)
+    for bus in range(1, num_bus):
+        i, j = slice(3 * bus - 3, 3 * bus), slice(3 * bus, 3 * bus + 3)
+        Y[i, i] += Y_line
+        Y[j, j] += Y_line
+        Y[i, j] -= Y_line
+        Y[j, i] -= Y_line
+    rows, cols = np.nonzero(Y)
+    return Topology(
+        admittance=AdmittanceSparse(
+            from_equipment=[ids[r] for r in rows],
+            to_equipment=[ids[c] for c in cols],
+            admittance_list=[(y.real, y.imag) for y in Y[rows, cols]],
+        ),
+        injections=Injection(),
+        base_voltage_magnitudes=VoltagesMagnitude(
+            values=[BASE_VOLTAGE] * len(ids), ids=ids
+        ),
+        base_voltage_angles=VoltagesAngle(
+            values=list(np.tile(PHASE_ANGLES, num_bus)), ids=ids
+        ),
+        slack_bus=ids[:3],
+    )
+
+
+def state(topology, rng):
+    """Per-unit magnitudes and angles that sag and lag along the feeder."""
+    num_node = len(topology.base_voltage_magnitudes.ids)
+    depth = np.repeat(np.arange(num_node // 3), 3)
+    magnitude = 1.0 - depth * rng.uniform(0.005, 0.015, num_node)
+    angle = np.array(topology.base_voltage_angles.values) - depth * rng.uniform(
+        0.002, 0.01, num_node
+    )
+    return magnitude, angle
+
+
+def measurements(parameters, topology, magnitude, angle):
+    """Exact P, Q and V of every node for a per-unit state."""
+    ids = topology.base_voltage_magnitudes.ids
+    template = [0.0] * len(ids)
+    model = EstimatorModel(
+        parameters,
+        topology,
+        PowersReal(values=template, ids=ids, equipment_ids=ids),
+        PowersImaginary(values=template, ids=ids, equipment_ids=ids),
+        VoltagesMagnitude(values=template, ids=ids),
+    )
+    V = magnitude * np.exp(1j * angle)
+    S = V * (model.Y_conjugate @ V.conjugate())
+    return (
+        PowersReal(
+            values=list(-S.real * parameters.base_power), ids=ids, equipment_ids=ids
+        ),
+        PowersImaginary(
+            values=list(-S.imag * parameters.base_power), ids=ids, equipment_ids=ids
+        ),
+        VoltagesMagnitude(values=list(magnitude * model.base_voltages), ids=ids),
+    )
+
+
+def estimate_error(parameters, topology, state, initial):
+    """Largest per-unit error of the estimate of state from initial."""
+    magnitude, angle = state
+    P, Q, V = measurements(parameters, topology, magnitude, angle)
+    initial_V, initial_ang = initial
+    vmag, vang, result = state_estimator(
+        parameters,
+        topology,
+        P,
+        Q,
+        V,
+        initial_V=initial_V,
+        initial_ang=initial_ang,
+        slack_index=0,
+    )
+    estimate = vmag / BASE_VOLTAGE * np.exp(1j * vang)
+    true = magnitude * np.exp(1j * (angle - angle[0]))
+    return np.max(np.abs(estimate - true)), result
+
+
+def validate(parameters, seed=0):
+    """Largest error of the flat and the warm start estimates."""
+    topology = feeder()
+    rng = np.random.default_rng(seed)
+    previous, current = state(topology, rng), state(topology, rng)
+    flat = (1.0, np.array(topology.base_voltage_angles.values))
+    errors = []
+    for name, true, initial in (
+        ("flat start", previous, flat),
+        ("warm start", current, previous),
+    ):
+        error, result = estimate_error(parameters, topology, true, initial)
+        logger.info(
+            f"{name}: error {error:.3g} after {result.nfev} evaluations, "
+            f"{result.message}"
+        )
+        errors.append(error)
+    return max(errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate a noise-free feeder with gauss_newton")
+    parser.add_argument(
+        "--tol", type=float, default=1e-6,
+        help="largest per-unit voltage error allowed",
+    )
+    args = parser.parse_args()
+    parameters = AlgorithmParameters(method="gauss_newton", tol=1e-10)
+    error = validate(parameters)
+    if error > args.tol:
+        logger.error(f"gauss_newton estimate is off by {error:.3g}")
+        sys.exit(1)
+    logger.info(f"gauss_newton recovers the state within {error:.3g}")
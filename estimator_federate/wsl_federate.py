@@ -5,17 +5,19 @@ Uses weighted least squares to estimate the voltage angles.
 
 First `call_h` calculates the residual from the voltage magnitude and angle,
 and `call_H` calculates a jacobian. Then `scipy.optimize.least_squares`
-is used to solve.
+is used to solve, or `gauss_newton` with the gauss_newton method.
 """
 
 import json
 import logging
 from datetime import datetime
-from typing import List, Optional, Union
+from enum import Enum
+from typing import Dict, List, Optional, Union
 
 import helics as h
 import numpy as np
 import scipy.sparse
+import scipy.sparse.linalg
 from oedisi.types.common import BrokerConfig
 from oedisi.types.data_types import (
     AdmittanceMatrix,
@@ -27,8 +29,9 @@ from oedisi.types.data_types import (
     VoltagesAngle,
     VoltagesMagnitude,
 )
-from pydantic import BaseModel
-from scipy.optimize import least_squares
+from payload import MissingIds, decode, ids_version, versioned
+from pydantic import BaseModel, validator
+from scipy.optimize import OptimizeResult, least_squares
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -46,10 +49,10 @@ def estimated_pqv(knownP, knownQ, knownV, Y, deltaK, VabsK, num_node):
     return h.reshape(-1)
 
 
-def calculate_jacobian(X0, z, num_node, knownP, knownQ, knownV, Y):
+def calculate_jacobian(X0, z, num_node, knownP, knownQ, knownV, Y, sqrt_weights=None):
     """Calculate the Jacobian matrix for the weighted least squares algorithm.
 
-    Called H in literature."""
+    Called H in literature. Rows are scaled by sqrt_weights when given."""
     deltaK, VabsK = X0[:num_node], X0[num_node:]
     num_knownV = len(knownV)
     # Calculate original H1
@@ -83,10 +86,95 @@ def calculate_jacobian(X0, z, num_node, knownP, knownQ, knownV, Y):
         H2 = np.concatenate((H_pow1.real, H_pow2.real), axis=1)[knownP, :]
         H3 = np.concatenate((H_pow1.imag, H_pow2.imag), axis=1)[knownQ, :]
         H = np.concatenate((H1, H2, H3), axis=0)
+    if sqrt_weights is not None:
+        if isinstance(H, np.ndarray):
+            H = sqrt_weights.reshape(-1, 1) * H
+        else:
+            H = scipy.sparse.diags_array(sqrt_weights) @ H
     return -H
 
 
-def residual(X0, z, num_node, knownP, knownQ, knownV, Y):
+class JacobianStructure:
+    """Jacobian of the residual on a CSR pattern fixed by Y and the measurements.
+
+    Row k of the power flow Jacobian has entries in the columns of row k of
+    Y and on the diagonal, so the pattern, and where each entry of the data
+    array comes from, is built once. Calls only write the values of
+    ``calculate_jacobian`` into the data array of the same matrix, which is
+    returned and overwritten by the next call.
+    """
+
+    def __init__(self, Y, num_node, knownP, knownQ, knownV, sqrt_weights=None):
+        # conj(Y) with every diagonal entry stored, as S_k enters there
+        Y = scipy.sparse.coo_array(Y)
+        diagonal = np.arange(num_node)
+        self.Yc = scipy.sparse.csr_array(
+            (
+                np.concatenate((Y.data.conjugate(), np.zeros(num_node))),
+                (
+                    np.concatenate((Y.row, diagonal)),
+                    np.concatenate((Y.col, diagonal)),
+                ),
+            ),
+            shape=(num_node, num_node),
+        )
+        self.Yc.sum_duplicates()
+        self.num_node = num_node
+        self.row = np.repeat(diagonal, np.diff(self.Yc.indptr))
+        self.col = self.Yc.indices
+        self.diagonal = np.flatnonzero(self.row == self.col)
+
+        # rows of the voltage measurements, then of P and Q, each with the
+        # angle columns of row k of Y followed by its magnitude columns
+        known = np.asarray(knownP + knownQ, dtype=np.int64)
+        lengths = np.diff(self.Yc.indptr)[known]
+        offsets = np.cumsum(lengths) - lengths
+        within = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+        self.source = np.repeat(self.Yc.indptr[known], lengths) + within
+        num_knownV = len(knownV)
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.concatenate((np.ones(num_knownV, np.int64), 2 * lengths))))
+        )
+        self.angle = np.repeat(indptr[num_knownV:-1], lengths) + within
+        self.magnitude = self.angle + np.repeat(lengths, lengths)
+        self.num_P = np.sum(lengths[: len(knownP)])
+        if sqrt_weights is None:
+            sqrt_weights = np.ones(num_knownV + len(known))
+        self.scale = -np.repeat(sqrt_weights[num_knownV:], lengths)
+        indices = np.empty(indptr[-1], dtype=np.int64)
+        indices[:num_knownV] = num_node + np.asarray(knownV, dtype=np.int64)
+        indices[self.angle] = self.col[self.source]
+        indices[self.magnitude] = num_node + self.col[self.source]
+        data = np.zeros(indptr[-1])
+        data[:num_knownV] = -sqrt_weights[:num_knownV]
+        self.H = scipy.sparse.csr_array(
+            (data, indices, indptr), shape=(len(indptr) - 1, 2 * num_node)
+        )
+
+    def __call__(self, X0, *args):
+        deltaK, VabsK = X0[: self.num_node], X0[self.num_node:]
+        rotation = np.exp(1j * deltaK)
+        Vp = VabsK * rotation
+        current = self.Yc @ Vp.conjugate()
+        d = self.diagonal
+        row_voltage = Vp[self.row]
+        # gradient of S with respect to |V| and delta
+        H_pow2 = row_voltage * self.Yc.data * rotation.conjugate()[self.col]
+        H_pow2[d] += rotation[self.row[d]] * current[self.row[d]]
+        H_pow1 = -1j * row_voltage * self.Yc.data * Vp.conjugate()[self.col]
+        H_pow1[d] += 1j * Vp[self.row[d]] * current[self.row[d]]
+
+        P, Q = slice(None, self.num_P), slice(self.num_P, None)
+        data = self.H.data
+        source, scale = self.source, self.scale
+        data[self.angle[P]] = scale[P] * H_pow1.real[source[P]]
+        data[self.magnitude[P]] = scale[P] * H_pow2.real[source[P]]
+        data[self.angle[Q]] = scale[Q] * H_pow1.imag[source[Q]]
+        data[self.magnitude[Q]] = scale[Q] * H_pow2.imag[source[Q]]
+        return self.H
+
+
+def residual(X0, z, num_node, knownP, knownQ, knownV, Y, sqrt_weights=None):
     delta, Vabs = X0[:num_node], X0[num_node:]
     h = estimated_pqv(knownP, knownQ, knownV, Y, delta, Vabs, num_node)
     logger.debug("X0")
@@ -95,6 +183,8 @@ def residual(X0, z, num_node, knownP, knownQ, knownV, Y):
     logger.debug(z)
     logger.debug("h")
     logger.debug(h)
+    if sqrt_weights is not None:
+        return sqrt_weights * (z - h)
     return z - h
 
 
@@ -120,20 +210,298 @@ def matrix_to_numpy(admittance: List[List[Complex]]):
     return np.array([[x[0] + 1j * x[1] for x in row] for row in admittance])
 
 
+# Topology indices of measurement ids, keyed by the versions of both id lists
+INDICES = {}
+
+
 def get_indices(topology, measurement):
     "Get list of indices in the topology for each index of the input measurement"
-    inv_map = {v: i for i, v in enumerate(
-        topology.base_voltage_magnitudes.ids)}
-    return [inv_map[v] for v in measurement.ids]
+    key = (ids_version(topology.base_voltage_magnitudes.ids),
+           ids_version(measurement.ids))
+    if key not in INDICES:
+        inv_map = {v: i for i, v in enumerate(
+            topology.base_voltage_magnitudes.ids)}
+        INDICES[key] = [inv_map[v] for v in measurement.ids]
+    return INDICES[key]
+
+
+# Fill-reducing orderings of the gain matrix, keyed like INDICES
+ORDERINGS = {}
+SPLU_OPTIONS = {"diag_pivot_thresh": 0, "options": {"SymmetricMode": True}}
+
+
+def permutation(G, order):
+    """Pattern of G with rows and columns in order, and where its entries come from."""
+    position = scipy.sparse.csc_array(
+        (np.arange(1, G.nnz + 1, dtype=float), G.indices, G.indptr), shape=G.shape
+    )[order][:, order].tocsc()
+    # splu sorts the indices of unsorted matrices in place
+    position.sort_indices()
+    return {
+        "pattern": (G.indptr.copy(), G.indices.copy()),
+        "indptr": position.indptr,
+        "indices": position.indices,
+        "entries": position.data.astype(np.int64) - 1,
+    }
+
+
+def factorize(G, key):
+    """Factorize the gain matrix G, returning a function that solves with it.
+
+    The pattern of G only depends on the topology and the measurement sets,
+    so the ordering SuperLU computes the first time is kept under key and
+    later matrices are permuted with it and factorized in natural order.
+    """
+    ordering = ORDERINGS.get(key)
+    if ordering is None or len(ordering["order"]) != G.shape[0]:
+        lu = scipy.sparse.linalg.splu(G, permc_spec="MMD_AT_PLUS_A", **SPLU_OPTIONS)
+        order = np.argsort(lu.perm_c)
+        ORDERINGS[key] = {"order": order, **permutation(G, order)}
+        return lu.solve
+
+    order = ordering["order"]
+    indptr, indices = ordering["pattern"]
+    if not (np.array_equal(G.indptr, indptr) and np.array_equal(G.indices, indices)):
+        ordering.update(permutation(G, order))
+    permuted = scipy.sparse.csc_array(
+        (G.data[ordering["entries"]], ordering["indices"], ordering["indptr"]),
+        shape=G.shape,
+    )
+    lu = scipy.sparse.linalg.splu(permuted, permc_spec="NATURAL", **SPLU_OPTIONS)
+
+    def solve(b):
+        x = np.empty_like(b)
+        x[order] = lu.solve(b[order])
+        return x
+
+    return solve
+
+
+GAUSS_NEWTON_MESSAGES = {
+    0: "The maximum number of iterations is exceeded.",
+    1: "`gtol` termination condition is satisfied.",
+    2: "`ftol` termination condition is satisfied.",
+    3: "`xtol` termination condition is satisfied.",
+}
+
+
+# damping of the first Gauss-Newton step
+INITIAL_DAMPING = 1e-6
+
+
+def gauss_newton(
+    fun, jac, x0, args, tol, max_iterations, fixed, key, damping, prior_weight=0.0
+):
+    """Minimize the sum of squares of fun with damped Gauss-Newton steps.
+
+    Each step solves the sparse normal equations ``(H^T H + l D) dx = -H^T r``
+    with D the diagonal of ``H^T H``, so the damping does not depend on the
+    scale of the weights. l starts at INITIAL_DAMPING, drops tenfold after a
+    step that reduces the cost, down to damping, and grows tenfold when a
+    step does not. Some nodes are not observable from the measurements,
+    which leaves ``H^T H`` singular. A prior_weight adds
+    ``prior_weight * |x - x0|^2`` to the cost, which holds those directions
+    at the start state; it should be far below the curvature of the
+    observable ones so that it does not bias them. The variables in fixed
+    are held at their initial value. Stops like ``least_squares`` on tol and
+    returns an ``OptimizeResult`` with the same fields and status codes.
+    """
+    x = np.array(x0, dtype=float)
+    prior = x.copy()
+    free = np.ones(len(x), dtype=bool)
+    free[fixed] = False
+
+    def objective(x, r):
+        return 0.5 * (r @ r + prior_weight * np.sum((x - prior) ** 2))
+
+    r = fun(x, *args)
+    cost = objective(x, r)
+    nfev, njev = 1, 0
+    status = 0
+    lam = max(damping, INITIAL_DAMPING)
+    while njev < max_iterations:
+        H = scipy.sparse.csc_array(jac(x, *args))[:, free]
+        njev += 1
+        g = H.T @ r + prior_weight * (x - prior)[free]
+        if np.max(np.abs(g), initial=0) < tol:
+            status = 1
+            break
+        G = (H.T @ H).tocsc()
+        if prior_weight > 0:
+            G = G + prior_weight * scipy.sparse.eye_array(G.shape[0], format="csc")
+        # unobserved variables have no diagonal entry to scale with
+        d = G.diagonal()
+        D = scipy.sparse.diags_array(np.maximum(d, 1e-12 * np.max(d, initial=1)))
+        while True:
+            solve = factorize((G + lam * D).tocsc(), key)
+            step = np.zeros_like(x)
+            step[free] = -solve(g)
+            x_new = x + step
+            r_new = fun(x_new, *args)
+            nfev += 1
+            cost_new = objective(x_new, r_new)
+            if cost_new < cost or lam > 1e10:
+                break
+            lam *= 10
+        lam = max(lam / 10, damping)
+        if not cost_new < cost:
+            # no step reduces the cost any more, as a trust region that
+            # shrinks to nothing in least_squares
+            status = 3
+            break
+        small_reduction = cost - cost_new < tol * cost
+        small_step = np.linalg.norm(step) < tol * (tol + np.linalg.norm(x_new))
+        x, r, cost = x_new, r_new, cost_new
+        if small_reduction:
+            status = 2
+            break
+        if small_step:
+            status = 3
+            break
+    return OptimizeResult(
+        x=x,
+        fun=r,
+        cost=cost,
+        nfev=nfev,
+        njev=njev,
+        status=status,
+        message=GAUSS_NEWTON_MESSAGES[status],
+        success=status > 0,
+    )
+
+
+class EstimatorMethod(str, Enum):
+    TRF = "trf"
+    GAUSS_NEWTON = "gauss_newton"
+
+
+class ClassWeights(BaseModel):
+    # 1 / variance of the measurement errors in per-unit, for the whole
+    # class and for single sensors by id
+    weight: float = 1.0
+    sensors: Dict[str, float] = {}
+
+    def for_ids(self, ids: List[str]):
+        "Weights of the measurements with ids"
+        if not self.sensors:
+            return np.full(len(ids), self.weight)
+        return np.array([self.sensors.get(i, self.weight) for i in ids])
+
+
+class MeasurementWeights(BaseModel):
+    voltage: ClassWeights = ClassWeights()
+    real_power: ClassWeights = ClassWeights()
+    reactive_power: ClassWeights = ClassWeights()
 
 
 class AlgorithmParameters(BaseModel):
     tol: float = 5e-7
     base_power: Optional[float] = 100.0
+    # trf uses scipy least_squares, gauss_newton solves the sparse normal
+    # equations for at most max_iterations steps
+    method: EstimatorMethod = EstimatorMethod.TRF
+    max_iterations: int = 50
+    damping: float = 1e-12
+    # gauss_newton only: weight of the prior toward the start state, relative
+    # to the mean measurement weight. It holds the unobservable directions
+    # at the start state, so it must be positive
+    prior_weight: float = 1e-8
+    # start from the previous estimate, falling back to the flat start when
+    # it does not converge or the RMS of its weighted residual is above
+    # reset_residual
+    warm_start: bool = True
+    reset_residual: Optional[float] = None
+    # weights of the residuals, read from weights_file when it is given
+    weights: MeasurementWeights = MeasurementWeights()
+    weights_file: Optional[str] = None
 
     class Config:
         use_enum_values = True
 
+    @validator("prior_weight")
+    def check_prior_weight(cls, prior_weight, values):
+        if values.get("method") == EstimatorMethod.GAUSS_NEWTON and prior_weight <= 0:
+            raise ValueError(
+                "gauss_newton needs a positive prior_weight, the unobservable "
+                "nodes make it diverge without one"
+            )
+        return prior_weight
+
+
+class EstimatorModel:
+    """Per-unit network and measurement layout shared by the time steps.
+
+    Holds the per-unit Y and its conjugate, the topology indices and weights
+    of the measurements and the Jacobian structure for one set of
+    measurement ids, so a time step only packs the measurement vector and
+    solves.
+    """
+
+    def __init__(self, parameters: AlgorithmParameters, topology, P, Q, V):
+        self.base_voltages = np.array(topology.base_voltage_magnitudes.values)
+        self.num_node = len(self.base_voltages)
+        self.base_power = parameters.base_power
+        self.key = (
+            ids_version(topology.base_voltage_magnitudes.ids),
+            ids_version(P.ids),
+            ids_version(Q.ids),
+            ids_version(V.ids),
+        )
+        knownP = get_indices(topology, P)
+        knownQ = get_indices(topology, Q)
+        knownV = get_indices(topology, V)
+        self.knownP = np.asarray(knownP, dtype=np.int64)
+        self.knownQ = np.asarray(knownQ, dtype=np.int64)
+        self.knownV = np.asarray(knownV, dtype=np.int64)
+
+        Y = get_y(topology.admittance, topology.base_voltage_magnitudes.ids)
+        # Hand-crafted unit conversion (check it, it works)
+        self.Y = scipy.sparse.csr_array(
+            scipy.sparse.diags_array(self.base_voltages)
+            @ Y
+            @ scipy.sparse.diags_array(self.base_voltages)
+        ) / (parameters.base_power * 1000)
+
+        # Residual and Jacobian rows are scaled by the square root of the weights
+        # Real dimension of solutions is
+        # 2 * num_node - len(knownP) - len(knownV) - len(knownQ)
+        weights = parameters.weights
+        self.sqrt_weights = np.sqrt(
+            np.concatenate(
+                (
+                    weights.voltage.for_ids(V.ids),
+                    weights.real_power.for_ids(P.ids),
+                    weights.reactive_power.for_ids(Q.ids),
+                )
+            )
+        )
+        # the prior is relative to the weights, so it does not depend on their scale
+        self.prior_weight = parameters.prior_weight * np.mean(self.sqrt_weights**2)
+        self.jacobian = JacobianStructure(
+            self.Y, self.num_node, knownP, knownQ, knownV, self.sqrt_weights
+        )
+        self.Y_conjugate = self.jacobian.Yc
+
+    def measurements(self, P, Q, V):
+        """Measurement vector z in per-unit, voltages then P then Q."""
+        return np.concatenate(
+            (
+                np.asarray(V.values) / self.base_voltages[self.knownV],
+                -np.asarray(P.values) / self.base_power,
+                -np.asarray(Q.values) / self.base_power,
+            )
+        )
+
+    def residual(self, X0, z):
+        """Weighted residual, as ``residual`` with the model's Y and weights."""
+        deltaK, VabsK = X0[: self.num_node], X0[self.num_node:]
+        Vp = VabsK * np.exp(1j * deltaK)
+        S = Vp * (self.Y_conjugate @ Vp.conjugate())
+        h = np.concatenate(
+            (VabsK[self.knownV], S.real[self.knownP], S.imag[self.knownQ])
+        )
+        return self.sqrt_weights * (z - h)
+
 
 def state_estimator(
     parameters: AlgorithmParameters,
@@ -144,6 +512,7 @@ def state_estimator(
     initial_ang=0,
     initial_V=1,
     slack_index=0,
+    model=None,
 ):
     """Estimates voltage magnitude and angle from topology, partial power injections
     P + Q i, and lossy partial voltage magnitude.
@@ -160,32 +529,22 @@ def state_estimator(
         Reactive power injection with unique ids
     V : VoltagesMagnitude (inherited from MeasurementArray)
         Voltage magnitude with unique ids
+    model : EstimatorModel, optional
+        Network and measurement layout of topology for the ids of P, Q and V,
+        built from them when not given
+
+    Returns
+    -------
+    Voltage magnitudes, voltage angles relative to the slack bus and the
+    ``OptimizeResult`` of the solver.
     """
-    base_voltages = np.array(topology.base_voltage_magnitudes.values)
-    num_node = len(base_voltages)
+    if model is None:
+        model = EstimatorModel(parameters, topology, P, Q, V)
+    num_node = model.num_node
     logging.debug("Number of Nodes")
     logging.debug(num_node)
 
-    knownP = get_indices(topology, P)
-    knownQ = get_indices(topology, Q)
-    knownV = get_indices(topology, V)
-
-    z = np.concatenate(
-        (
-            V.values / base_voltages[knownV],
-            -np.array(P.values) / parameters.base_power,
-            -np.array(Q.values) / parameters.base_power,
-        ),
-        axis=0,
-    )
-
-    Y = get_y(topology.admittance, topology.base_voltage_magnitudes.ids)
-    # Hand-crafted unit conversion (check it, it works)
-    Y = (
-        scipy.sparse.diags_array(base_voltages)
-        @ Y
-        @ scipy.sparse.diags_array(base_voltages)
-    ) / (parameters.base_power * 1000)
+    z = model.measurements(P, Q, V)
     tol = parameters.tol
 
     if type(initial_ang) != np.ndarray:
@@ -207,20 +566,33 @@ def state_estimator(
     X0 = np.concatenate((delta, Vabs))
     logging.debug(X0)
 
-    # Weights are ignored since errors are sampled from Gaussian
-    # Real dimension of solutions is
-    # 2 * num_node - len(knownP) - len(knownV) - len(knownQ)
-    ls_result = least_squares(
-        residual,
-        X0,
-        jac=calculate_jacobian,
-        method="trf",
-        verbose=2,
-        ftol=tol,
-        xtol=tol,
-        gtol=tol,
-        args=(z, num_node, knownP, knownQ, knownV, Y),
-    )
+    args = (z,)
+    if parameters.method == EstimatorMethod.GAUSS_NEWTON:
+        # the slack angle is the reference, the other angles are solved
+        ls_result = gauss_newton(
+            model.residual,
+            model.jacobian,
+            X0,
+            args,
+            tol,
+            parameters.max_iterations,
+            [slack_index],
+            model.key,
+            parameters.damping,
+            model.prior_weight,
+        )
+    else:
+        ls_result = least_squares(
+            model.residual,
+            X0,
+            jac=model.jacobian,
+            method="trf",
+            verbose=2,
+            ftol=tol,
+            xtol=tol,
+            gtol=tol,
+            args=args,
+        )
     solution = ls_result.x
     vmagestDecen, vangestDecen = solution[num_node:], solution[:num_node]
     logging.debug("vangestDecen")
@@ -228,7 +600,19 @@ def state_estimator(
     logging.debug("vmagestDecen")
     logging.debug(vmagestDecen)
     vangestDecen = vangestDecen - vangestDecen[slack_index]
-    return vmagestDecen * base_voltages, vangestDecen
+    return vmagestDecen * model.base_voltages, vangestDecen, ls_result
+
+
+def rms_residual(result):
+    return np.sqrt(np.mean(result.fun**2)) if len(result.fun) else 0.0
+
+
+def converged(result, parameters: AlgorithmParameters):
+    """Check if an estimate can be used as the start of the next time step."""
+    if not result.success or not np.all(np.isfinite(result.x)):
+        return False
+    threshold = parameters.reset_residual
+    return threshold is None or rms_residual(result) <= threshold
 
 
 class StateEstimatorFederate:
@@ -293,7 +677,13 @@ class StateEstimatorFederate:
 
         self.initial_ang = None
         self.initial_V = None
+        self.previous_ang = None
+        self.previous_V = None
+        self.models = {}
         topology = Topology.parse_obj(self.sub_topology.json)
+        # version the topology ids once, get_indices caches on it every step
+        topology.base_voltage_magnitudes.ids = versioned(
+            topology.base_voltage_magnitudes.ids)
         ids = topology.base_voltage_magnitudes.ids
         logger.info("Topology has been read")
         slack_index = None
@@ -315,40 +705,19 @@ class StateEstimatorFederate:
 
             logger.info("start time: " + str(datetime.now()))
 
-            voltages = VoltagesMagnitude.parse_obj(
-                self.sub_voltages_magnitude.json)
-            power_P = PowersReal.parse_obj(self.sub_power_P.json)
-            power_Q = PowersImaginary.parse_obj(self.sub_power_Q.json)
-            knownV = get_indices(topology, voltages)
-
-            if self.initial_V is None:
-                # Flat start or using average measurements
-                if (
-                    len(power_P.ids) + len(voltages.ids) + len(power_Q.ids)
-                    > len(ids) * 2
-                ):
-                    self.initial_V = 1.0
-                else:
-                    self.initial_V = np.mean(
-                        np.array(voltages.values)
-                        / np.array(topology.base_voltage_magnitudes.values)[knownV]
-                    )
-            if self.initial_ang is None:
-                self.initial_ang = np.array(
-                    topology.base_voltage_angles.values)
-
-            voltage_magnitudes, voltage_angles = state_estimator(
-                self.algorithm_parameters,
-                topology,
-                power_P,
-                power_Q,
-                voltages,
-                initial_V=self.initial_V,
-                initial_ang=self.initial_ang,
-                slack_index=slack_index,
+            try:
+                voltages = decode(self.sub_voltages_magnitude, VoltagesMagnitude)
+                power_P = decode(self.sub_power_P, PowersReal)
+                power_Q = decode(self.sub_power_Q, PowersImaginary)
+            except MissingIds as e:
+                logger.warning(f"Skipping time step {granted_time}: {e}")
+                granted_time = h.helicsFederateRequestTime(
+                    self.vfed, h.HELICS_TIME_MAXTIME
+                )
+                continue
+            voltage_magnitudes, voltage_angles = self.estimate(
+                topology, voltages, power_P, power_Q, slack_index
             )
-            # self.initial_V = voltage_magnitudes
-            # self.initial_ang = voltage_angles
             self.pub_voltage_mag.publish(
                 VoltagesMagnitude(
                     values=list(voltage_magnitudes), ids=ids, time=voltages.time
@@ -363,6 +732,91 @@ class StateEstimatorFederate:
 
         self.destroy()
 
+    def model(self, topology, voltages, power_P, power_Q):
+        """EstimatorModel of the topology for the ids of the measurements."""
+        key = (
+            ids_version(power_P.ids),
+            ids_version(power_Q.ids),
+            ids_version(voltages.ids),
+        )
+        if key not in self.models:
+            self.models[key] = EstimatorModel(
+                self.algorithm_parameters, topology, power_P, power_Q, voltages
+            )
+        return self.models[key]
+
+    def estimate(self, topology, voltages, power_P, power_Q, slack_index):
+        """Estimate the voltages of a time step.
+
+        Starts from the estimate of the previous time step when warm_start is
+        set, and solves again from the flat start if that does not converge.
+        """
+        ids = topology.base_voltage_magnitudes.ids
+        model = self.model(topology, voltages, power_P, power_Q)
+        base_voltages = model.base_voltages
+        knownV = model.knownV
+
+        if self.initial_V is None:
+            # Flat start or using average measurements
+            if (
+                len(power_P.ids) + len(voltages.ids) + len(power_Q.ids)
+                > len(ids) * 2
+            ):
+                self.initial_V = 1.0
+            else:
+                self.initial_V = np.mean(
+                    np.array(voltages.values) / base_voltages[knownV]
+                )
+        if self.initial_ang is None:
+            self.initial_ang = np.array(topology.base_voltage_angles.values)
+
+        warm = self.algorithm_parameters.warm_start and self.previous_V is not None
+        if warm:
+            initial_V, initial_ang = self.previous_V, self.previous_ang
+        else:
+            initial_V, initial_ang = self.initial_V, self.initial_ang
+        voltage_magnitudes, voltage_angles, result = state_estimator(
+            self.algorithm_parameters,
+            topology,
+            power_P,
+            power_Q,
+            voltages,
+            initial_V=initial_V,
+            initial_ang=initial_ang,
+            slack_index=slack_index,
+            model=model,
+        )
+        if warm and not converged(result, self.algorithm_parameters):
+            logger.info(
+                f"Warm start ended with residual {rms_residual(result):.3g}, "
+                "solving from flat start"
+            )
+            voltage_magnitudes, voltage_angles, result = state_estimator(
+                self.algorithm_parameters,
+                topology,
+                power_P,
+                power_Q,
+                voltages,
+                initial_V=self.initial_V,
+                initial_ang=self.initial_ang,
+                slack_index=slack_index,
+                model=model,
+            )
+        if not result.success:
+            logger.warning(
+                f"Estimate did not converge: {result.message} "
+                f"Residual {rms_residual(result):.3g} after {result.nfev} evaluations"
+            )
+
+        # keep the estimate in per-unit for the next time step
+        if converged(result, self.algorithm_parameters):
+            self.previous_V = voltage_magnitudes / base_voltages
+            self.previous_ang = voltage_angles
+        else:
+            self.previous_V = None
+            self.previous_ang = None
+        return voltage_magnitudes, voltage_angles
+
     def destroy(self):
         "Finalize and destroy the federates"
         h.helicsFederateDisconnect(self.vfed)
@@ -381,6 +835,9 @@ def run_simulator(broker_config: BrokerConfig):
                 config["algorithm_parameters"])
         else:
             parameters = AlgorithmParameters.parse_obj({})
+        if parameters.weights_file is not None:
+            parameters.weights = MeasurementWeights.parse_file(
+                parameters.weights_file)
 
     with open("input_mapping.json") as f:
         input_mapping = json.load(f)
@@ -6,23 +6,14 @@ import math
 import os
 import random
 import time
+from dataclasses import dataclass
 from enum import Enum
 from time import strptime
 from typing import Dict, List, Optional, Set
 
-import boto3
 import numpy as np
 import opendssdirect as dss
 import xarray as xr
-from botocore import UNSIGNED
-from botocore.config import Config
-from dss_functions import (
-    get_capacitors,
-    get_generators,
-    get_loads,
-    get_pvsystems,
-    get_voltages,
-)
 
 from oedisi.types.data_types import (
     Command,
@@ -31,7 +22,10 @@ from oedisi.types.data_types import (
     IncidenceList,
 )
 from pydantic import BaseModel
-from scipy.sparse import coo_matrix, csc_matrix
+from scipy.sparse import coo_matrix, csr_matrix
+
+from checkpoint import checkpoint_directory, restore_checkpoint, save_checkpoint
+from download_cache import DownloadCache, download_model, open_bucket
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -69,7 +63,14 @@ class FeederConfig(BaseModel):
     start_time_index: int = 0
     topology_output: str = "topology.json"
     use_sparse_admittance: bool = False
+    binary_payloads: bool = False
+    load_y_delta: bool = False
+    validate_every_n_steps: int = 1
     tap_setting: Optional[int] = None
+    checkpoint_location: Optional[str] = None
+    download_cache: Optional[str] = None
+    download_source: Optional[str] = None
+    offline: bool = False
 
 
 class FeederMapping(BaseModel):
@@ -89,6 +90,83 @@ class OpenDSSState(Enum):
     DISABLED = 7
 
 
+# Element classes whose powers are injected at the nodes, with the
+# OpenDSS interface that iterates over them
+POWER_CLASSES = {
+    "Load": dss.Loads,
+    "PVSystem": dss.PVsystems,
+    "Generator": dss.Generators,
+    "Capacitor": dss.Capacitors,
+}
+
+
+# Properties that change which nodes elements are connected to
+TOPOLOGY_PROPERTIES = {"bus1", "bus2", "buses", "phases", "conn", "enabled"}
+
+
+@dataclass
+class ElementTable:
+    """Static metadata of the elements of one class, as arrays.
+
+    ``names``, ``bus`` and ``phase_mask`` have one entry per element, in the
+    order of the OpenDSS iterator. The other fields have one entry per
+    element node, sorted by node name. ``positions`` indexes the active power
+    in the concatenated ``CktElement.Powers`` of all elements of the class,
+    and the reactive power follows it.
+    """
+
+    n_elements: int
+    names: List[str]
+    bus: np.ndarray
+    phase_mask: np.ndarray
+    equipment_ids: List[str]
+    ids: List[str]
+    element: np.ndarray
+    nodes: np.ndarray
+    positions: np.ndarray
+    node_count: np.ndarray
+
+
+@dataclass
+class LoadAdmittance:
+    """Admittance entries of the loads at a load shape multiplier of 1.
+
+    ``conductance`` is scaled by the P multiplier and ``susceptance`` by the
+    Q multiplier of ``shapes[shape]``. Entries without a load shape have
+    ``shape == len(shapes)``.
+    """
+
+    rows: np.ndarray
+    cols: np.ndarray
+    conductance: np.ndarray
+    susceptance: np.ndarray
+    shape: np.ndarray
+    shapes: List[str]
+
+
+# Load shape points kept from the last one read
+SHAPE_WINDOW = 96
+
+
+def shape_point(hour, interval, npts):
+    """Index of the point of a fixed interval load shape OpenDSS uses at hour."""
+    # round half to even, like OpenDSS
+    index = round(hour / interval)
+    if index > npts:
+        index = index % npts
+    if index == 0:
+        index = npts
+    return index - 1
+
+
+def shape_points(hours, interval, npts):
+    """``shape_point`` of an array of hours."""
+    index = np.round(np.asarray(hours) / interval).astype(int)
+    index = np.where(index > npts, index % npts, index)
+    index = np.where(index == 0, npts, index)
+    return index - 1
+
+
 class FeederSimulator(object):
     """A simple class that handles publishing the solar forecast."""
 
@@ -100,7 +178,15 @@ class FeederSimulator(object):
     _name_index_dict: Dict[str, int]
     _inverter_to_pvsystems: Dict[str, Set[str]]
     _pvsystem_to_inverter: Dict[str, str]
-    _pvsystems: Set[str]
+    _elements: Dict[str, ElementTable]
+    _property_names: Dict[str, Set[str]]
+    _load_admittance: Optional[LoadAdmittance]
+    _load_shapes: Dict[str, tuple]
+    _needs_snapshot_run: bool
+    _y_node_order: List[str]
+    _y_permutation: np.ndarray
+    _y_patterns: Dict[str, tuple]
+    _pv_setpoints: Dict[str, tuple]
     _inverters: Set[str]
     _inverter_counter: int
     _xycurve_counter: int
@@ -108,16 +194,28 @@ class FeederSimulator(object):
     def __init__(self, config: FeederConfig):
         """Create a ``FeederSimulator`` object."""
         self._state = OpenDSSState.UNLOADED
+        self._needs_snapshot_run = True
         self._opendss_location = config.opendss_location
         self._profile_location = config.profile_location
         self._sensor_location = config.sensor_location
         self._use_smartds = config.use_smartds
         self._user_uploads_model = config.user_uploads_model
+        self._checkpoint_location = config.checkpoint_location
+        self._download_cache = config.download_cache
+        self._download_source = config.download_source
+        self._offline = config.offline
         self._inverter_to_pvsystems = {}
         self._pvsystem_to_inverter = {}
         self._inverters = set()
         self._inverter_counter = 0
         self._xycurve_counter = 0
+        self._elements = {}
+        self._property_names = {}
+        self._load_admittance = None
+        self._load_shapes = {}
+        self._y_node_order = []
+        self._y_patterns = {}
+        self._pv_setpoints = {}
 
         self._start_time = int(
             time.mktime(strptime(config.start_date, "%Y-%m-%d %H:%M:%S"))
@@ -152,34 +250,57 @@ class FeederSimulator(object):
         self.snapshot_run()
         assert self._state == OpenDSSState.SNAPSHOT_RUN, f"{self._state}"
 
-    def forcast_pv(self, steps: int) -> list:
-        cmd = f'Set stepsize={self._simulation_time_step} Number=1'
-        dss.Text.Command(cmd)
-        forecast = []
-        for k in range(steps):
-            dss.Solution.Solve()
-
-            # names of PV systems and forecasted power output
-            pv_names = []
-            powers = []
-
-            # compute average irradiance for the current timestep
-            flag = dss.PVsystems.First()
-            avg_irradiance = dss.PVsystems.IrradianceNow()
-            while flag:
-                avg_irradiance = (
-                    avg_irradiance + dss.PVsystems.IrradianceNow())/2
-                flag = dss.PVsystems.Next()
-
-            # now compute the power output from the evaluated average irradiance
-            flag = dss.PVsystems.First()
-            while flag:
-                pv_names.append(f"PVSystem.{dss.PVsystems.Name().lower()}")
-                powers.append(dss.PVsystems.Pmpp() * avg_irradiance)
-                flag = dss.PVsystems.Next()
-
-            forecast.append(xr.DataArray(powers, coords={"ids": pv_names}))
-        return forecast
+    def forcast_pv(self, steps: int) -> xr.DataArray:
+        """Forecast the available power of the PV systems over steps.
+
+        The irradiance of each PV system is read from its yearly (or daily)
+        load shape at the times ``solve`` is called for the time steps,
+        without running the solver, so the forecast of a step is the
+        ``Pmpp * IrradianceNow`` that ``get_available_pv`` reports then.
+
+        Returns
+        -------
+        xr.DataArray with dims ``("time", "ids")`` in kW
+        """
+        start = time.localtime(self._start_time)
+        seconds = (
+            3600 * start.tm_hour + 60 * start.tm_min + start.tm_sec
+            + self._run_freq_sec * np.arange(steps)
+        )
+        # like go_cosim, solve at the hour and second of the day
+        hours = (seconds % 86400) / 3600
+
+        names = []
+        ratings = []
+        pv_shapes = []
+        flag = dss.PVsystems.First()
+        while flag:
+            names.append(dss.CktElement.Name())
+            ratings.append(dss.PVsystems.Pmpp() * dss.PVsystems.Irradiance())
+            pv_shapes.append(dss.PVsystems.yearly() or dss.PVsystems.daily())
+            flag = dss.PVsystems.Next()
+
+        shapes = sorted(set(pv_shapes) - {""})
+        multipliers = np.ones((steps, len(shapes) + 1))
+        for ii, load_shape in enumerate(shapes):
+            dss.LoadShape.Name(load_shape)
+            interval = dss.LoadShape.HrInterval()
+            pmult = np.array(dss.LoadShape.PMult())
+            if interval <= 0:
+                shape_hours = np.array(dss.LoadShape.TimeArray())
+                multipliers[:, ii] = np.interp(
+                    hours % shape_hours[-1], shape_hours, pmult)
+            else:
+                multipliers[:, ii] = pmult[shape_points(hours, interval, len(pmult))]
+
+        shape_index = {name: ii for ii, name in enumerate(shapes)}
+        shape_index[""] = len(shapes)
+        columns = [shape_index[name] for name in pv_shapes]
+        return xr.DataArray(
+            multipliers[:, columns] * np.array(ratings),
+            dims=("time", "ids"),
+            coords={"ids": names},
+        )
 
     def snapshot_run(self):
         """Run snapshot of simuation without specifying a time.
@@ -191,6 +312,16 @@ class FeederSimulator(object):
         dss.Text.Command("CalcVoltageBases")
         dss.Text.Command("solve mode=snapshot")
         self._state = OpenDSSState.SNAPSHOT_RUN
+        self._needs_snapshot_run = False
+
+    def needs_snapshot_run(self):
+        """Check if elements may be disabled or voltage bases out of date.
+
+        Set by commands that disable elements or change connections or
+        controls, cleared once everything is re-enabled and voltage bases
+        are recalculated. Otherwise solving at the next time is enough.
+        """
+        return self._needs_snapshot_run
 
     def reenable(self):
         dss.Text.Command("Batchedit Load..* enabled=yes")
@@ -202,61 +333,27 @@ class FeederSimulator(object):
         dss.Text.Command("Batchedit Storage..* enabled=no")
 
     def download_data(self, bucket_name, update_loadshape_location=False):
-        """Download data from bucket path."""
+        """Download data from bucket path, through the download cache if set."""
         logging.info(f"Downloading from bucket {bucket_name}")
-        # Equivalent to --no-sign-request
-        s3_resource = boto3.resource(
-            "s3", config=Config(signature_version=UNSIGNED))
-        bucket = s3_resource.Bucket(bucket_name)
-        opendss_location = self._opendss_location
-        profile_location = self._profile_location
-        sensor_location = self._sensor_location
-
-        for obj in bucket.objects.filter(Prefix=opendss_location):
-            output_location = os.path.join(
-                "opendss", obj.key.replace(opendss_location, "").strip("/")
+        if self._offline and self._download_cache is None:
+            raise ValueError("Offline mode needs a download cache")
+        bucket = None
+        if not self._offline:
+            bucket = open_bucket(bucket_name, self._download_source)
+        if self._download_cache is not None:
+            bucket = DownloadCache(
+                self._download_cache, bucket_name, bucket, self._offline)
+        try:
+            download_model(
+                bucket,
+                self._opendss_location,
+                self._profile_location,
+                self._sensor_location,
+                update_loadshape_location,
             )
-            os.makedirs(os.path.dirname(output_location), exist_ok=True)
-            bucket.download_file(obj.key, output_location)
-
-        modified_loadshapes = ""
-        os.makedirs(os.path.join("profiles"), exist_ok=True)
-        if update_loadshape_location:
-            all_profiles = set()
-            with open(os.path.join("opendss", "LoadShapes.dss"), "r") as fp_loadshapes:
-                for row in fp_loadshapes.readlines():
-                    new_row = row.replace("../", "")
-                    new_row = new_row.replace("file=", "file=../")
-                    for token in new_row.split(" "):
-                        if token.startswith("(file="):
-                            location = (
-                                token.split(
-                                    "=../profiles/")[1].strip().strip(")")
-                            )
-                            all_profiles.add(location)
-                    modified_loadshapes = modified_loadshapes + new_row
-            with open(os.path.join("opendss", "LoadShapes.dss"), "w") as fp_loadshapes:
-                fp_loadshapes.write(modified_loadshapes)
-            for profile in all_profiles:
-                s3_location = f"{profile_location}/{profile}"
-                bucket.download_file(
-                    s3_location, os.path.join("profiles", profile))
-
-        else:
-            for obj in bucket.objects.filter(Prefix=profile_location):
-                output_location = os.path.join(
-                    "profiles", obj.key.replace(
-                        profile_location, "").strip("/")
-                )
-                os.makedirs(os.path.dirname(output_location), exist_ok=True)
-                bucket.download_file(obj.key, output_location)
-
-        if sensor_location is not None:
-            output_location = os.path.join(
-                "sensors", os.path.basename(sensor_location))
-            if not os.path.exists(os.path.dirname(output_location)):
-                os.makedirs(os.path.dirname(output_location))
-            bucket.download_file(sensor_location, output_location)
+        finally:
+            if self._download_cache is not None:
+                bucket.close()
 
     def create_measurement_lists(
         self,
@@ -305,21 +402,33 @@ class FeederSimulator(object):
         return self._AllNodeNames
 
     def load_feeder(self):
-        """Load feeder once downloaded. Relies on legacy mode."""
+        """Load feeder once downloaded. Relies on legacy mode.
+
+        With a checkpoint location the model is restored from its checkpoint
+        when there is one, and a checkpoint is saved otherwise.
+        """
         # Real solution is kvarlimit with kvarmax
         dss.Basic.LegacyModels(True)
         dss.Text.Command("clear")
-        dss.Text.Command("redirect " + self._feeder_file)
-        result = dss.Text.Result()
-        if not result == "":
-            raise ValueError("Feeder not loaded: " + result)
+        checkpoint = None
+        restored = None
+        if self._checkpoint_location is not None:
+            checkpoint = checkpoint_directory(
+                self._checkpoint_location, self._feeder_file)
+            restored = restore_checkpoint(checkpoint, self._feeder_file)
+            if restored is not None:
+                logger.info(f"Restored feeder from checkpoint {checkpoint}")
+        if restored is None:
+            dss.Text.Command("redirect " + self._feeder_file)
+            result = dss.Text.Result()
+            if not result == "":
+                raise ValueError("Feeder not loaded: " + result)
         self._circuit = dss.Circuit
         self._AllNodeNames = self._circuit.YNodeOrder()
         self._node_number = len(self._AllNodeNames)
-        self._nodes_index = [self._AllNodeNames.index(
-            ii) for ii in self._AllNodeNames]
+        self._nodes_index = list(range(self._node_number))
         self._name_index_dict = {
-            ii: self._AllNodeNames.index(ii) for ii in self._AllNodeNames
+            name: ii for ii, name in enumerate(self._AllNodeNames)
         }
 
         self._source_indexes = []
@@ -328,20 +437,116 @@ class FeederSimulator(object):
             Bus = dss.CktElement.BusNames()[0].upper()
             for phase in range(1, dss.CktElement.NumPhases() + 1):
                 self._source_indexes.append(
-                    self._AllNodeNames.index(Bus.upper() + "." + str(phase))
+                    self._name_index_dict[Bus.upper() + "." + str(phase)]
                 )
 
-        self.setup_vbase()
-
-        self._pvsystems = set()
-        for PV in get_pvsystems(dss):
-            self._pvsystems.add("PVSystem." + PV["name"])
+        self._bus_index_dict = {
+            bus.upper(): ii for ii, bus in enumerate(self._circuit.AllBusNames())
+        }
+        self._elements = {}
+        self._property_names = {}
+        self._load_admittance = None
+        self._load_shapes = {}
+        self._pv_setpoints = {}
+        if restored is not None:
+            self._Vbase_allnode = restored["vbase"]
+            self._Vbase_allnode_dict = dict(
+                zip(self._AllNodeNames, self._Vbase_allnode))
+            self._elements = dict(restored["elements"])
+        else:
+            self.setup_vbase()
+        for element_class in POWER_CLASSES:
+            self._element_table(element_class)
+
+        if checkpoint is not None and restored is None:
+            save_checkpoint(checkpoint, self._feeder_file, {
+                "node_names": self._AllNodeNames,
+                "vbase": self._Vbase_allnode,
+                "elements": self._elements,
+            })
+            logger.info(f"Saved feeder checkpoint {checkpoint}")
 
         if self.tap_setting is not None:
             # Doesn't work with AutoTrans or 3-winding transformers.
             dss.Text.Command(
                 f"batchedit transformer..* wdg=2 tap={self.tap_setting}")
         self._state = OpenDSSState.LOADED
+        self._needs_snapshot_run = True
+
+    @property
+    def _pvsystems(self):
+        """Names of the PV systems, from the PVSystem element table.
+
+        The table is dropped when change_obj changes the topology, so the
+        names follow PV systems that are added, removed or disabled.
+        """
+        return set(self._element_table("PVSystem").names)
+
+    def _element_table(self, element_class):
+        """Get the table of an element class, building it if needed."""
+        if element_class not in self._elements:
+            self._elements[element_class] = self._build_element_table(
+                element_class)
+        return self._elements[element_class]
+
+    def _build_element_table(self, element_class):
+        """Query the static metadata of the elements of a class."""
+        interface = POWER_CLASSES[element_class]
+        names: List[str] = []
+        bus_indexes: List[int] = []
+        phase_masks: List[int] = []
+        equipment_ids: List[str] = []
+        ids: List[str] = []
+        element: List[int] = []
+        nodes: List[int] = []
+        positions: List[int] = []
+        n_elements = 0
+        offset = 0
+        flag = interface.First()
+        while flag:
+            name = dss.CktElement.Name()
+            bus = dss.CktElement.BusNames()[0].split(".")
+            phases = bus[1:]
+            if not phases:
+                phases = ["1", "2", "3"]
+            if element_class == "Capacitor":
+                phases = phases[: dss.CktElement.NumPhases()]
+            names.append(name)
+            bus_indexes.append(self._bus_index_dict[bus[0].upper()])
+            phase_masks.append(
+                sum(1 << (int(phase) - 1) for phase in set(phases) if phase != "0")
+            )
+            for ii, phase in enumerate(phases):
+                node_name = bus[0].upper() + "." + phase
+                assert (
+                    node_name in self._name_index_dict
+                ), f"{node_name} for {name} not found"
+                equipment_ids.append(name)
+                ids.append(node_name)
+                element.append(n_elements)
+                nodes.append(self._name_index_dict[node_name])
+                positions.append(offset + 2 * ii)
+            offset += (
+                2 * dss.CktElement.NumConductors() * dss.CktElement.NumTerminals()
+            )
+            n_elements += 1
+            flag = interface.Next()
+
+        # same order as sorting the xarray by ids
+        order = np.argsort(np.array(ids, dtype=str), kind="stable")
+        element = np.array(element, dtype=int)
+        return ElementTable(
+            n_elements=n_elements,
+            names=names,
+            bus=np.array(bus_indexes, dtype=int),
+            phase_mask=np.array(phase_masks, dtype=int),
+            equipment_ids=[equipment_ids[i] for i in order],
+            ids=[ids[i] for i in order],
+            element=element[order],
+            nodes=np.array(nodes, dtype=int)[order],
+            positions=np.array(positions, dtype=int)[order],
+            node_count=np.bincount(element, minlength=n_elements),
+        )
 
     def disable_elements(self):
         """Disable most elements. Used in disabled_run."""
@@ -355,6 +560,7 @@ class FeederSimulator(object):
         dss.Text.Command("Batchedit Capacitor..* enabled=false")
         dss.Text.Command("batchedit storage..* enabled=false")
         self._state = OpenDSSState.DISABLED
+        self._needs_snapshot_run = True
 
     def disabled_run(self):
         """Disable most elements and solve. Used for most Y-matrix needs."""
@@ -366,22 +572,63 @@ class FeederSimulator(object):
         dss.Text.Command("solve")
         self._state = OpenDSSState.DISABLED_RUN
 
-    def get_y_matrix(self):
-        """Calculate Y-matrix as a coo-matrix. Disables some elements."""
-        self.disabled_run()
-        self._state = OpenDSSState.DISABLED_RUN
+    def _node_permutation(self):
+        """Get permutation from YNodeOrder to _AllNodeNames.
 
-        Ysparse = csc_matrix(dss.YMatrix.getYsparse())
-        Ymatrix = Ysparse.tocoo()
+        Recomputed only when OpenDSS reports a different YNodeOrder.
+        """
         new_order = self._circuit.YNodeOrder()
-        permute = np.array(permutation(new_order, self._AllNodeNames))
-        return coo_matrix(
-            (Ymatrix.data, (permute[Ymatrix.row], permute[Ymatrix.col])),
-            shape=Ymatrix.shape,
+        if new_order != self._y_node_order:
+            self._y_node_order = new_order
+            self._y_permutation = np.array(
+                permutation(new_order, self._AllNodeNames))
+            self._y_patterns = {}
+        return self._y_permutation
+
+    def _get_y_sparse(self, kind):
+        """Get the current OpenDSS Y-matrix as csr-matrix in node order.
+
+        The reordering of the sparsity pattern is cached by kind. While
+        OpenDSS returns the same pattern only the data is copied, and the
+        returned matrices share their index arrays.
+        """
+        permute = self._node_permutation()
+        data, indices, indptr = dss.YMatrix.getYsparse()
+        pattern = self._y_patterns.get(kind)
+        if (
+            pattern is None
+            or not np.array_equal(pattern[0], indices)
+            or not np.array_equal(pattern[1], indptr)
+        ):
+            rows = permute[indices]
+            cols = permute[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))]
+            order = np.lexsort((cols, rows))
+            csr_indptr = np.zeros(self._node_number + 1, dtype=indptr.dtype)
+            np.cumsum(
+                np.bincount(rows, minlength=self._node_number), out=csr_indptr[1:]
+            )
+            pattern = (
+                indices.copy(),
+                indptr.copy(),
+                order,
+                cols[order].astype(indices.dtype),
+                csr_indptr,
+            )
+            self._y_patterns[kind] = pattern
+        _, _, order, csr_indices, csr_indptr = pattern
+        return csr_matrix(
+            (data[order], csr_indices, csr_indptr),
+            shape=(self._node_number, self._node_number),
         )
 
+    def get_y_matrix(self):
+        """Calculate Y-matrix as a csr-matrix. Disables some elements."""
+        self.disabled_run()
+        self._state = OpenDSSState.DISABLED_RUN
+        return self._get_y_sparse("network")
+
     def get_load_y_matrix(self):
-        """Calculate Y-matrix as a coo-matrix. Disables most except load."""
+        """Calculate Y-matrix as a csr-matrix. Disables most except load."""
         assert self._state == OpenDSSState.SOLVE_AT_TIME, f"{self._state}"
         self.disable_elements()
         dss.Text.Command("batchedit Load..* enabled=true")
@@ -390,10 +637,7 @@ class FeederSimulator(object):
         # solve
         dss.Text.Command("solve")
 
-        Ysparse = csc_matrix(dss.YMatrix.getYsparse())
-        Ymatrix = Ysparse.tocoo()
-        new_order = self._circuit.YNodeOrder()
-        permute = np.array(permutation(new_order, self._AllNodeNames))
+        Ymatrix = self._get_y_sparse("load")
 
         dss.Text.Command("batchedit Load..* enabled=false")
         self._state = OpenDSSState.DISABLED_RUN
@@ -403,11 +647,141 @@ class FeederSimulator(object):
         dss.Text.Command("set maxiterations=20")
         dss.Text.Command("solve")
         self._state = OpenDSSState.SOLVE_AT_TIME
+        self._needs_snapshot_run = False
 
-        return coo_matrix(
-            (Ymatrix.data, (permute[Ymatrix.row], permute[Ymatrix.col])),
-            shape=Ymatrix.shape,
+        return Ymatrix
+
+    def _build_load_admittance(self):
+        """Calculate the admittance entries of every load, as OpenDSS does.
+
+        OpenDSS puts the equivalent admittance of the load at its base
+        voltage in the Y-matrix, so this does not depend on the solution.
+        """
+        rows: List[int] = []
+        cols: List[int] = []
+        conductance: List[float] = []
+        susceptance: List[float] = []
+        shape: List[str] = []
+
+        def add(i, j, kW, kvar, load_shape):
+            rows.append(i)
+            cols.append(j)
+            conductance.append(kW)
+            susceptance.append(-kvar)
+            shape.append(load_shape)
+
+        flag = dss.Loads.First()
+        while flag:
+            bus = dss.CktElement.BusNames()[0].split(".")
+            phases = bus[1:]
+            if not phases:
+                phases = ["1", "2", "3"]
+            nodes = [
+                self._name_index_dict.get(bus[0].upper() + "." + phase)
+                for phase in phases
+            ]
+            n_phases = dss.Loads.Phases()
+            # admittance of the load in kW and kvar, multiplied by 1e3 / V^2
+            vbase = dss.Loads.kV() * 1000
+            kW = dss.Loads.kW() * 1000 / vbase**2
+            kvar = dss.Loads.kvar() * 1000 / vbase**2
+            load_shape = dss.Loads.Yearly() or dss.Loads.Daily()
+            if dss.Loads.IsDelta():
+                kW, kvar = kW / n_phases, kvar / n_phases
+                if n_phases == 1:
+                    branches = [(nodes[0], nodes[1])]
+                else:
+                    branches = [
+                        (nodes[i], nodes[(i + 1) % n_phases]) for i in range(n_phases)
+                    ]
+            else:
+                if n_phases > 1:
+                    kW, kvar = 3 * kW / n_phases, 3 * kvar / n_phases
+                neutral = nodes[n_phases] if len(nodes) > n_phases else None
+                branches = [(node, neutral) for node in nodes[:n_phases]]
+            for i, j in branches:
+                add(i, i, kW, kvar, load_shape)
+                if j is not None:
+                    add(j, j, kW, kvar, load_shape)
+                    add(i, j, -kW, -kvar, load_shape)
+                    add(j, i, -kW, -kvar, load_shape)
+            flag = dss.Loads.Next()
+
+        shapes = sorted(set(shape) - {""})
+        shape_index = {name: ii for ii, name in enumerate(shapes)}
+        shape_index[""] = len(shapes)
+        return LoadAdmittance(
+            rows=np.array(rows, dtype=int),
+            cols=np.array(cols, dtype=int),
+            conductance=np.array(conductance),
+            susceptance=np.array(susceptance),
+            shape=np.array([shape_index[name] for name in shape], dtype=int),
+            shapes=shapes,
+        )
+
+    def _load_shape_multipliers(self, load_shape, hour):
+        """Get the P and Q multipliers of a load shape at an hour.
+
+        Only SHAPE_WINDOW points of fixed interval shapes are kept, and they
+        are read again from OpenDSS when hour leaves them.
+        """
+        cached = self._load_shapes.get(load_shape)
+        if cached is not None:
+            interval, npts, start, pmult, qmult, hours = cached
+            if interval <= 0:
+                hour = hour % hours[-1]
+                return np.interp(hour, hours, pmult), np.interp(hour, hours, qmult)
+            point = shape_point(hour, interval, npts)
+            if start <= point < start + len(pmult):
+                return pmult[point - start], qmult[point - start]
+
+        dss.LoadShape.Name(load_shape)
+        interval = dss.LoadShape.HrInterval()
+        pmult = np.array(dss.LoadShape.PMult())
+        qmult = np.array(dss.LoadShape.QMult())
+        if len(qmult) != len(pmult):
+            # OpenDSS uses the P multipliers when there are no Q multipliers
+            qmult = pmult
+        npts = len(pmult)
+        hours = None
+        start = 0
+        if interval <= 0:
+            hours = np.array(dss.LoadShape.TimeArray())
+        else:
+            start = shape_point(hour, interval, npts)
+            pmult = pmult[start: start + SHAPE_WINDOW]
+            qmult = qmult[start: start + SHAPE_WINDOW]
+        self._load_shapes[load_shape] = (interval, npts, start, pmult, qmult, hours)
+        return self._load_shape_multipliers(load_shape, hour)
+
+    def get_load_y_delta(self):
+        """Calculate the load part of the Y-matrix as a csr-matrix.
+
+        Unlike ``get_load_y_matrix`` this does not solve again: the load
+        admittances are calculated from the load table and scaled by the
+        load shapes at the current time. Adding the result to the Y-matrix
+        of ``get_y_matrix`` gives the matrix of ``get_load_y_matrix`` as long
+        as transformer taps have not moved.
+        """
+        assert self._state == OpenDSSState.SOLVE_AT_TIME, f"{self._state}"
+        if self._load_admittance is None:
+            self._load_admittance = self._build_load_admittance()
+        admittance = self._load_admittance
+
+        hour = dss.Solution.DblHour()
+        pmult = np.ones(len(admittance.shapes) + 1)
+        qmult = np.ones(len(admittance.shapes) + 1)
+        for ii, load_shape in enumerate(admittance.shapes):
+            pmult[ii], qmult[ii] = self._load_shape_multipliers(load_shape, hour)
+
+        data = (
+            admittance.conductance * pmult[admittance.shape]
+            + 1j * admittance.susceptance * qmult[admittance.shape]
         )
+        return coo_matrix(
+            (data, (admittance.rows, admittance.cols)),
+            shape=(self._node_number, self._node_number),
+        ).tocsr()
 
     def setup_vbase(self):
         """Load base voltages into feeder."""
@@ -460,152 +834,93 @@ class FeederSimulator(object):
         else:
             assert self._state == OpenDSSState.SOLVE_AT_TIME, f"{self._state}"
 
-    def get_PQs_load(self, static=False):
-        """Get active and reactive power of loads as xarray."""
+    def _static_powers(self, element_class):
+        """Get rated power of each element of a class, split over its nodes."""
+        interface = POWER_CLASSES[element_class]
+        powers: List[complex] = []
+        flag = interface.First()
+        while flag:
+            if element_class == "Load":
+                kW = interface.kW()
+                PF = interface.PF()
+                powers.append(complex(kW, kW / PF * math.sqrt(1 - PF * PF)))
+            elif element_class == "Capacitor":
+                # -1 because it's injected into the grid
+                powers.append(complex(0, -1 * interface.kvar()))
+            else:
+                # -1 because injecting
+                powers.append(complex(-1 * interface.kW(), -1 * interface.kvar()))
+            flag = interface.Next()
+        return np.array(powers, dtype=np.complex128)
+
+    def _element_powers(self, element_class):
+        """Get concatenated ``CktElement.Powers`` of all elements of a class."""
+        interface = POWER_CLASSES[element_class]
+        powers = []
+        flag = interface.First()
+        while flag:
+            powers.append(dss.CktElement.Powers())
+            flag = interface.Next()
+        if len(powers) != self._element_table(element_class).n_elements:
+            # elements were added or disabled since the table was built
+            del self._elements[element_class]
+            return self._element_powers(element_class)
+        if not powers:
+            return np.empty(0)
+        return np.concatenate(powers)
+
+    def _get_PQs(self, element_class, static):
+        """Get powers of an element class as xarray, sorted by node."""
         self._ready_to_load_power(static)
-
-        all_node_names = set(self._AllNodeNames)
-        PQs: List[complex] = []
-        node_names: List[str] = []
-        pq_names: List[str] = []
-        # PQ_load = np.zeros((num_nodes), dtype=np.complex128)
-        for ld in get_loads(dss, self._circuit):
-            self._circuit.SetActiveElement("Load." + ld["name"])
-            current_pq_name = dss.CktElement.Name()
-            for ii in range(len(ld["phases"])):
-                node_name = ld["bus1"].upper() + "." + ld["phases"][ii]
-                assert (
-                    node_name in all_node_names
-                ), f"{node_name} for {current_pq_name} not found"
-                if static:
-                    power = complex(ld["kW"], ld["kVar"])
-                    PQs.append(power / len(ld["phases"]))
-                else:
-                    power = dss.CktElement.Powers()
-                    PQs.append(complex(power[2 * ii], power[2 * ii + 1]))
-                pq_names.append(current_pq_name)
-                node_names.append(node_name)
-        pq_xr = xr.DataArray(
+        if static:
+            powers = self._static_powers(element_class)
+            if len(powers) != self._element_table(element_class).n_elements:
+                del self._elements[element_class]
+            table = self._element_table(element_class)
+            PQs = (powers / np.maximum(table.node_count, 1))[table.element]
+        else:
+            flat = self._element_powers(element_class)
+            table = self._element_table(element_class)
+            if element_class == "Capacitor":
+                PQs = 1j * flat[table.positions + 1]
+            else:
+                PQs = flat[table.positions] + 1j * flat[table.positions + 1]
+        return xr.DataArray(
             PQs,
             dims=("eqnode",),
             coords={
-                "equipment_ids": ("eqnode", pq_names),
-                "ids": ("eqnode", node_names),
+                "equipment_ids": ("eqnode", table.equipment_ids),
+                "ids": ("eqnode", table.ids),
             },
         )
-        return pq_xr.sortby(pq_xr.ids)
+
+    def get_PQs_load(self, static=False):
+        """Get active and reactive power of loads as xarray."""
+        return self._get_PQs("Load", static)
 
     def get_PQs_pv(self, static=False):
         """Get active and reactive power of PVSystems as xarray."""
-        self._ready_to_load_power(static)
-
-        all_node_names = set(self._AllNodeNames)
-        PQs: List[complex] = []
-        node_names: List[str] = []
-        pq_names: List[str] = []
-        for PV in get_pvsystems(dss):
-            bus = PV["bus"].split(".")
-            if len(bus) == 1:
-                bus = bus + ["1", "2", "3"]
-            self._circuit.SetActiveElement("PVSystem." + PV["name"])
-            current_pq_name = dss.CktElement.Name()
-            for ii in range(len(bus) - 1):
-                node_name = bus[0].upper() + "." + bus[ii + 1]
-                assert (
-                    node_name in all_node_names
-                ), f"{node_name} for {current_pq_name} not found"
-                if static:
-                    power = complex(
-                        -1 * PV["kW"], -1 * PV["kVar"]
-                    )  # -1 because injecting
-                    PQs.append(power / (len(bus) - 1))
-                else:
-                    power = dss.CktElement.Powers()
-                    PQs.append(complex(power[2 * ii], power[2 * ii + 1]))
-                pq_names.append(current_pq_name)
-                node_names.append(node_name)
-        pq_xr = xr.DataArray(
-            PQs,
-            dims=("eqnode",),
-            coords={
-                "equipment_ids": ("eqnode", pq_names),
-                "ids": ("eqnode", node_names),
-            },
-        )
-        return pq_xr.sortby(pq_xr.ids)
+        return self._get_PQs("PVSystem", static)
 
     def get_PQs_gen(self, static=False):
         """Get active and reactive power of Generators as xarray."""
-        self._ready_to_load_power(static)
-
-        all_node_names = set(self._AllNodeNames)
-        PQs: List[complex] = []
-        node_names: List[str] = []
-        pq_names: List[str] = []
-        for gen in get_generators(dss):
-            bus = gen["bus"].split(".")
-            if len(bus) == 1:
-                bus = bus + ["1", "2", "3"]
-            self._circuit.SetActiveElement("Generator." + gen["name"])
-            current_pq_name = dss.CktElement.Name()
-            for ii in range(len(bus) - 1):
-                node_name = bus[0].upper() + "." + bus[ii + 1]
-                assert (
-                    node_name in all_node_names
-                ), f"{node_name} for {current_pq_name} not found"
-                if static:
-                    power = complex(
-                        -1 * gen["kW"], -1 * gen["kVar"]
-                    )  # -1 because injecting
-                    PQs.append(power / (len(bus) - 1))
-                else:
-                    power = dss.CktElement.Powers()
-                    PQs.append(complex(power[2 * ii], power[2 * ii + 1]))
-                pq_names.append(current_pq_name)
-                node_names.append(node_name)
-        pq_xr = xr.DataArray(
-            PQs,
-            dims=("eqnode",),
-            coords={
-                "equipment_ids": ("eqnode", pq_names),
-                "ids": ("eqnode", node_names),
-            },
-        )
-        return pq_xr.sortby(pq_xr.ids)
+        return self._get_PQs("Generator", static)
 
     def get_PQs_cap(self, static=False):
         """Get active and reactive power of Capacitors as xarray."""
-        self._ready_to_load_power(static)
+        return self._get_PQs("Capacitor", static)
 
-        all_node_names = set(self._AllNodeNames)
-        PQs: List[complex] = []
-        node_names: List[str] = []
-        pq_names: List[str] = []
-        for cap in get_capacitors(dss):
-            current_pq_name = cap["name"]
-            for ii in range(cap["numPhases"]):
-                node_name = cap["busname"].upper() + "." + cap["busphase"][ii]
-                assert (
-                    node_name in all_node_names
-                ), f"{node_name} for {current_pq_name} not found"
-                if static:
-                    power = complex(
-                        0, -1 * cap["kVar"]
-                    )  # -1 because it's injected into the grid
-                    PQs.append(power / cap["numPhases"])
-                else:
-                    PQs.append(complex(0, cap["power"][2 * ii + 1]))
-                pq_names.append(current_pq_name)
-                node_names.append(node_name)
-        pq_xr = xr.DataArray(
-            PQs,
-            dims=("eqnode",),
-            coords={
-                "equipment_ids": ("eqnode", pq_names),
-                "ids": ("eqnode", node_names),
-            },
+    def get_node_powers(self, PQ_load, PQ_PV, PQ_gen, PQ_cap):
+        """Sum the xarrays from the get_PQs functions into node order."""
+        nodes = np.concatenate(
+            [self._element_table(element_class).nodes for element_class in POWER_CLASSES]
         )
-        return pq_xr.sortby(pq_xr.ids)
+        PQs = np.concatenate(
+            [PQ.data for PQ in (PQ_load, PQ_PV, PQ_gen, PQ_cap)]
+        ).astype(np.complex128)
+        return np.bincount(
+            nodes, weights=PQs.real, minlength=self._node_number
+        ) + 1j * np.bincount(nodes, weights=PQs.imag, minlength=self._node_number)
 
     def get_base_voltages(self):
         """Get base voltages xarray. Can be uesd anytime."""
@@ -632,16 +947,14 @@ class FeederSimulator(object):
             self._state != OpenDSSState.DISABLED_RUN
             and self._state != OpenDSSState.UNLOADED
         ), f"{self._state}"
-        name_voltage_dict = get_voltages(self._circuit)
+        permute = self._node_permutation()
+        voltages = np.array(self._circuit.YNodeVArray()).view(np.complex128)
         res_feeder_voltages = np.zeros(
             (len(self._AllNodeNames)), dtype=np.complex128)
-        for voltage_name in name_voltage_dict.keys():
-            res_feeder_voltages[self._name_index_dict[voltage_name]] = (
-                name_voltage_dict[voltage_name]
-            )
+        res_feeder_voltages[permute] = voltages
 
         return xr.DataArray(
-            res_feeder_voltages, {"ids": list(name_voltage_dict.keys())}
+            res_feeder_voltages, {"ids": list(self._y_node_order)}
         )
 
     def change_obj(self, change_commands: List[Command]):
@@ -658,18 +971,38 @@ class FeederSimulator(object):
         """
         assert self._state != OpenDSSState.UNLOADED, f"{self._state}"
         for entry in change_commands:
-            dss.Circuit.SetActiveElement(
-                entry.obj_name
-            )  # make the required element as active element
-            # dss.CktElement.Properties(entry.obj_property).Val = entry.val
-            # dss.Properties.Value(entry.obj_property, str(entry.val))
-            properties = dss.CktElement.AllPropertyNames()
-            element_name = dss.CktElement.Name()
-            assert entry.obj_property.lower() in map(
-                lambda x: x.lower(), properties
-            ), f"{entry.obj_property} not in {properties} for {element_name}"
+            # property names only depend on the class of the element
+            element_class = entry.obj_name.split(".")[0].lower()
+            if element_class not in self._property_names:
+                dss.Circuit.SetActiveElement(
+                    entry.obj_name
+                )  # make the required element as active element
+                # dss.CktElement.Properties(entry.obj_property).Val = entry.val
+                # dss.Properties.Value(entry.obj_property, str(entry.val))
+                self._property_names[element_class] = set(
+                    map(lambda x: x.lower(), dss.CktElement.AllPropertyNames())
+                )
+            properties = self._property_names[element_class]
+            assert (
+                entry.obj_property.lower() in properties
+            ), f"{entry.obj_property} not in {properties} for {entry.obj_name}"
             dss.Text.Command(
                 f"{entry.obj_name}.{entry.obj_property}={entry.val}")
+            if entry.obj_property.lower() in TOPOLOGY_PROPERTIES:
+                self._elements = {}
+                self._load_admittance = None
+                # PV systems may have been added or removed, apply all again
+                self._pv_setpoints = {}
+                self._needs_snapshot_run = True
+            elif entry.obj_property.lower() == "kv":
+                self._load_admittance = None
+                self._needs_snapshot_run = True
+            elif element_class == "load":
+                self._load_admittance = None
+            elif element_class == "loadshape":
+                self._load_shapes = {}
+            if element_class == "pvsystem":
+                self._pv_setpoints.pop(entry.obj_name.lower(), None)
 
     def create_inverter(self, pvsystem_set: Set[str]):
         """Create new inverter from set of pvsystem.
@@ -776,49 +1109,83 @@ class FeederSimulator(object):
 
     def set_pv_output(self, pv_system, p, q):
         """Sets the P and Q values for a PV system in OpenDSS"""
-        max_pv = self.get_max_pv_available(pv_system)
-        # pf = q / ((p**2 + q **2)**0.5)
+        self.set_pv_outputs([(f"PVSystem.{pv_system}", p, q)])
 
-        obj_name = f"PVSystem.{pv_system}"
-        if max_pv <= 0 or p == 0:
-            Warning("Maximum PV Value is 0")
-            obj_val = 100
-            q = 0
-        elif p < max_pv:
-            obj_val = p / float(max_pv) * 100
-        else:
-            obj_val = 100
-            ratio = float(max_pv) / p
-            q = q * ratio  # adjust q value to that it matches the kw output
-        command = [
-            Command(obj_name=obj_name, obj_property="%Pmpp", val=str(obj_val)),
-            Command(obj_name=obj_name, obj_property="kvar", val=str(q)),
-            Command(obj_name=obj_name, obj_property="%Cutout", val="0"),
-            Command(obj_name=obj_name, obj_property="%Cutin", val="0"),
-        ]
-        self.change_obj(command)
+    def set_pv_outputs(self, batch):
+        """Sets the P and Q values of many PV systems in OpenDSS.
 
-    def get_max_pv_available(self, pv_system):
-        irradiance = None
-        pmpp = None
+        Parameters
+        ----------
+        batch: list of (name, p, q)
+            name of the PV system with the ``PVSystem.`` prefix, and its
+            active and reactive power set points in kW and kvar.
+
+        The available power of every PV system is read in a single pass and
+        the set points are clipped to it together. Each PV system gets one
+        ``Edit`` command, and none when its settings did not change since
+        they were last applied.
+        """
+        if len(batch) == 0:
+            return
+        available = self._pv_available()
+        table = self._element_table("PVSystem")
+        index = {name.lower(): ii for ii, name in enumerate(table.names)}
+        setpoints = {}
+        for name, p, q in batch:
+            if name.lower() not in index:
+                raise ValueError(f"Irradiance or PMPP not found for {name}")
+            setpoints[name.lower()] = (p, q)
+        names = list(setpoints)
+        p, q = np.array(list(setpoints.values()), dtype=float).reshape(-1, 2).T
+        max_pv = available[[index[name] for name in names]]
+
+        # the available power bounds p, and q is scaled down with it
+        unavailable = (max_pv <= 0) | (p == 0)
+        if np.any(unavailable):
+            Warning("Maximum PV Value is 0")
+        partial = ~unavailable & (p < max_pv)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pct_pmpp = np.where(partial, p / max_pv * 100, 100.0)
+            q = np.where(unavailable, 0.0, np.where(partial, q, q * max_pv / p))
+
+        commands = []
+        for name, value, kvar in zip(names, pct_pmpp.tolist(), q.tolist()):
+            previous = self._pv_setpoints.get(name)
+            if previous == (value, kvar):
+                continue
+            command = f"Edit {name} %Pmpp={value} kvar={kvar}"
+            if previous is None:
+                command += " %Cutout=0 %Cutin=0"
+            commands.append(command)
+            self._pv_setpoints[name] = (value, kvar)
+        for command in commands:
+            dss.Text.Command(command)
+
+    def _pv_available(self):
+        """Available power Pmpp * IrradianceNow of each PV system, in kW."""
+        available = []
         flag = dss.PVsystems.First()
         while flag:
-            if dss.PVsystems.Name() == pv_system:
-                irradiance = dss.PVsystems.IrradianceNow()
-                pmpp = dss.PVsystems.Pmpp()
+            available.append(dss.PVsystems.Pmpp() * dss.PVsystems.IrradianceNow())
             flag = dss.PVsystems.Next()
-        if irradiance is None or pmpp is None:
+        if len(available) != self._element_table("PVSystem").n_elements:
+            del self._elements["PVSystem"]
+        return np.array(available)
+
+    def get_max_pv_available(self, pv_system):
+        available = self._pv_available()
+        index = {
+            name.lower(): ii
+            for ii, name in enumerate(self._element_table("PVSystem").names)
+        }
+        name = f"PVSystem.{pv_system}".lower()
+        if name not in index:
             raise ValueError(f"Irradiance or PMPP not found for {pv_system}")
-        return irradiance * pmpp
+        return available[index[name]]
 
     def get_available_pv(self):
-        pv_names = []
-        powers = []
-        flag = dss.PVsystems.First()
-        while flag:
-            pv_names.append(f"PVSystem.{dss.PVsystems.Name()}")
-            powers.append(dss.PVsystems.Pmpp() * dss.PVsystems.IrradianceNow())
-            flag = dss.PVsystems.Next()
+        powers = self._pv_available()
+        pv_names = self._element_table("PVSystem").names
         return xr.DataArray(powers, coords={"ids": pv_names})
 
     def apply_inverter_control(self, inv_control: InverterControl):
@@ -864,6 +1231,7 @@ class FeederSimulator(object):
         ), f"{self._inverter_to_pvsystems[inverter]} does not match {pvsystem_set} for {inverter}"
 
         self.set_properties_to_inverter(inverter, inv_control)
+        self._needs_snapshot_run = True
         return inverter
 
     def get_incidences(self) -> IncidenceList:
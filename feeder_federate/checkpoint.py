@@ -0,0 +1,234 @@
+"""Checkpoints of compiled OpenDSS models.
+
+Compiling a model spends most of its time parsing the load shape files. A
+checkpoint is a copy of the DSS files of the model in which every load
+shape reads its multipliers from a binary file holding the values OpenDSS
+parsed, together with data FeederSimulator derives from the circuit (node
+names, base voltages, element tables). Checkpoints are kept in a cache
+directory under the hash of the model files, so any change to the model
+gives a new checkpoint.
+
+The element definitions are compiled from the original DSS files, which
+keeps the circuit identical. A restored circuit is still checked against
+the node names and load shapes of the checkpoint, and the original model is
+compiled when they differ.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import re
+import shutil
+
+import numpy as np
+import opendssdirect as dss
+
+logger = logging.getLogger(__name__)
+
+DATA_FILE = "checkpoint.pkl"
+MODEL_DIRECTORY = "model"
+SHAPE_DIRECTORY = "shapes"
+
+# (file=...), (sngfile=...) and (dblfile=...) references to data files
+FILE_REFERENCE = re.compile(r"\((file|sngfile|dblfile)=([^,)\s]+)([^)]*)\)", re.I)
+# data files given as properties, such as csvfile=...
+FILE_PROPERTY = re.compile(r"(?<!\()\b(csvfile|sngfile|dblfile|pqcsvfile)=([^\s)]+)", re.I)
+NEW_LOADSHAPE = re.compile(r"^\s*new\s+(?:object=)?\"?loadshape\.([^\s\"]+)", re.I)
+MULTIPLIER = re.compile(r"\b(p?mult|qmult)=\((?:file|sngfile|dblfile)=[^)]*\)", re.I)
+
+
+def is_dss_file(path):
+    return path.lower().endswith(".dss")
+
+
+def walk_model(root, location):
+    """Walk the directory of a model, leaving out the checkpoint location."""
+    location = os.path.abspath(location)
+    for directory, directories, names in os.walk(root):
+        directories[:] = sorted(
+            name for name in directories
+            if os.path.abspath(os.path.join(directory, name)) != location
+        )
+        yield directory, sorted(names)
+
+
+def model_files(feeder_file, location):
+    """Files of the model of a feeder file.
+
+    These are the files in the directory of the feeder file and the data
+    files its DSS files reference, such as profiles in another directory.
+    """
+    root = os.path.dirname(os.path.abspath(feeder_file))
+    files = []
+    for directory, names in walk_model(root, location):
+        files += [os.path.join(directory, name) for name in names]
+    referenced = set()
+    for path in files:
+        if not is_dss_file(path):
+            continue
+        with open(path, "r", errors="replace") as fp:
+            text = fp.read()
+        for pattern in (FILE_REFERENCE, FILE_PROPERTY):
+            for match in pattern.finditer(text):
+                reference = os.path.normpath(
+                    os.path.join(os.path.dirname(path), match.group(2)))
+                if not reference.startswith(root + os.sep):
+                    referenced.add(reference)
+    return files + sorted(referenced)
+
+
+def model_hash(feeder_file, location):
+    """Hash of the contents of the model files and the OpenDSS version."""
+    root = os.path.dirname(os.path.abspath(feeder_file))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(dss.Basic.Version().encode())
+    digest.update(os.path.basename(feeder_file).encode())
+    for path in model_files(feeder_file, location):
+        digest.update(os.path.relpath(path, root).encode())
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                for block in iter(lambda: fp.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def checkpoint_directory(location, feeder_file):
+    return os.path.join(location, model_hash(feeder_file, location))
+
+
+def shapes_digest():
+    """Hash of the intervals and multipliers of the load shapes in OpenDSS."""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in dss.LoadShape.AllNames():
+        dss.LoadShape.Name(name)
+        digest.update(name.encode())
+        digest.update(np.float64(dss.LoadShape.HrInterval()).tobytes())
+        digest.update(np.array(dss.LoadShape.PMult()).tobytes())
+        digest.update(np.array(dss.LoadShape.QMult()).tobytes())
+    return digest.hexdigest()
+
+
+def write_shapes(directory):
+    """Write the multipliers of the fixed interval load shapes as dbl files.
+
+    Returns the files of each load shape by lower case name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    shape_files = {}
+    for ii, name in enumerate(dss.LoadShape.AllNames()):
+        dss.LoadShape.Name(name)
+        if dss.LoadShape.HrInterval() <= 0:
+            # the hours are read with the multipliers, keep the data file
+            continue
+        files = {}
+        pmult = np.array(dss.LoadShape.PMult(), dtype=np.float64)
+        files["mult"] = os.path.join(directory, f"shape{ii}_p.dbl")
+        pmult.tofile(files["mult"])
+        qmult = np.array(dss.LoadShape.QMult(), dtype=np.float64)
+        if len(qmult) == len(pmult):
+            files["qmult"] = os.path.join(directory, f"shape{ii}_q.dbl")
+            qmult.tofile(files["qmult"])
+        shape_files[name.lower()] = files
+    return shape_files
+
+
+def rewrite_line(line, source_directory, shape_files):
+    """Point the data file references of a DSS line at the checkpoint."""
+    match = NEW_LOADSHAPE.match(line)
+    if match and match.group(1).lower() in shape_files:
+        files = shape_files[match.group(1).lower()]
+
+        def binary(multiplier):
+            kind = "qmult" if multiplier.group(1).lower() == "qmult" else "mult"
+            if kind not in files:
+                return multiplier.group(0)
+            return f"{multiplier.group(1)}=(dblfile={files[kind]})"
+
+        line = MULTIPLIER.sub(binary, line)
+
+    def absolute(reference):
+        path = os.path.join(source_directory, reference.group(2))
+        return f"({reference.group(1)}={os.path.abspath(path)}{reference.group(3)})"
+
+    def absolute_property(reference):
+        path = os.path.join(source_directory, reference.group(2))
+        return f"{reference.group(1)}={os.path.abspath(path)}"
+
+    line = FILE_REFERENCE.sub(absolute, line)
+    return FILE_PROPERTY.sub(absolute_property, line)
+
+
+def save_checkpoint(directory, feeder_file, data):
+    """Save the compiled circuit in OpenDSS and data as a checkpoint.
+
+    The DSS files are copied with rewritten data file references and the
+    other files of the model directory are linked.
+    """
+    temporary = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    shape_files = write_shapes(os.path.join(temporary, SHAPE_DIRECTORY))
+    # the dbl files are referenced at their final location
+    final_directory = os.path.abspath(os.path.join(directory, SHAPE_DIRECTORY))
+    shape_files = {
+        name: {
+            kind: os.path.join(final_directory, os.path.basename(path))
+            for kind, path in files.items()
+        }
+        for name, files in shape_files.items()
+    }
+
+    root = os.path.dirname(os.path.abspath(feeder_file))
+    for source_directory, names in walk_model(root, os.path.dirname(directory)):
+        target_directory = os.path.join(
+            temporary, MODEL_DIRECTORY, os.path.relpath(source_directory, root))
+        os.makedirs(target_directory, exist_ok=True)
+        for name in names:
+            source = os.path.join(source_directory, name)
+            target = os.path.join(target_directory, name)
+            if not is_dss_file(name):
+                os.symlink(source, target)
+                continue
+            with open(source, "r", errors="replace") as fp:
+                lines = fp.readlines()
+            with open(target, "w") as fp:
+                fp.writelines(
+                    rewrite_line(line, source_directory, shape_files)
+                    for line in lines)
+
+    data = {**data, "shapes_digest": shapes_digest()}
+    with open(os.path.join(temporary, DATA_FILE), "wb") as fp:
+        pickle.dump(data, fp)
+    try:
+        os.rename(temporary, directory)
+    except OSError:
+        # saved by another run in the meantime
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+def restore_checkpoint(directory, feeder_file):
+    """Compile the checkpoint of a model into OpenDSS.
+
+    Returns the data saved with the checkpoint, or None when there is no
+    checkpoint or the restored circuit does not match it, in which case
+    OpenDSS is cleared again.
+    """
+    data_file = os.path.join(directory, DATA_FILE)
+    if not os.path.exists(data_file):
+        return None
+    with open(data_file, "rb") as fp:
+        data = pickle.load(fp)
+    master = os.path.join(directory, MODEL_DIRECTORY, os.path.basename(feeder_file))
+    try:
+        dss.Text.Command("redirect " + master)
+        if (
+            dss.Text.Result() == ""
+            and dss.Circuit.YNodeOrder() == data["node_names"]
+            and shapes_digest() == data["shapes_digest"]
+        ):
+            return data
+    except Exception as e:
+        logger.warning(f"Checkpoint {directory} could not be restored: {e}")
+    dss.Text.Command("clear")
+    shutil.rmtree(directory, ignore_errors=True)
+    return None
@@ -0,0 +1,336 @@
+"""Local content-addressed cache of the model files downloaded from buckets.
+
+Every downloaded file is stored once in ``objects/`` under the hash of its
+content. ``manifest.json`` maps the keys of each bucket to their hash and
+size, and each listed prefix to its keys, so a cached model is copied out
+of the cache without contacting the bucket. Copies are checked against the
+hash in the manifest.
+
+Buckets are S3 buckets, or directories standing in for them when a source
+directory is given, with the files of bucket ``name`` in ``<source>/<name>``.
+
+Run this module to fill a cache with the feeders of scenarios::
+
+    python feeder_federate/download_cache.py ~/.cache/oedisi scenario/*/system.json
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.DEBUG)
+
+MANIFEST_FILE = "manifest.json"
+OBJECT_DIRECTORY = "objects"
+
+
+class S3Bucket:
+    """Public S3 bucket, read without credentials."""
+
+    def __init__(self, name):
+        # Equivalent to --no-sign-request
+        s3_resource = boto3.resource(
+            "s3", config=Config(signature_version=UNSIGNED))
+        self.bucket = s3_resource.Bucket(name)
+
+    def list(self, prefix):
+        return [obj.key for obj in self.bucket.objects.filter(Prefix=prefix)]
+
+    def download(self, key, path):
+        self.bucket.download_file(key, path)
+
+
+class DirectoryBucket:
+    """Local directory standing in for a bucket, with keys as paths."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def list(self, prefix):
+        keys = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                key = os.path.relpath(
+                    os.path.join(directory, name), self.root
+                ).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def download(self, key, path):
+        source = os.path.join(self.root, key)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"{key} not in {self.root}")
+        shutil.copyfile(source, path)
+
+
+def open_bucket(name, source=None):
+    """Open bucket name on S3, or in the source directory when given."""
+    if source is not None:
+        return DirectoryBucket(os.path.join(source, name))
+    return S3Bucket(name)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DownloadCache:
+    """Bucket whose files are kept in a local content-addressed cache.
+
+    Has the ``list`` and ``download`` methods of the bucket it caches. In
+    offline mode the bucket is never used and missing entries raise
+    ``FileNotFoundError``.
+    """
+
+    def __init__(self, location, name, bucket=None, offline=False):
+        self.location = os.path.abspath(location)
+        self.name = name
+        self.bucket = bucket
+        self.offline = offline
+        self.changed = False
+        os.makedirs(os.path.join(self.location, OBJECT_DIRECTORY), exist_ok=True)
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        path = os.path.join(self.location, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {"prefixes": {}, "objects": {}}
+        with open(path, "r") as fp:
+            manifest = json.load(fp)
+        return manifest.get(self.name, {"prefixes": {}, "objects": {}})
+
+    def write_manifest(self):
+        """Merge the entries of this bucket into the manifest file.
+
+        The file is read again first, so caches used by other processes at
+        the same time keep their entries.
+        """
+        path = os.path.join(self.location, MANIFEST_FILE)
+        manifest = {}
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                manifest = json.load(fp)
+        entries = manifest.setdefault(self.name, {"prefixes": {}, "objects": {}})
+        entries["prefixes"].update(self.manifest["prefixes"])
+        entries["objects"].update(self.manifest["objects"])
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+        os.replace(temporary, path)
+        self.changed = False
+
+    def close(self):
+        """Write the entries added since the manifest was last written."""
+        if self.changed:
+            self.write_manifest()
+
+    def object_path(self, digest):
+        return os.path.join(self.location, OBJECT_DIRECTORY, digest[:2], digest)
+
+    def source(self, missing):
+        if self.offline or self.bucket is None:
+            raise FileNotFoundError(
+                f"{missing} of bucket {self.name} is not in the cache "
+                f"{self.location} and downloads are disabled"
+            )
+        return self.bucket
+
+    def list(self, prefix):
+        if prefix not in self.manifest["prefixes"]:
+            keys = self.source(f"Listing of {prefix}").list(prefix)
+            self.manifest["prefixes"][prefix] = keys
+            self.changed = True
+        return self.manifest["prefixes"][prefix]
+
+    def download(self, key, path):
+        entry = self.manifest["objects"].get(key)
+        if entry is not None:
+            cached = self.object_path(entry["hash"])
+            if os.path.exists(cached) and os.path.getsize(cached) == entry["size"]:
+                shutil.copyfile(cached, path)
+                if file_hash(path) == entry["hash"]:
+                    return
+                logger.warning(f"Cached {key} does not match its hash")
+                os.remove(cached)
+            del self.manifest["objects"][key]
+            self.changed = True
+
+        bucket = self.source(key)
+        temporary = os.path.join(
+            self.location, OBJECT_DIRECTORY, f"{os.getpid()}.download")
+        bucket.download(key, temporary)
+        digest = file_hash(temporary)
+        cached = self.object_path(digest)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        os.replace(temporary, cached)
+        self.manifest["objects"][key] = {
+            "hash": digest, "size": os.path.getsize(cached)}
+        self.changed = True
+        shutil.copyfile(cached, path)
+
+
+def download_model(
+    bucket,
+    opendss_location,
+    profile_location,
+    sensor_location=None,
+    update_loadshape_location=False,
+):
+    """Download a model into the opendss, profiles and sensors directories.
+
+    With update_loadshape_location, as for SMART-DS feeders, only the
+    profiles used by LoadShapes.dss are downloaded and its references to
+    them are rewritten.
+    """
+    for key in bucket.list(opendss_location):
+        output_location = os.path.join(
+            "opendss", key.replace(opendss_location, "").strip("/")
+        )
+        os.makedirs(os.path.dirname(output_location), exist_ok=True)
+        bucket.download(key, output_location)
+
+    modified_loadshapes = ""
+    os.makedirs(os.path.join("profiles"), exist_ok=True)
+    if update_loadshape_location:
+        all_profiles = set()
+        with open(os.path.join("opendss", "LoadShapes.dss"), "r") as fp_loadshapes:
+            for row in fp_loadshapes.readlines():
+                new_row = row.replace("../", "")
+                new_row = new_row.replace("file=", "file=../")
+                for token in new_row.split(" "):
+                    if token.startswith("(file="):
+                        location = (
+                            token.split(
+                                "=../profiles/")[1].strip().strip(")")
+                        )
+                        all_profiles.add(location)
+                modified_loadshapes = modified_loadshapes + new_row
+        with open(os.path.join("opendss", "LoadShapes.dss"), "w") as fp_loadshapes:
+            fp_loadshapes.write(modified_loadshapes)
+        for profile in all_profiles:
+            s3_location = f"{profile_location}/{profile}"
+            bucket.download(s3_location, os.path.join("profiles", profile))
+
+    else:
+        for key in bucket.list(profile_location):
+            output_location = os.path.join(
+                "profiles", key.replace(profile_location, "").strip("/")
+            )
+            os.makedirs(os.path.dirname(output_location), exist_ok=True)
+            bucket.download(key, output_location)
+
+    if sensor_location is not None:
+        output_location = os.path.join(
+            "sensors", os.path.basename(sensor_location))
+        if not os.path.exists(os.path.dirname(output_location)):
+            os.makedirs(os.path.dirname(output_location))
+        bucket.download(sensor_location, output_location)
+
+
+# component definition of this federate, and the component types used for
+# it when a scenario has no components.json
+FEEDER_DEFINITION = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "component_definition.json")
+FEEDER_TYPES = {"Feeder", "LocalFeeder"}
+
+
+def feeder_types(system_file):
+    """Component types of a scenario that run this federate.
+
+    They are the types whose definition in the components.json next to the
+    system file is the one of this federate. Its paths are relative to the
+    repository root.
+    """
+    components_file = os.path.join(os.path.dirname(system_file), "components.json")
+    if not os.path.exists(components_file):
+        return FEEDER_TYPES
+    with open(components_file, "r") as fp:
+        components = json.load(fp)
+    root = os.path.dirname(os.path.dirname(FEEDER_DEFINITION))
+    return {
+        name for name, definition in components.items()
+        if os.path.exists(os.path.join(root, definition))
+        and os.path.samefile(os.path.join(root, definition), FEEDER_DEFINITION)
+    }
+
+
+def feeder_parameters(system_file):
+    """Parameters of the feeders of a scenario that are downloaded."""
+    with open(system_file, "r") as fp:
+        system = json.load(fp)
+    types = feeder_types(system_file)
+    for component in system["components"]:
+        parameters = component.get("parameters", {})
+        if component.get("type") not in types:
+            continue
+        if parameters.get("existing_feeder_file") is not None:
+            continue
+        if parameters.get("user_uploads_model", False):
+            continue
+        yield parameters
+
+
+def prefetch(location, system_files, source=None):
+    """Fill the cache at location with the feeders of the scenarios."""
+    done = set()
+    for system_file in system_files:
+        try:
+            feeders = list(feeder_parameters(system_file))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Skipping {system_file}, it could not be read: {e}")
+            continue
+        for parameters in feeders:
+            smartds = parameters.get("use_smartds", False)
+            name = "oedi-data-lake" if smartds else "gadal"
+            model = (
+                name,
+                parameters["opendss_location"],
+                parameters["profile_location"],
+                parameters.get("sensor_location"),
+            )
+            if model in done:
+                continue
+            done.add(model)
+            logger.info(f"Prefetching {model[1]} for {system_file}")
+            cache = DownloadCache(location, name, open_bucket(name, source))
+            current_directory = os.getcwd()
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+                try:
+                    download_model(cache, *model[1:], smartds)
+                finally:
+                    cache.close()
+                    os.chdir(current_directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download the feeders of scenarios into a local cache")
+    parser.add_argument("cache", help="cache directory")
+    parser.add_argument(
+        "system_files", nargs="*",
+        help="system.json files of the scenarios, by default scenario/*/system.json",
+    )
+    parser.add_argument(
+        "--source", default=None,
+        help="directory standing in for the buckets, with one subdirectory per bucket",
+    )
+    args = parser.parse_args()
+    system_files = args.system_files or sorted(glob.glob("scenario/*/system.json"))
+    prefetch(args.cache, system_files, args.source)
@@ -30,8 +30,9 @@ def get_loads(dss, circuit):
         if not datum["numPhases"]:
             datum["numPhases"] = 3
             datum["phases"] = ["1", "2", "3"]
-        datum["voltageMag"] = cktElement.VoltagesMagAng()[0]
-        datum["voltageAng"] = cktElement.VoltagesMagAng()[1]
+        voltage = cktElement.VoltagesMagAng()
+        datum["voltageMag"] = voltage[0]
+        datum["voltageAng"] = voltage[1]
         datum["power"] = dss.CktElement.Powers()[:2]
 
         data.append(datum)
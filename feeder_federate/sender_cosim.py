@@ -11,6 +11,7 @@ import numpy as np
 import numpy.typing as npt
 import xarray as xr
 from FeederSimulator import FeederConfig, FeederSimulator
+from payload import PayloadPublication
 from oedisi.types.common import BrokerConfig
 from oedisi.types.data_types import (
     AdmittanceMatrix,
@@ -28,7 +29,7 @@ from oedisi.types.data_types import (
     VoltagesMagnitude,
     VoltagesReal,
 )
-from scipy.sparse import coo_matrix
+from scipy.sparse import spmatrix
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -40,8 +41,9 @@ def numpy_to_y_matrix(array: npt.NDArray[np.complex64]):
     return [[(element.real, element.imag) for element in row] for row in array]
 
 
-def sparse_to_admittance_sparse(array: coo_matrix, unique_ids: List[str]):
-    """Convert coo sparse array to AdmittanceSparse type."""
+def sparse_to_admittance_sparse(array: spmatrix, unique_ids: List[str]):
+    """Convert sparse array to AdmittanceSparse type."""
+    array = array.tocoo()
     return AdmittanceSparse(
         from_equipment=[unique_ids[i] for i in array.row],
         to_equipment=[unique_ids[i] for i in array.col],
@@ -141,6 +143,7 @@ class InitialData:
 
     Y: Any
     topology: Topology
+    Y_conjugate: Any = None
 
 
 def get_initial_data(sim: FeederSimulator, config: FeederConfig):
@@ -191,17 +194,7 @@ def get_initial_data(sim: FeederSimulator, config: FeederConfig):
         slack_bus=slack_ids,
         incidences=incidences,
     )
-    return InitialData(Y=Y, topology=topology)
-
-
-def agg_to_ids(x: xr.core.dataarray.DataArray, ids):
-    """Aggregate xarray to ids. Specialized to equipment node arrays."""
-    target = xr.zeros_like(ids, dtype=np.float64)
-    if x.shape == (0,):
-        return target
-
-    _, x_grouped = xr.align(ids, x.groupby("ids").sum(), join="left", fill_value=0.0)
-    return x_grouped
+    return InitialData(Y=Y, topology=topology, Y_conjugate=Y.conjugate())
 
 
 @dataclass
@@ -213,10 +206,22 @@ class CurrentData:
     calculated_power: xr.core.dataarray.DataArray
     injections: Injection
     load_y_matrix: Any
+    load_y_delta: Any = None
+
+
+def get_current_data(
+    sim: FeederSimulator, Y, load_y_delta=False, validate=True, Y_conjugate=None
+):
+    """Construct current data from simulation after having solved.
 
+    With ``load_y_delta`` the load admittances are calculated without
+    solving again, as ``CurrentData.load_y_delta``, and the load Y-matrix is
+    ``Y`` plus them.
 
-def get_current_data(sim: FeederSimulator, Y):
-    """Construct current data from simulation after having solved."""
+    Without ``validate`` the calculated power is only computed at the source
+    nodes, which the injections need, and is zero elsewhere.
+    ``Y_conjugate`` may be given to avoid conjugating ``Y`` every step.
+    """
     feeder_voltages = sim.get_voltages_actual()
     PQ_load = sim.get_PQs_load(static=False)
     PQ_PV = sim.get_PQs_pv(static=False)
@@ -227,43 +232,80 @@ def get_current_data(sim: FeederSimulator, Y):
     power_real, power_imaginary = get_powers(-PQ_load, -PQ_PV, -PQ_gen, -PQ_cap)
     injections = Injection(power_real=power_real, power_imaginary=power_imaginary)
 
-    ids = xr.DataArray(
-        sim._AllNodeNames,
+    if Y_conjugate is None:
+        Y_conjugate = Y.conjugate()
+    voltages = feeder_voltages.data
+    source = sim._source_indexes
+    if validate:
+        calculated = voltages * (Y_conjugate @ voltages.conjugate()) / 1000
+    else:
+        calculated = np.zeros_like(voltages)
+        calculated[source] = (
+            voltages[source] * (Y_conjugate[source] @ voltages.conjugate()) / 1000
+        )
+    calculated_power = xr.DataArray(
+        calculated, coords={"ids": feeder_voltages.ids.data}
+    )
+
+    node_powers = sim.get_node_powers(PQ_load, PQ_PV, PQ_gen, PQ_cap)
+    node_powers[source] = -calculated[source]
+    PQ_injections_all = xr.DataArray(
+        node_powers,
+        dims=("ids",),
         coords={
             "ids": sim._AllNodeNames,
+            "equipment_ids": (
+                "ids", list(map(lambda x: x.split(".")[0], sim._AllNodeNames))
+            ),
         },
     )
-    PQ_injections_all = (
-        agg_to_ids(PQ_load, ids)
-        + agg_to_ids(PQ_PV, ids)
-        + agg_to_ids(PQ_gen, ids)
-        + agg_to_ids(PQ_cap, ids)
-    )
-
-    PQ_injections_all = PQ_injections_all.assign_coords(
-        equipment_ids=("ids", list(map(lambda x: x.split(".")[0], sim._AllNodeNames)))
-    )
-    calculated_power = (
-        feeder_voltages * (Y.conjugate() @ feeder_voltages.conjugate()) / 1000
-    )
 
-    PQ_injections_all[sim._source_indexes] = -calculated_power[sim._source_indexes]
-
-    Y_load = sim.get_load_y_matrix()
+    if load_y_delta:
+        Y_delta = sim.get_load_y_delta()
+        Y_load = Y + Y_delta
+    else:
+        Y_delta = None
+        Y_load = sim.get_load_y_matrix()
     return CurrentData(
         feeder_voltages=feeder_voltages,
         PQ_injections_all=PQ_injections_all,
         calculated_power=calculated_power,
         injections=injections,
         load_y_matrix=Y_load,
+        load_y_delta=Y_delta,
+    )
+
+
+def check_load_y_delta(sim: FeederSimulator, Y, load_y_delta, tol=1e-6):
+    """Compare the load Y-matrix delta with the Y-matrix OpenDSS solves for.
+
+    Returns the largest error relative to the largest load admittance.
+    """
+    Y_load = sim.get_load_y_matrix()
+    error = abs((Y_load - Y) - load_y_delta).max()
+    scale = abs(load_y_delta).max() if load_y_delta.nnz else 1.0
+    if error > tol * scale:
+        logger.warning(
+            f"Load Y-matrix delta is off by {error} from OpenDSS, "
+            "transformer taps may have moved"
+        )
+    return error / scale
+
+
+def admittance_payload(array: spmatrix, unique_ids: List[str], sparse: bool):
+    """Admittance payload of a sparse matrix, AdmittanceSparse when sparse."""
+    if sparse:
+        return sparse_to_admittance_sparse(array, unique_ids)
+    return AdmittanceMatrix(
+        admittance_matrix=numpy_to_y_matrix(array.toarray()), ids=unique_ids
     )
 
 
 def where_power_unbalanced(PQ_injections_all, calculated_power, tol=1):
     """Find errors where PQ_injectinos does not match calculated power."""
-    errors = PQ_injections_all + calculated_power
+    errors = PQ_injections_all.data + calculated_power.data
     (indices,) = np.where(np.abs(errors) > tol)
-    return errors.ids[indices]
+    return PQ_injections_all.ids[indices]
 
 
 def go_cosim(
@@ -292,32 +334,37 @@ def go_cosim(
     h.helicsFederateInfoSetTimeProperty(fedinfo, h.helics_property_time_delta, deltat)
     vfed = h.helicsCreateValueFederate(config.name, fedinfo)
 
-    pub_voltages_real = h.helicsFederateRegisterPublication(
-        vfed, "voltages_real", h.HELICS_DATA_TYPE_STRING, ""
+    # Values published every step can use the binary encoding of payload.py
+    pub_voltages_real = PayloadPublication(
+        vfed, "voltages_real", config.binary_payloads
     )
-    pub_voltages_imag = h.helicsFederateRegisterPublication(
-        vfed, "voltages_imag", h.HELICS_DATA_TYPE_STRING, ""
+    pub_voltages_imag = PayloadPublication(
+        vfed, "voltages_imag", config.binary_payloads
     )
-    pub_voltages_magnitude = h.helicsFederateRegisterPublication(
-        vfed, "voltages_magnitude", h.HELICS_DATA_TYPE_STRING, ""
+    pub_voltages_magnitude = PayloadPublication(
+        vfed, "voltages_magnitude", config.binary_payloads
     )
-    pub_powers_real = h.helicsFederateRegisterPublication(
-        vfed, "powers_real", h.HELICS_DATA_TYPE_STRING, ""
+    pub_powers_real = PayloadPublication(
+        vfed, "powers_real", config.binary_payloads
     )
-    pub_powers_imag = h.helicsFederateRegisterPublication(
-        vfed, "powers_imag", h.HELICS_DATA_TYPE_STRING, ""
+    pub_powers_imag = PayloadPublication(
+        vfed, "powers_imag", config.binary_payloads
     )
     pub_topology = h.helicsFederateRegisterPublication(
         vfed, "topology", h.HELICS_DATA_TYPE_STRING, ""
     )
-    pub_injections = h.helicsFederateRegisterPublication(
-        vfed, "injections", h.HELICS_DATA_TYPE_STRING, ""
+    pub_injections = PayloadPublication(
+        vfed, "injections", config.binary_payloads
+    )
+    pub_available_power = PayloadPublication(
+        vfed, "available_power", config.binary_payloads
     )
-    pub_available_power = h.helicsFederateRegisterPublication(
-        vfed, "available_power", h.HELICS_DATA_TYPE_STRING, ""
+    pub_load_y_matrix = PayloadPublication(
+        vfed, "load_y_matrix", config.binary_payloads
     )
-    pub_load_y_matrix = h.helicsFederateRegisterPublication(
-        vfed, "load_y_matrix", h.HELICS_DATA_TYPE_STRING, ""
+    # only published with load_y_delta, the load admittances alone
+    pub_load_y_delta = PayloadPublication(
+        vfed, "load_y_delta", config.binary_payloads
     )
     pub_pv_forecast = h.helicsFederateRegisterPublication(
         vfed, "pv_forecast", h.HELICS_DATA_TYPE_STRING, ""
@@ -358,13 +405,16 @@ def go_cosim(
     pub_topology.publish(initial_data.topology.json())
 
     logger.info("Evaluating the forecasted PV")
-    forecast_data = sim.forcast_pv(int(config.number_of_timesteps))
-    PVforecast = [MeasurementArray(**xarray_to_dict(forecast), 
-                    units="kW").json() for forecast in forecast_data]
-    pub_pv_forecast.publish(json.dumps(PVforecast))
+    forecast = sim.forcast_pv(int(config.number_of_timesteps))
+    pub_pv_forecast.publish(json.dumps({
+        "ids": list(forecast.ids.data),
+        "values": forecast.data.tolist(),
+        "units": "kW",
+    }))
 
     granted_time = -1
     request_time = 0
+    load_y_checked = False
 
     while request_time < int(config.number_of_timesteps):
         granted_time = h.helicsFederateRequestTime(vfed, request_time)
@@ -389,26 +439,42 @@ def go_cosim(
         for inv_control in inverter_controls.__root__:
             sim.apply_inverter_control(inv_control)
 
-        pv_sets = sub_pv_set.json
-        for pv_set in pv_sets:
-            sim.set_pv_output(pv_set[0].split(".")[1], pv_set[1], pv_set[2])
+        sim.set_pv_outputs(sub_pv_set.json)
 
         logger.info(
             f"Solve at hour {floored_timestamp.hour} second "
             f"{60*floored_timestamp.minute + floored_timestamp.second}"
         )
 
-        sim.snapshot_run()
+        if sim.needs_snapshot_run():
+            sim.snapshot_run()
         sim.solve(
             floored_timestamp.hour,
             60 * floored_timestamp.minute + floored_timestamp.second,
         )
 
-        current_data = get_current_data(sim, initial_data.Y)
-
-        bad_bus_names = where_power_unbalanced(
-            current_data.PQ_injections_all, current_data.calculated_power
+        validate = (
+            config.validate_every_n_steps > 0
+            and current_index % config.validate_every_n_steps == 0
+        )
+        current_data = get_current_data(
+            sim,
+            initial_data.Y,
+            config.load_y_delta,
+            validate,
+            initial_data.Y_conjugate,
         )
+        if config.load_y_delta and not load_y_checked:
+            # compare once with the matrix OpenDSS solves for
+            check_load_y_delta(sim, initial_data.Y, current_data.load_y_delta)
+            load_y_checked = True
+
+        if validate:
+            bad_bus_names = where_power_unbalanced(
+                current_data.PQ_injections_all, current_data.calculated_power
+            )
+        else:
+            bad_bus_names = []
         if len(bad_bus_names) > 0:
             raise ValueError(
                 f"""
@@ -431,55 +497,55 @@ def go_cosim(
             VoltagesMagnitude(
                 **xarray_to_dict(voltage_magnitudes),
                 time=current_timestamp,
-            ).json()
+            )
         )
         pub_voltages_real.publish(
             VoltagesReal(
                 **xarray_to_dict(current_data.feeder_voltages.real),
                 time=current_timestamp,
-            ).json()
+            )
         )
         pub_voltages_imag.publish(
             VoltagesImaginary(
                 **xarray_to_dict(current_data.feeder_voltages.imag),
                 time=current_timestamp,
-            ).json()
+            )
         )
         pub_powers_real.publish(
             PowersReal(
                 **xarray_to_dict(current_data.PQ_injections_all.real),
                 time=current_timestamp,
-            ).json()
+            )
         )
         pub_powers_imag.publish(
             PowersImaginary(
                 **xarray_to_dict(current_data.PQ_injections_all.imag),
                 time=current_timestamp,
-            ).json()
+            )
         )
-        pub_injections.publish(current_data.injections.json())
+        pub_injections.publish(current_data.injections)
         pub_available_power.publish(
             MeasurementArray(
                 **xarray_to_dict(sim.get_available_pv()),
                 time=current_timestamp,
                 units="kWA",
-            ).json()
+            )
         )
 
-        if config.use_sparse_admittance:
-            pub_load_y_matrix.publish(
-                sparse_to_admittance_sparse(
-                    current_data.load_y_matrix, sim._AllNodeNames
-                ).json()
+        pub_load_y_matrix.publish(
+            admittance_payload(
+                current_data.load_y_matrix,
+                sim._AllNodeNames,
+                config.use_sparse_admittance,
             )
-        else:
-            pub_load_y_matrix.publish(
-                AdmittanceMatrix(
-                    admittance_matrix=numpy_to_y_matrix(
-                        current_data.load_y_matrix.toarray()
-                    ),
-                    ids=sim._AllNodeNames,
-                ).json()
+        )
+        if current_data.load_y_delta is not None:
+            pub_load_y_delta.publish(
+                admittance_payload(
+                    current_data.load_y_delta,
+                    sim._AllNodeNames,
+                    config.use_sparse_admittance,
+                )
             )
 
         logger.info("end time: " + str(datetime.now()))
@@ -0,0 +1,61 @@
+"""Validate the load Y-matrix delta against the matrix OpenDSS solves for.
+
+``FeederSimulator.get_load_y_delta`` calculates the load admittances without
+solving again. Added to the Y-matrix of ``get_y_matrix`` they must give the
+matrix of ``get_load_y_matrix``. Run this module to compare them on a feeder
+at several times of day; it exits with an error when they differ::
+
+    python feeder_federate/validate_load_y.py oedisi-ieee123/qsts/master.dss
+"""
+
+import argparse
+import logging
+import sys
+
+from FeederSimulator import FeederConfig, FeederSimulator
+from sender_cosim import check_load_y_delta
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# (hour, second) of the solves compared, on and between load shape points
+TIMES = [(0, 900), (6, 0), (12, 0), (12, 450), (13, 1350), (23, 2700)]
+
+
+def validate(feeder_file, times=TIMES, tol=1e-6):
+    """Largest error of the load Y-matrix delta relative to the load admittances."""
+    config = FeederConfig(
+        name="validate_load_y",
+        profile_location="",
+        opendss_location="",
+        existing_feeder_file=feeder_file,
+        start_date="2017-01-01 00:00:00",
+        number_of_timesteps=1,
+    )
+    sim = FeederSimulator(config)
+    Y = sim.get_y_matrix()
+    errors = []
+    for hour, second in times:
+        sim.snapshot_run()
+        sim.solve(hour, second)
+        error = check_load_y_delta(sim, Y, sim.get_load_y_delta(), tol)
+        logger.info(f"hour {hour} second {second}: relative error {error:.3g}")
+        errors.append(error)
+    return max(errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the load Y-matrix delta with OpenDSS")
+    parser.add_argument("feeder_file", help="master DSS file of the feeder")
+    parser.add_argument(
+        "--tol", type=float, default=1e-6,
+        help="largest error allowed, relative to the largest load admittance",
+    )
+    args = parser.parse_args()
+    error = validate(args.feeder_file, tol=args.tol)
+    if error > args.tol:
+        logger.error(f"Load Y-matrix delta is off by {error:.3g}")
+        sys.exit(1)
+    logger.info(f"Load Y-matrix delta matches OpenDSS within {error:.3g}")
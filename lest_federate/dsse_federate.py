@@ -1,6 +1,7 @@
 import area
 import pv_detect
 import adapter
+from payload import MissingIds, decode
 import logging
 import helics as h
 import json
@@ -127,19 +128,25 @@ class EstimatorFederate(object):
             slack = topology.slack_bus[0]
             [slack_bus, phase] = slack.split('.')
 
-            voltages_mag = VoltagesMagnitude.parse_obj(
-                self.sub.voltages_mag.json)
+            powers_real: PowersReal
+            powers_imag: PowersImaginary
+            try:
+                voltages_mag = decode(self.sub.voltages_mag, VoltagesMagnitude)
+                # get the available power in real time
+                powers_real = decode(self.sub.powers_real, PowersReal)
+                powers_imag = decode(self.sub.powers_imag, PowersImaginary)
+            except MissingIds as e:
+                logger.warning(f"Skipping time step {granted_time}: {e}")
+                granted_time = h.helicsFederateRequestTime(
+                    self.fed, h.HELICS_TIME_MAXTIME
+                )
+                continue
+
             bus_info = adapter.extract_voltages(bus_info, voltages_mag)
 
             time = voltages_mag.time
             logger.debug(time)
 
-            # get the available power in real time
-            powers_real: PowersReal
-            powers_real = PowersReal.parse_obj(self.sub.powers_real.json)
-
-            powers_imag: PowersImaginary
-            powers_imag = PowersImaginary.parse_obj(self.sub.powers_imag.json)
             bus_info = adapter.extract_powers(
                 bus_info, powers_real, powers_imag)
 
@@ -1,6 +1,7 @@
 import numpy as np
 import math
 import logging
+from incidence import bus_incidence
 from oedisi.types.data_types import (
     VoltagesMagnitude,
     PowersReal,
@@ -121,6 +122,8 @@ def get_hmat(
 
     # sum(Sij) - sum(Sjk) == -sj
 
+    incidence = bus_incidence(branch_info, bus_info, 'kv', PRIMARY_V)
+    branch_keys = list(branch_info)
     for keyb, val_bus in bus_info.items():
         if keyb != source_bus:
             k_frm_3p = []
@@ -131,49 +134,37 @@ def get_hmat(
             k_to_1p = []
 
             # Find bus idx in "from" of branch_sw_data
-            ind_frm = 0
-            ind_to = 0
+            incident = incidence[val_bus['idx']]
             if val_bus['kv'] < PRIMARY_V:
                 # if the bus is a part of a split phase transformer
-                for key, val_br in branch_info.items():
-                    if val_bus['idx'] == val_br['from']:
-                        k_frm_1p.append(ind_frm - nbranch_ABC)
-
-                    if val_bus['idx'] == val_br['to']:
-                        k_to_1p.append(ind_to - nbranch_ABC)
-                    ind_to += 1
-                    ind_frm += 1
+                for ind_frm in incident['from_pri'] + incident['from_sec']:
+                    k_frm_1p.append(ind_frm - nbranch_ABC)
+                for ind_to in incident['to_pri'] + incident['to_sec']:
+                    k_to_1p.append(ind_to - nbranch_ABC)
 
             else:
-                # iterate through all the branches and find all whose 'from' or 'to' bus match the current bus
-                for key, val_br in branch_info.items():
-                    if val_bus['idx'] == val_br['from']:
-                        if bus_info[val_br['to_bus']]['kv'] > PRIMARY_V:
-                            k_frm_3p.append(ind_frm)
-                        else:
-                            if key[-1] == 'a':
-                                k_frm_1pa.append(
-                                    nbranch_ABC * 6 + ind_frm - nbranch_ABC)
-                                k_frm_1qa.append(
-                                    nbranch_ABC * 3 + ind_frm - nbranch_ABC + nbranch_s1s2)
-                            if key[-1] == 'b':
-                                k_frm_1pb.append(
-                                    nbranch_ABC * 5 + ind_frm - nbranch_ABC)
-                                k_frm_1qb.append(
-                                    nbranch_ABC * 2 + ind_frm - nbranch_ABC + nbranch_s1s2)
-                            if key[-1] == 'c':
-                                k_frm_1pc.append(
-                                    nbranch_ABC * 4 + ind_frm - nbranch_ABC)
-                                k_frm_1qc.append(
-                                    nbranch_ABC * 1 + ind_frm - nbranch_ABC + nbranch_s1s2)
-
-                    if val_bus['idx'] == val_br['to']:
-                        if bus_info[val_br['fr_bus']]['kv'] > PRIMARY_V:
-                            k_to_3p.append(ind_to)
-                        else:
-                            k_to_1p.append(ind_to - nbranch_ABC)
-                    ind_to += 1
-                    ind_frm += 1
+                # split the branches leaving the bus by the level of their 'to' bus
+                k_frm_3p = list(incident['from_pri'])
+                for ind_frm in incident['from_sec']:
+                    key = branch_keys[ind_frm]
+                    if key[-1] == 'a':
+                        k_frm_1pa.append(
+                            nbranch_ABC * 6 + ind_frm - nbranch_ABC)
+                        k_frm_1qa.append(
+                            nbranch_ABC * 3 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                    if key[-1] == 'b':
+                        k_frm_1pb.append(
+                            nbranch_ABC * 5 + ind_frm - nbranch_ABC)
+                        k_frm_1qb.append(
+                            nbranch_ABC * 2 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                    if key[-1] == 'c':
+                        k_frm_1pc.append(
+                            nbranch_ABC * 4 + ind_frm - nbranch_ABC)
+                        k_frm_1qc.append(
+                            nbranch_ABC * 1 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                k_to_3p = list(incident['to_pri'])
+                for ind_to in incident['to_sec']:
+                    k_to_1p.append(ind_to - nbranch_ABC)
 
                 loc = 0
                 # Finding the kfrms and ktos for the branches
@@ -140,7 +140,7 @@ def pack_voltages(voltages: dict, time: int) -> VoltagesMagnitude:
 
 def extract_forecast(bus: dict, forecast) -> dict:
     for eq, power in zip(forecast["ids"], forecast["values"]):
-        print(eq)
+        logger.debug(eq)
         if "_" in eq:
             [_, name] = eq.rsplit("_", 1)
         else:
@@ -1,9 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+import multiprocessing
 import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import linprog
 import cvxpy as cp
 import math
 import logging
 import copy
+from incidence import bus_incidence
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -38,6 +43,17 @@ class ControlType(Enum):
     WATT_VAR = 3
 
 
+class Solver(Enum):
+    ECOS = "ECOS"
+    OSQP = "OSQP"
+    CLARABEL = "CLARABEL"
+    HIGHS = "HIGHS"
+
+
+class OPFSolveError(Exception):
+    """Raised when the OPF has no optimal solution, e.g. it is infeasible."""
+
+
 def ignore_phase(control: dict) -> float:
     setpoint = 0
     for key, val in control.items():
@@ -46,6 +62,30 @@ def ignore_phase(control: dict) -> float:
     return setpoint
 
 
+class TripletMatrix:
+    """Sparse constraint matrix assembled from (row, col, value) triplets.
+
+    Entries are written with ``A[row, col] = value`` like a dense array, so the
+    constraint helpers below fill it in place. Writing the same entry twice
+    keeps the last value, matching dense assignment.
+    """
+
+    def __init__(self, n_cols: int) -> None:
+        self.n_cols = n_cols
+        self.entries = {}
+
+    def __setitem__(self, key, value) -> None:
+        self.entries[key] = value
+
+    def tocsr(self, n_rows: int) -> sp.csr_matrix:
+        if not self.entries:
+            return sp.csr_matrix((n_rows, self.n_cols))
+        rows, cols = zip(*self.entries.keys())
+        vals = list(self.entries.values())
+        return sp.coo_matrix(
+            (vals, (rows, cols)), shape=(n_rows, self.n_cols)).tocsr()
+
+
 def power_balance(A, b, k_frm, k_to, counteq, col, val):
     for k in k_frm:
         A[counteq, col + k] = -1
@@ -57,21 +97,26 @@ def power_balance(A, b, k_frm, k_to, counteq, col, val):
     return A, b
 
 
-def voltage_cons_pri(A, b, p, frm, to, counteq, pii, qii, pij, qij, pik, qik, nbus_ABC, nbus_s1s2, nbranch_ABC, baseZ):
+def voltage_cons_pri(A, Z, b, p, frm, to, counteq, pii, qii, pij, qij, pik, qik, nbus_ABC, nbus_s1s2, nbranch_ABC):
+    """Voltage drop row for a primary branch phase.
+
+    The impedance terms go into Z unscaled; the model multiplies them by
+    1/baseZ, which depends on the source bus voltage of the timestep.
+    """
     A[counteq, frm] = 1
     A[counteq, to] = -1
     n_flow_ABC = (nbus_ABC * 3 + nbus_s1s2) + \
         (nbus_ABC * 6 + nbus_s1s2 * 2)
     # real power drop
-    A[counteq, p + n_flow_ABC + + nbranch_ABC * 0] = pii / baseZ
-    A[counteq, p + n_flow_ABC + nbranch_ABC * 1] = pij / baseZ
-    A[counteq, p + n_flow_ABC + nbranch_ABC * 2] = pik / baseZ
+    Z[counteq, p + n_flow_ABC + + nbranch_ABC * 0] = pii
+    Z[counteq, p + n_flow_ABC + nbranch_ABC * 1] = pij
+    Z[counteq, p + n_flow_ABC + nbranch_ABC * 2] = pik
     # reactive power drop
-    A[counteq, p + n_flow_ABC + nbranch_ABC * 3] = qii / baseZ
-    A[counteq, p + n_flow_ABC + nbranch_ABC * 4] = qij / baseZ
-    A[counteq, p + n_flow_ABC + nbranch_ABC * 5] = qik / baseZ
+    Z[counteq, p + n_flow_ABC + nbranch_ABC * 3] = qii
+    Z[counteq, p + n_flow_ABC + nbranch_ABC * 4] = qij
+    Z[counteq, p + n_flow_ABC + nbranch_ABC * 5] = qik
     b[counteq] = 0.0
-    return A, b
+    return A, Z, b
 
 
 def update_base_kv(bus: dict) -> dict:
@@ -81,622 +126,697 @@ def update_base_kv(bus: dict) -> dict:
     return bus
 
 
-def optimal_power_flow(branch_info: dict, bus_info: dict, source_bus: str, control: ControlType, pf_flag: bool):
+class LinDistFlowModel:
+    """LinDistFlow problem built once per topology and re-solved every timestep.
+
+    The constraint matrices only depend on the network, so they are assembled
+    and handed to cvxpy once. The quantities that change between timesteps are
+    cvxpy Parameters:
+
+    - ``load``: right hand side of the bus injection equations
+    - ``pv_limit``: upper limits of the DER control variables
+    - ``source_v``: squared substation voltage per phase
+    - ``inv_base_z``: 1/baseZ scaling of the primary voltage drop terms
+
+    ``update`` refreshes them from a bus_info dict and ``solve`` re-solves the
+    already canonicalized problem.
+
+    ECOS, OSQP and Clarabel solve the problem through cvxpy, warm started from
+    the previous solution where the solver supports it (OSQP). HiGHS is called
+    through scipy ``linprog`` directly on the sparse constraint matrices.
+    """
+
     # System's base definition
     BASE_S = 1 / (1000000 * 100)
     S_CAPACITY = 1.2
     PRIMARY_V = 0.12
-    bus_info = update_base_kv(bus_info)
-
-    slack_v = max([b['base_kv'] for b in bus_info.values()])
-    print("Slack Voltage: ", slack_v)
-    basekV = bus_info[source_bus]['base_kv']
-    baseZ = basekV ** 2 / 100
-    SOURCE_V = [slack_v/basekV]*3
-
-    # Find the ABC phase and s1s2 phase triplex line and bus numbers
-    nbranch_ABC = 0
-    nbus_ABC = 0
-    nbranch_s1s2 = 0
-    nbus_s1s2 = 0
-    mult = 1
-    secondary_model = ['TPX_LINE', 'SPLIT_PHASE']
-    name = []
-    for b_eq in branch_info:
-        if branch_info[b_eq]['type'] in secondary_model:
-            nbranch_s1s2 += 1
-        else:
-            nbranch_ABC += 1
-
-    for b_eq in bus_info:
-        name.append(b_eq)
-        if bus_info[b_eq]['base_kv'] > PRIMARY_V:
-            nbus_ABC += 1
-        else:
-            nbus_s1s2 += 1
-
-    # Number of Optimization Variables
-    voltage_count = (nbus_ABC * 3 + nbus_s1s2) + (nbus_ABC * 6 + nbus_s1s2 * 2)
-    injection_count = (nbranch_ABC * 6 + nbranch_s1s2 * 2)
-    flow_count = (nbus_ABC * 3 + nbus_s1s2)
-    der_count = (nbus_ABC * 3 + nbus_s1s2) + nbus_ABC * 3 + nbus_s1s2
-    variable_number = voltage_count + injection_count + flow_count + der_count
-
-    # Number of equality/inequality constraints (Injection equations (ABC) at each bus)
-    #    #  Check if this is correct number or not:
-    n_bus = nbus_ABC * 3 + nbus_s1s2  # Total Bus Number
-    n_branch = nbranch_ABC * 3 + nbranch_s1s2  # Total Branch Number
-
-    constraint_number = 1000 + variable_number + n_bus + 3 * n_bus + n_branch
-    A_ineq = np.zeros((constraint_number, variable_number))
-    b_ineq = np.zeros(constraint_number)
-
-    x = cp.Variable(variable_number)
-    # Initialize the matrices
-    P = np.zeros((variable_number, variable_number))
-    q_obj_vector = np.zeros(variable_number)
-    A_eq = np.zeros((constraint_number, variable_number))
-    b_eq = np.zeros(constraint_number)
-
-    # Some extra variable definition for clean code:
-    #                      Voltage      PQ_inj     PQ_flow
-    state_variable_number = n_bus + 2 * n_bus + 2 * n_branch
-
-    # Q-dg variable starting number
-    #                               P_dg
-    n_Qdg = state_variable_number + n_bus
-    # s = 0
-
-    # # Deciding the starting index for Control Variable
-    # if P_control==True:
-    #     variable_start_idx = state_variable_number
-    # elif Q_control==True:
-    #     variable_start_idx = n_Qdg
-
-    # Linear Programming Cost Vector:
-    # for k in range(nbus_ABC  + nbus_s1s2):
-
-    if control is ControlType.WATT:
-        for k in range(n_bus):
-            q_obj_vector[state_variable_number + k] = -1  # DER max objective
-    elif control is ControlType.VAR:
-        for k in range(n_bus):
-            q_obj_vector[n_Qdg + k] = 0  # Just Voltage regulation
-            # q_obj_vector[n_Qdg + k] = -1  # Just Voltage regulation
-
-    # # Define BFM constraints for both real and reactive power: Power flow conservaion
-    # Constraint 1: Flow equation
-
-    # sum(Sij) - sum(Sjk) == -sj
-
-    counteq = 0
-    for keyb, val_bus in bus_info.items():
-        if keyb != source_bus:
-            k_frm_3p = []
-            k_to_3p = []
-            k_frm_1p = []
-            k_frm_1pa, k_frm_1pb, k_frm_1pc = [], [], []
-            k_frm_1qa, k_frm_1qb, k_frm_1qc = [], [], []
-            k_to_1p = []
-
-            # Find bus idx in "from" of branch_sw_data
-            ind_frm = 0
-            ind_to = 0
-            if val_bus['base_kv'] < PRIMARY_V:
-                for key, val_br in branch_info.items():
-                    if val_bus['idx'] == val_br['from']:
-                        k_frm_1p.append(ind_frm - nbranch_ABC)
 
-                    if val_bus['idx'] == val_br['to']:
-                        k_to_1p.append(ind_to - nbranch_ABC)
-                    ind_to += 1
-                    ind_frm += 1
-                loc = (nbus_ABC * 3 + nbus_s1s2) + \
-                    (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 6
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_1p, k_to_1p, counteq, loc,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5)
-                counteq += 1
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_1p, k_to_1p, counteq, loc + nbranch_s1s2,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5 + nbus_s1s2)
-                counteq += 1
+    def __init__(self, branch_info: dict, bus_info: dict, source_bus: str, control: ControlType, pf_flag: bool,
+                 solver: Solver = Solver.ECOS):
+        self.branch_info = branch_info
+        self.bus_info = bus_info
+        self.source_bus = source_bus
+        self.control = control
+        self.pf_flag = pf_flag
+        self.solver = solver
+        self.build(update_base_kv(bus_info))
+
+    def build(self, bus_info: dict) -> None:
+        branch_info = self.branch_info
+        source_bus = self.source_bus
+        control = self.control
+        PRIMARY_V = self.PRIMARY_V
+
+        # Find the ABC phase and s1s2 phase triplex line and bus numbers
+        nbranch_ABC = 0
+        nbus_ABC = 0
+        nbranch_s1s2 = 0
+        nbus_s1s2 = 0
+        secondary_model = ['TPX_LINE', 'SPLIT_PHASE']
+        for b_eq in branch_info:
+            if branch_info[b_eq]['type'] in secondary_model:
+                nbranch_s1s2 += 1
             else:
-                for key, val_br in branch_info.items():
-                    if val_bus['idx'] == val_br['from']:
-                        if bus_info[val_br['to_bus']]['base_kv'] > PRIMARY_V:
-                            k_frm_3p.append(ind_frm)
-                        else:
-                            if key[-1] == 'a':
-                                k_frm_1pa.append(
-                                    nbranch_ABC * 6 + ind_frm - nbranch_ABC)
-                                k_frm_1qa.append(
-                                    nbranch_ABC * 3 + ind_frm - nbranch_ABC + nbranch_s1s2)
-                            if key[-1] == 'b':
-                                k_frm_1pb.append(
-                                    nbranch_ABC * 5 + ind_frm - nbranch_ABC)
-                                k_frm_1qb.append(
-                                    nbranch_ABC * 2 + ind_frm - nbranch_ABC + nbranch_s1s2)
-                            if key[-1] == 'c':
-                                k_frm_1pc.append(
-                                    nbranch_ABC * 4 + ind_frm - nbranch_ABC)
-                                k_frm_1qc.append(
-                                    nbranch_ABC * 1 + ind_frm - nbranch_ABC + nbranch_s1s2)
-
-                    if val_bus['idx'] == val_br['to']:
-                        if bus_info[val_br['fr_bus']]['base_kv'] > PRIMARY_V:
-                            k_to_3p.append(ind_to)
-                        else:
-                            k_to_1p.append(ind_to - nbranch_ABC)
-                    ind_to += 1
-                    ind_frm += 1
-                loc = (nbus_ABC * 3 + nbus_s1s2) + \
-                    (nbus_ABC * 6 + nbus_s1s2 * 2)
-                # Finding the kfrms
-                k_frm_A = k_frm_3p + k_frm_1pa
-                k_frm_B = k_frm_3p + k_frm_1pb
-                k_frm_C = k_frm_3p + k_frm_1pc
-                k_to_A = k_to_B = k_to_C = k_to_3p
-
-                # Real Power balance equations
-                # # Phase A
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_A, k_to_A, counteq, loc,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 0)
-                counteq += 1
-                # # # Phase B
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_B, k_to_B, counteq, loc + nbranch_ABC,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 1)
-                counteq += 1
-                # # # Phase C
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_C, k_to_C, counteq, loc + nbranch_ABC * 2,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 2)
-                counteq += 1
-                k_frm_A = k_frm_3p + k_frm_1qa
-                k_frm_B = k_frm_3p + k_frm_1qb
-                k_frm_C = k_frm_3p + k_frm_1qc
-
-                # Reactive Power balance equations
-                loc = (nbus_ABC * 3 + nbus_s1s2) + \
-                    (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 3
-                # Phase A
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_A, k_to_A, counteq, loc,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 3)
-                counteq += 1
-                # Phase B
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_B, k_to_B, counteq, loc + nbranch_ABC,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 4)
-                counteq += 1
-                # Phase C
-                A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_C, k_to_C, counteq, loc + nbranch_ABC * 2,
-                                           val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5)
-                counteq += 1
-
-    # Constraint 2: Voltage drop equation:
-    # Vj = Vi - Zij Sij* - Sij Zij*
-
-    # For Primary Nodes:
-    idx = 0
-    v_lim = []
-    for k, val_br in branch_info.items():
-        # Not writing voltage constraints for transformers
-        if val_br['type'] not in secondary_model:
-            z = np.asarray(val_br['zprim'])
-            v_lim.append(val_br['from'])
-            v_lim.append(val_br['to'])
-            # Writing three phase voltage constraints
-            # Phase A
-            paa, qaa = -2 * z[0, 0][0], -2 * z[0, 0][1]
-            pab, qab = -(- z[0, 1][0] + math.sqrt(3) * z[0, 1][1]), -(
-                - z[0, 1][1] - math.sqrt(3) * z[0, 1][0])
-            pac, qac = -(- z[0, 2][0] - math.sqrt(3) * z[0, 2][1]), -(
-                - z[0, 2][1] + math.sqrt(3) * z[0, 2][0])
-            A_eq, b_eq = voltage_cons_pri(A_eq, b_eq, idx, val_br['from'], val_br['to'], counteq, paa, qaa, pab, qab,
-                                          pac, qac, nbus_ABC, nbus_s1s2, nbranch_ABC, baseZ)
+                nbranch_ABC += 1
 
-            counteq += 1
-            # Phase B
-            pbb, qbb = -2 * z[1, 1][0], -2 * z[1, 1][1]
-            pba, qba = -(- z[0, 1][0] - math.sqrt(3) * z[0, 1][1]), -(
-                - z[0, 1][1] + math.sqrt(3) * z[0, 1][0])
-            pbc, qbc = -(- z[1, 2][0] + math.sqrt(3) * z[1, 2][1]), -(
-                - z[1, 2][1] - math.sqrt(3) * z[1, 2][0])
-            A_eq, b_eq = voltage_cons_pri(A_eq, b_eq, idx, nbus_ABC + val_br['from'], nbus_ABC + val_br['to'], counteq,
-                                          pba,
-                                          qba,
-                                          pbb, qbb, pbc, qbc, nbus_ABC, nbus_s1s2, nbranch_ABC, baseZ)
-            counteq += 1
-            # Phase C
-            pcc, qcc = -2 * z[2, 2][0], -2 * z[2, 2][1]
-            pca, qca = -(- z[0, 2][0] + math.sqrt(3) * z[0, 2][1]), -(
-                - z[0, 2][1] - math.sqrt(3) * z[0, 2][0])
-            pcb, qcb = -(- z[1, 2][0] - math.sqrt(3) * z[1, 2][1]), -(
-                - z[0, 2][1] + math.sqrt(3) * z[1, 2][0])
-            A_eq, b_eq = voltage_cons_pri(A_eq, b_eq, idx, nbus_ABC * 2 + val_br['from'], nbus_ABC * 2 + val_br['to'],
-                                          counteq,
-                                          pca, qca, pcb, qcb, pcc, qcc, nbus_ABC, nbus_s1s2, nbranch_ABC, baseZ)
-            counteq += 1
-        idx += 1
-
-    # For secondary Nodes:
-    def voltage_cons_sec(A, b, p, frm, to, counteq, p_pri, q_pri, p_sec, q_sec):
-        A[counteq, frm] = 1
-        A[counteq, to] = -1
-        n_flow_s1s2 = (nbus_ABC * 3 + nbus_s1s2) + \
-            (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 6
-        # real power drop
-        A[counteq, p + n_flow_s1s2] = p_pri + 0.5 * p_sec
-        # reactive power drop
-        A[counteq, p + n_flow_s1s2 + nbranch_s1s2] = q_pri + 0.5 * q_sec
-        b[counteq] = 0.0
-        return A, b
-
-    idx = 0
-    pq_index = []
-    for k, val_br in branch_info.items():
-        # For split phase transformer, we use interlace design
-        if val_br['type'] in secondary_model:
-            if val_br['type'] == 'SPLIT_PHASE':
-                pq_index.append(val_br['idx'])
-                zp = np.asarray(val_br['impedance'])
-                zs = np.asarray(val_br['impedance1'])
-                v_lim.append(val_br['from'])
-                v_lim.append(val_br['to'])
-                # Writing voltage constraints
-                # Phase S1
-                p_pri, q_pri = -2 * zp[0], -2 * zp[1]
-                p_sec, q_sec = -2 * zs[0], -2 * zs[1]
-                phase = k[-1]
-                if phase == 'a':
-                    from_bus = val_br['from']
-                if phase == 'b':
-                    from_bus = val_br['from'] + nbus_ABC
-                if phase == 'c':
-                    from_bus = val_br['from'] + nbus_ABC * 2
-                to_bus = val_br['to'] - nbus_ABC + nbus_ABC * 3
-                # A, b = voltage_cons(A, b, idx - nbus_ABC, from_bus, to_bus, counteq, p_pri, q_pri, p_sec, q_sec)
-                A_eq, b_eq = voltage_cons_sec(A_eq, b_eq, idx - nbranch_ABC, from_bus, to_bus, counteq, p_pri,
-                                              q_pri, p_sec, q_sec, nbus_ABC, nbus_s1s2, nbranch_ABC, baseZ)  # Monish
-                counteq += 1
-
-            # For triplex line, we assume there is no mutual coupling
-            if val_br['type'] != 'SPLIT_PHASE':
-                # The impedance of line will be converted into pu here.
-                zbase = 120.0 * 120.0 / 15000
-                zp = np.asarray(val_br['impedance'])
-                v_lim.append(val_br['from'])
-                v_lim.append(val_br['to'])
-                # Writing voltage constraints
-                # Phase S1
-                p_s1, q_s1 = 0, 0
-                p_s2, q_s2 = -2 * zp[0, 0][0] / zbase, -2 * zp[0, 0][1] / zbase
-                from_bus = val_br['from'] - nbus_ABC + nbus_ABC * 3
-                to_bus = val_br['to'] - nbus_ABC + nbus_ABC * 3
-                # A, b = voltage_cons(A, b, idx - nbus_ABC, from_bus, to_bus, counteq, p_s1, q_s1, p_s2, q_s2)
-                A_eq, b_eq = voltage_cons_sec(A_eq, b_eq, idx - nbranch_ABC, from_bus, to_bus, counteq, p_s1, q_s1,
-                                              p_s2, q_s2, nbus_ABC, nbus_s1s2, nbranch_ABC, baseZ)  # Monish
-                counteq += 1
-        idx += 1
-
-    # Constraint 3: Substation voltage definition
-    # V_substation = V_source
-    source_bus_idx = bus_info[source_bus]['idx']
-    A_eq[counteq, source_bus_idx] = 1
-    b_eq[counteq] = (SOURCE_V[0]) ** 2
-    counteq += 1
-    A_eq[counteq, source_bus_idx + nbus_ABC] = 1
-    b_eq[counteq] = (SOURCE_V[1]) ** 2
-    counteq += 1
-    A_eq[counteq, source_bus_idx + nbus_ABC * 2] = 1
-    b_eq[counteq] = (SOURCE_V[2]) ** 2
-    counteq += 1
-
-    # BFM Power Flow Model ends. Next we define the Control variables:
-
-    # # Make injection a decision variable
-
-    # print("Start: Injection Constraints")
-
-    # P_dg control:
-    if control is ControlType.WATT:
-        DG_up_lim = np.zeros((n_bus, 1))
+        for b_eq in bus_info:
+            if bus_info[b_eq]['base_kv'] > PRIMARY_V:
+                nbus_ABC += 1
+            else:
+                nbus_s1s2 += 1
+
+        # Number of Optimization Variables
+        voltage_count = (nbus_ABC * 3 + nbus_s1s2) + \
+            (nbus_ABC * 6 + nbus_s1s2 * 2)
+        injection_count = (nbranch_ABC * 6 + nbranch_s1s2 * 2)
+        flow_count = (nbus_ABC * 3 + nbus_s1s2)
+        der_count = (nbus_ABC * 3 + nbus_s1s2) + nbus_ABC * 3 + nbus_s1s2
+        variable_number = voltage_count + injection_count + flow_count + der_count
+
+        # Number of equality/inequality constraints (Injection equations (ABC) at each bus)
+        #    #  Check if this is correct number or not:
+        n_bus = nbus_ABC * 3 + nbus_s1s2  # Total Bus Number
+        n_branch = nbranch_ABC * 3 + nbranch_s1s2  # Total Branch Number
+
+        constraint_number = 1000 + variable_number + n_bus + 3 * n_bus + n_branch
+        A_ineq = TripletMatrix(variable_number)
+        b_ineq = np.zeros(constraint_number)
+
+        x = cp.Variable(variable_number)
+        # Initialize the matrices
+        q_obj_vector = np.zeros(variable_number)
+        A_eq = TripletMatrix(variable_number)
+        Z_eq = TripletMatrix(variable_number)
+        b_eq = np.zeros(constraint_number)
+
+        # Rows whose right hand side is a parameter
+        load_rows = []
+        injection_buses = []
+        source_rows = []
+        pv_limit_rows = []
+        pv_limit_cols = []
+
+        # Some extra variable definition for clean code:
+        #                      Voltage      PQ_inj     PQ_flow
+        state_variable_number = n_bus + 2 * n_bus + 2 * n_branch
+
+        # Q-dg variable starting number
+        #                               P_dg
+        n_Qdg = state_variable_number + n_bus
+
+        # Linear Programming Cost Vector:
+        if control is ControlType.WATT:
+            for k in range(n_bus):
+                q_obj_vector[state_variable_number + k] = -1  # DER max objective
+        elif control is ControlType.VAR:
+            for k in range(n_bus):
+                q_obj_vector[n_Qdg + k] = 0  # Just Voltage regulation
+
+        # # Define BFM constraints for both real and reactive power: Power flow conservaion
+        # Constraint 1: Flow equation
+
+        # sum(Sij) - sum(Sjk) == -sj
+
+        incidence = bus_incidence(branch_info, bus_info, 'base_kv', PRIMARY_V)
+        branch_keys = list(branch_info)
+        counteq = 0
         for keyb, val_bus in bus_info.items():
             if keyb != source_bus:
-                # Real power injection at a bus
-                if val_bus['base_kv'] > PRIMARY_V:
-                    # p_inj  + p_gen(control var) =  p_load
-                    # Phase A Real Power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 0 + val_bus['idx']] = 1
-                    A_eq[counteq, state_variable_number +
-                         nbus_ABC * 0 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][0][0] * BASE_S * mult
+                k_frm_3p = []
+                k_to_3p = []
+                k_frm_1p = []
+                k_frm_1pa, k_frm_1pb, k_frm_1pc = [], [], []
+                k_frm_1qa, k_frm_1qb, k_frm_1qc = [], [], []
+                k_to_1p = []
+
+                # Find bus idx in "from" of branch_sw_data
+                incident = incidence[val_bus['idx']]
+                if val_bus['base_kv'] < PRIMARY_V:
+                    for ind_frm in incident['from_pri'] + incident['from_sec']:
+                        k_frm_1p.append(ind_frm - nbranch_ABC)
+                    for ind_to in incident['to_pri'] + incident['to_sec']:
+                        k_to_1p.append(ind_to - nbranch_ABC)
+                    loc = (nbus_ABC * 3 + nbus_s1s2) + \
+                        (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 6
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_1p, k_to_1p, counteq, loc,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5)
                     counteq += 1
-                    # Phase B Real Power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 1 + val_bus['idx']] = 1
-                    A_eq[counteq, state_variable_number +
-                         nbus_ABC * 1 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][1][0] * BASE_S * mult
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_1p, k_to_1p, counteq, loc + nbranch_s1s2,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5 + nbus_s1s2)
                     counteq += 1
-                    # Phase C Real Power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 2 + val_bus['idx']] = 1
-                    A_eq[counteq, state_variable_number +
-                         nbus_ABC * 2 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][2][0] * BASE_S * mult
+                else:
+                    k_frm_3p = list(incident['from_pri'])
+                    for ind_frm in incident['from_sec']:
+                        key = branch_keys[ind_frm]
+                        if key[-1] == 'a':
+                            k_frm_1pa.append(
+                                nbranch_ABC * 6 + ind_frm - nbranch_ABC)
+                            k_frm_1qa.append(
+                                nbranch_ABC * 3 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                        if key[-1] == 'b':
+                            k_frm_1pb.append(
+                                nbranch_ABC * 5 + ind_frm - nbranch_ABC)
+                            k_frm_1qb.append(
+                                nbranch_ABC * 2 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                        if key[-1] == 'c':
+                            k_frm_1pc.append(
+                                nbranch_ABC * 4 + ind_frm - nbranch_ABC)
+                            k_frm_1qc.append(
+                                nbranch_ABC * 1 + ind_frm - nbranch_ABC + nbranch_s1s2)
+                    k_to_3p = list(incident['to_pri'])
+                    for ind_to in incident['to_sec']:
+                        k_to_1p.append(ind_to - nbranch_ABC)
+                    loc = (nbus_ABC * 3 + nbus_s1s2) + \
+                        (nbus_ABC * 6 + nbus_s1s2 * 2)
+                    # Finding the kfrms
+                    k_frm_A = k_frm_3p + k_frm_1pa
+                    k_frm_B = k_frm_3p + k_frm_1pb
+                    k_frm_C = k_frm_3p + k_frm_1pc
+                    k_to_A = k_to_B = k_to_C = k_to_3p
+
+                    # Real Power balance equations
+                    # # Phase A
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_A, k_to_A, counteq, loc,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 0)
                     counteq += 1
-
-                    # DG upper limit set up:
-                    DG_up_lim[nbus_ABC * 0 + val_bus['idx']
-                              ] = val_bus['pv'][0][0] * BASE_S
-                    DG_up_lim[nbus_ABC * 1 + val_bus['idx']
-                              ] = val_bus['pv'][1][0] * BASE_S
-                    DG_up_lim[nbus_ABC * 2 + val_bus['idx']
-                              ] = val_bus['pv'][2][0] * BASE_S
-
-                    # Phase A Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 3 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][0][1] * BASE_S * mult
+                    # # # Phase B
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_B, k_to_B, counteq, loc + nbranch_ABC,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 1)
                     counteq += 1
-                    # Phase B Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 4 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][1][1] * BASE_S * mult
+                    # # # Phase C
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_C, k_to_C, counteq, loc + nbranch_ABC * 2,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 2)
                     counteq += 1
-                    # Phase C Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 5 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][2][1] * BASE_S * mult
+                    k_frm_A = k_frm_3p + k_frm_1qa
+                    k_frm_B = k_frm_3p + k_frm_1qb
+                    k_frm_C = k_frm_3p + k_frm_1qc
+
+                    # Reactive Power balance equations
+                    loc = (nbus_ABC * 3 + nbus_s1s2) + \
+                        (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 3
+                    # Phase A
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_A, k_to_A, counteq, loc,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 3)
                     counteq += 1
-
-                # work on this for the secondary netowrks:
-                else:
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 5 + val_bus['idx']] = 1
-                    A_eq[counteq, state_variable_number + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][0] * BASE_S * mult
+                    # Phase B
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_B, k_to_B, counteq, loc + nbranch_ABC,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 4)
                     counteq += 1
-                    # Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 5 + nbus_s1s2 + val_bus['idx']] = 1
-                    A_eq[counteq, n_Qdg + nbus_ABC * 2 + val_bus['idx']] = -1
-                    b_eq[counteq] = val_bus['pq'][1] * BASE_S
+                    # Phase C
+                    A_eq, b_eq = power_balance(A_eq, b_eq, k_frm_C, k_to_C, counteq, loc + nbranch_ABC * 2,
+                                               val_bus['idx'] + nbus_ABC * 3 + nbus_s1s2 + nbus_ABC * 5)
                     counteq += 1
 
-                    DG_up_lim[nbus_ABC * 3 + val_bus['idx']
-                              ] = val_bus['pv'][0] * BASE_S
+        # Constraint 2: Voltage drop equation:
+        # Vj = Vi - Zij Sij* - Sij Zij*
 
-    elif control is ControlType.VAR:
-        DG_up_lim = np.zeros((n_bus, 1))
-        for keyb, val_bus in bus_info.items():
-            if keyb != source_bus:
-                # Real power injection at a bus
-                if val_bus['base_kv'] > PRIMARY_V:
-                    # p_inj   =  - p_d_gen + p_load
-                    # Phase A Real Power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 0 + val_bus['idx']] = 1
-                    b_eq[counteq] = - val_bus['pv'][0][0] * \
-                        BASE_S + val_bus['pq'][0][0] * BASE_S * mult
-                    counteq += 1
-                    # Phase B Real Power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 1 + val_bus['idx']] = 1
-                    b_eq[counteq] = - val_bus['pv'][1][0] * \
-                        BASE_S + val_bus['pq'][1][0] * BASE_S * mult
-                    counteq += 1
-                    # Phase C Real Power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 2 + val_bus['idx']] = 1
-                    b_eq[counteq] = - val_bus['pv'][2][0] * \
-                        BASE_S + val_bus['pq'][2][0] * BASE_S * mult
-                    counteq += 1
+        # For Primary Nodes:
+        idx = 0
+        v_lim = []
+        for k, val_br in branch_info.items():
+            # Not writing voltage constraints for transformers
+            if val_br['type'] not in secondary_model:
+                z = np.asarray(val_br['zprim'])
+                v_lim.append(val_br['from'])
+                v_lim.append(val_br['to'])
+                # Writing three phase voltage constraints
+                # Phase A
+                paa, qaa = -2 * z[0, 0][0], -2 * z[0, 0][1]
+                pab, qab = -(- z[0, 1][0] + math.sqrt(3) * z[0, 1][1]), -(
+                    - z[0, 1][1] - math.sqrt(3) * z[0, 1][0])
+                pac, qac = -(- z[0, 2][0] - math.sqrt(3) * z[0, 2][1]), -(
+                    - z[0, 2][1] + math.sqrt(3) * z[0, 2][0])
+                A_eq, Z_eq, b_eq = voltage_cons_pri(A_eq, Z_eq, b_eq, idx, val_br['from'], val_br['to'], counteq,
+                                                    paa, qaa, pab, qab, pac, qac, nbus_ABC, nbus_s1s2, nbranch_ABC)
 
-                    # Q_inj  + Q_gen(control var) =  Q_load
-                    # Phase A Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 3 + val_bus['idx']] = 1
-                    A_eq[counteq, n_Qdg + nbus_ABC * 0 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][0][1] * BASE_S * mult
-                    counteq += 1
-                    # Phase B Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 4 + val_bus['idx']] = 1
-                    A_eq[counteq, n_Qdg + nbus_ABC * 1 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][1][1] * BASE_S * mult
+                counteq += 1
+                # Phase B
+                pbb, qbb = -2 * z[1, 1][0], -2 * z[1, 1][1]
+                pba, qba = -(- z[0, 1][0] - math.sqrt(3) * z[0, 1][1]), -(
+                    - z[0, 1][1] + math.sqrt(3) * z[0, 1][0])
+                pbc, qbc = -(- z[1, 2][0] + math.sqrt(3) * z[1, 2][1]), -(
+                    - z[1, 2][1] - math.sqrt(3) * z[1, 2][0])
+                A_eq, Z_eq, b_eq = voltage_cons_pri(A_eq, Z_eq, b_eq, idx, nbus_ABC + val_br['from'],
+                                                    nbus_ABC + val_br['to'], counteq,
+                                                    pba, qba, pbb, qbb, pbc, qbc, nbus_ABC, nbus_s1s2, nbranch_ABC)
+                counteq += 1
+                # Phase C
+                pcc, qcc = -2 * z[2, 2][0], -2 * z[2, 2][1]
+                pca, qca = -(- z[0, 2][0] + math.sqrt(3) * z[0, 2][1]), -(
+                    - z[0, 2][1] - math.sqrt(3) * z[0, 2][0])
+                pcb, qcb = -(- z[1, 2][0] - math.sqrt(3) * z[1, 2][1]), -(
+                    - z[0, 2][1] + math.sqrt(3) * z[1, 2][0])
+                A_eq, Z_eq, b_eq = voltage_cons_pri(A_eq, Z_eq, b_eq, idx, nbus_ABC * 2 + val_br['from'],
+                                                    nbus_ABC * 2 + val_br['to'], counteq,
+                                                    pca, qca, pcb, qcb, pcc, qcc, nbus_ABC, nbus_s1s2, nbranch_ABC)
+                counteq += 1
+            idx += 1
+
+        # For secondary Nodes:
+        def voltage_cons_sec(A, b, p, frm, to, counteq, p_pri, q_pri, p_sec, q_sec):
+            A[counteq, frm] = 1
+            A[counteq, to] = -1
+            n_flow_s1s2 = (nbus_ABC * 3 + nbus_s1s2) + \
+                (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 6
+            # real power drop
+            A[counteq, p + n_flow_s1s2] = p_pri + 0.5 * p_sec
+            # reactive power drop
+            A[counteq, p + n_flow_s1s2 + nbranch_s1s2] = q_pri + 0.5 * q_sec
+            b[counteq] = 0.0
+            return A, b
+
+        idx = 0
+        for k, val_br in branch_info.items():
+            # For split phase transformer, we use interlace design
+            if val_br['type'] in secondary_model:
+                if val_br['type'] == 'SPLIT_PHASE':
+                    zp = np.asarray(val_br['impedance'])
+                    zs = np.asarray(val_br['impedance1'])
+                    v_lim.append(val_br['from'])
+                    v_lim.append(val_br['to'])
+                    # Writing voltage constraints
+                    # Phase S1
+                    p_pri, q_pri = -2 * zp[0], -2 * zp[1]
+                    p_sec, q_sec = -2 * zs[0], -2 * zs[1]
+                    phase = k[-1]
+                    if phase == 'a':
+                        from_bus = val_br['from']
+                    if phase == 'b':
+                        from_bus = val_br['from'] + nbus_ABC
+                    if phase == 'c':
+                        from_bus = val_br['from'] + nbus_ABC * 2
+                    to_bus = val_br['to'] - nbus_ABC + nbus_ABC * 3
+                    A_eq, b_eq = voltage_cons_sec(A_eq, b_eq, idx - nbranch_ABC, from_bus, to_bus, counteq,
+                                                  p_pri, q_pri, p_sec, q_sec)
                     counteq += 1
-                    # Phase C Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 5 + val_bus['idx']] = 1
-                    A_eq[counteq, n_Qdg + nbus_ABC * 2 + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][2][1] * BASE_S * mult
+
+                # For triplex line, we assume there is no mutual coupling
+                if val_br['type'] != 'SPLIT_PHASE':
+                    # The impedance of line will be converted into pu here.
+                    zbase = 120.0 * 120.0 / 15000
+                    zp = np.asarray(val_br['impedance'])
+                    v_lim.append(val_br['from'])
+                    v_lim.append(val_br['to'])
+                    # Writing voltage constraints
+                    # Phase S1
+                    p_s1, q_s1 = 0, 0
+                    p_s2, q_s2 = -2 * zp[0, 0][0] / zbase, -2 * zp[0, 0][1] / zbase
+                    from_bus = val_br['from'] - nbus_ABC + nbus_ABC * 3
+                    to_bus = val_br['to'] - nbus_ABC + nbus_ABC * 3
+                    A_eq, b_eq = voltage_cons_sec(A_eq, b_eq, idx - nbranch_ABC, from_bus, to_bus, counteq,
+                                                  p_s1, q_s1, p_s2, q_s2)
                     counteq += 1
+            idx += 1
+
+        # Constraint 3: Substation voltage definition
+        # V_substation = V_source
+        source_bus_idx = bus_info[source_bus]['idx']
+        for phase in range(3):
+            A_eq[counteq, source_bus_idx + nbus_ABC * phase] = 1
+            source_rows.append(counteq)
+            counteq += 1
 
-                    # DG upper limit set up:
-                    DG_up_lim[nbus_ABC * 0 + val_bus['idx']] = np.sqrt(
-                        ((S_CAPACITY * val_bus['pv'][0][0] * BASE_S) ** 2) - ((val_bus['pv'][0][0] * BASE_S) ** 2))
-                    DG_up_lim[nbus_ABC * 1 + val_bus['idx']] = np.sqrt(
-                        ((S_CAPACITY * val_bus['pv'][1][0] * BASE_S) ** 2) - ((val_bus['pv'][1][0] * BASE_S) ** 2))
-                    DG_up_lim[nbus_ABC * 2 + val_bus['idx']] = np.sqrt(
-                        ((S_CAPACITY * val_bus['pv'][2][0] * BASE_S) ** 2) - ((val_bus['pv'][2][0] * BASE_S) ** 2))
+        # BFM Power Flow Model ends. Next we define the Control variables:
+
+        # # Make injection a decision variable
+
+        # p_inj  + p_gen(control var) =  p_load   (WATT)
+        # p_inj   =  - p_d_gen + p_load           (VAR)
+        # Q_inj  + Q_gen(control var) =  Q_load
+        # The loads and DER limits are filled in by update()
+        if control in (ControlType.WATT, ControlType.VAR):
+            for keyb, val_bus in bus_info.items():
+                if keyb != source_bus:
+                    injection_buses.append((keyb, val_bus['base_kv'] > PRIMARY_V))
+                    # Real power injection at a bus
+                    if val_bus['base_kv'] > PRIMARY_V:
+                        for phase in range(3):
+                            A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
+                                 nbus_ABC * phase + val_bus['idx']] = 1
+                            if control is ControlType.WATT:
+                                A_eq[counteq, state_variable_number +
+                                     nbus_ABC * phase + val_bus['idx']] = 1
+                            load_rows.append(counteq)
+                            counteq += 1
+
+                        for phase in range(3):
+                            A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
+                                 nbus_ABC * (phase + 3) + val_bus['idx']] = 1
+                            if control is ControlType.VAR:
+                                A_eq[counteq, n_Qdg + nbus_ABC *
+                                     phase + val_bus['idx']] = 1
+                            load_rows.append(counteq)
+                            counteq += 1
+
+                    # work on this for the secondary netowrks:
+                    else:
+                        A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
+                             nbus_ABC * 5 + val_bus['idx']] = 1
+                        A_eq[counteq, state_variable_number + val_bus['idx']] = 1
+                        load_rows.append(counteq)
+                        counteq += 1
+                        # Reactive power
+                        A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
+                             nbus_ABC * 5 + nbus_s1s2 + val_bus['idx']] = 1
+                        A_eq[counteq, n_Qdg + nbus_ABC * 2 + val_bus['idx']] = -1
+                        load_rows.append(counteq)
+                        counteq += 1
+
+        # Reactive power as a function of real power and inverter rating
+        countineq = 0
 
-                # work on this for the secondary netowrks:
-                else:
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 5 + val_bus['idx']] = 1
-                    A_eq[counteq, state_variable_number + val_bus['idx']] = 1
-                    b_eq[counteq] = val_bus['pq'][0] * BASE_S * mult
-                    counteq += 1
-                    # Reactive power
-                    A_eq[counteq, nbus_ABC * 3 + nbus_s1s2 +
-                         nbus_ABC * 5 + nbus_s1s2 + val_bus['idx']] = 1
-                    A_eq[counteq, n_Qdg + nbus_ABC * 2 + val_bus['idx']] = -1
-                    b_eq[counteq] = val_bus['pq'][1] * BASE_S
-                    counteq += 1
+        for keyb, val_bus in bus_info.items():
+            if val_bus['base_kv'] < PRIMARY_V:
+
+                A_eq[counteq, n_Qdg + nbus_ABC * 2 + val_bus['idx']] = 1
+                b_eq[counteq] = 0. * val_bus['s_rated'] * self.BASE_S
+                counteq += 1
 
-                    DG_up_lim[nbus_ABC * 3 + val_bus['idx']
-                              ] = val_bus['pv'][0] * BASE_S
+        # Constraints for all bound within Maximum Capacity values
+        # Only P_dg control Variable:
+        if control is ControlType.WATT:
+            for k in range(n_bus):
+                A_ineq[countineq, state_variable_number + k] = 1
+                pv_limit_rows.append(countineq)
+                pv_limit_cols.append(k)
+                countineq += 1
+
+            for k in range(n_bus):
+                A_ineq[countineq, state_variable_number + k] = -1
+                b_ineq[countineq] = 0.0
+                countineq += 1
+
+        # Only Q_dg control Variable:
+        elif control is ControlType.VAR:
+            for k in range(n_bus):
+                A_ineq[countineq, n_Qdg + k] = 1
+                pv_limit_rows.append(countineq)
+                pv_limit_cols.append(k)
+                countineq += 1
+
+            for k in range(n_bus):
+                A_ineq[countineq, n_Qdg + k] = -1
+                pv_limit_rows.append(countineq)
+                pv_limit_cols.append(k)
+                countineq += 1
+
+        # Constraint 3: 0.95^2 <= V <= 1.05^2 (For those nodes where voltage constraint exist)
+        v_idxs = set(v_lim)
+        # # Does the vmin make sense here?
+        if self.pf_flag is True:
+            vmax = 1.5
+            vmin = 0.1
+        else:
+            vmax = 1.05
+            vmin = 0.95
+
+        for k in range(nbus_ABC):
+            if k in v_idxs:
+                # Upper bound
+                for phase in range(3):
+                    A_ineq[countineq, k + nbus_ABC * phase] = 1
+                    b_ineq[countineq] = vmax ** 2
+                    countineq += 1
+                # Lower Bound
+                for phase in range(3):
+                    A_ineq[countineq, k + nbus_ABC * phase] = -1
+                    b_ineq[countineq] = - vmin ** 2
+                    countineq += 1
+
+        def selection(rows: list, cols: list, n_rows: int, n_cols: int) -> sp.csr_matrix:
+            return sp.coo_matrix(
+                (np.ones(len(rows)), (rows, cols)), shape=(n_rows, n_cols)).tocsr()
+
+        self.A_eq = A_eq.tocsr(counteq)
+        self.Z_eq = Z_eq.tocsr(counteq)
+        self.b_eq = b_eq[:counteq]
+        self.A_ineq = A_ineq.tocsr(countineq)
+        self.b_ineq = b_ineq[:countineq]
+        self.q_obj_vector = q_obj_vector
+        self.load_map = selection(
+            load_rows, range(len(load_rows)), counteq, len(load_rows))
+        self.source_map = selection(source_rows, range(3), counteq, 3)
+        self.pv_limit_map = selection(
+            pv_limit_rows, pv_limit_cols, countineq, n_bus)
+
+        self.load = cp.Parameter(len(load_rows))
+        self.pv_limit = cp.Parameter(n_bus)
+        self.source_v = cp.Parameter(3)
+        self.inv_base_z = cp.Parameter(nonneg=True)
+        self.linprog_A_eq = None
+        self.linprog_base_z = None
+
+        self.x = x
+        self.prob = cp.Problem(
+            cp.Minimize(q_obj_vector.T @ x),
+            [self.A_ineq @ x <= self.b_ineq + self.pv_limit_map @ self.pv_limit,
+             self.A_eq @ x + self.inv_base_z * (self.Z_eq @ x)
+             == self.b_eq + self.load_map @ self.load + self.source_map @ self.source_v])
+
+        self.injection_buses = injection_buses
+        self.nbus_ABC = nbus_ABC
+        self.nbus_s1s2 = nbus_s1s2
+        self.nbranch_ABC = nbranch_ABC
+        self.n_bus = n_bus
+        self.state_variable_number = state_variable_number
+        self.n_Qdg = n_Qdg
+
+    def parameters(self, bus_info: dict) -> dict:
+        """Compute the parameter values for the loads, PV and voltages in bus_info."""
+        BASE_S = self.BASE_S
+        S_CAPACITY = self.S_CAPACITY
+        nbus_ABC = self.nbus_ABC
+        mult = 1
+
+        base_kv = {key: b['base_kv'] * b['tap_ratio']
+                   for key, b in bus_info.items()}
+        slack_v = max(base_kv.values())
+        logger.debug(f"Slack Voltage: {slack_v}")
+        basekV = base_kv[self.source_bus]
+        baseZ = basekV ** 2 / 100
+        SOURCE_V = [slack_v/basekV]*3
+
+        load = []
+        DG_up_lim = np.zeros(self.n_bus)
+        for keyb, primary in self.injection_buses:
+            val_bus = bus_info[keyb]
+            if primary:
+                for phase in range(3):
+                    p_load = val_bus['pq'][phase][0] * BASE_S * mult
+                    if self.control is ControlType.VAR:
+                        p_load -= val_bus['pv'][phase][0] * BASE_S
+                    load.append(p_load)
+                for phase in range(3):
+                    load.append(val_bus['pq'][phase][1] * BASE_S * mult)
+
+                # DG upper limit set up:
+                for phase in range(3):
+                    p_dg = val_bus['pv'][phase][0] * BASE_S
+                    if self.control is ControlType.WATT:
+                        DG_up_lim[nbus_ABC * phase + val_bus['idx']] = p_dg
+                    else:
+                        DG_up_lim[nbus_ABC * phase + val_bus['idx']] = np.sqrt(
+                            ((S_CAPACITY * p_dg) ** 2) - (p_dg ** 2))
+
+            # work on this for the secondary netowrks:
+            else:
+                load.append(val_bus['pq'][0] * BASE_S * mult)
+                load.append(val_bus['pq'][1] * BASE_S)
+                DG_up_lim[nbus_ABC * 3 + val_bus['idx']
+                          ] = val_bus['pv'][0] * BASE_S
+
+        return {
+            'load': np.array(load),
+            'pv_limit': DG_up_lim,
+            'source_v': np.square(SOURCE_V),
+            'inv_base_z': 1 / baseZ,
+        }
+
+    def update(self, bus_info: dict) -> None:
+        """Set the parameters from the loads, PV and voltages in bus_info."""
+        self.set_parameters(self.parameters(bus_info))
+
+    def set_parameters(self, values: dict) -> None:
+        self.load.value = values['load']
+        self.pv_limit.value = values['pv_limit']
+        self.source_v.value = values['source_v']
+        self.inv_base_z.value = values['inv_base_z']
+
+    def solve(self, bus_info: dict):
+        """Update the parameters from bus_info and solve the OPF.
+
+        Returns the bus voltages, line flows, control set points and the
+        conversion factor to kW, like optimal_power_flow.
+        """
+        self.update(bus_info)
+        return self.solve_current(bus_info)
+
+    def solve_horizon(self, bus_info: dict, steps: list, workers: int = 1) -> list:
+        """Solve the OPF for every step of a forecast horizon.
+
+        steps holds the output of ``parameters`` for each step. All steps
+        reuse the compiled problem, and steps with identical parameters, such
+        as the night-time steps of a PV forecast, are solved only once. With
+        more than one worker the steps are spread over a process pool.
+        Returns one (voltages, line flows, control, conversion) tuple per step.
+        """
+        keys = []
+        unique = {}
+        for values in steps:
+            key = np.concatenate([
+                values['load'], values['pv_limit'],
+                values['source_v'], [values['inv_base_z']]]).tobytes()
+            keys.append(key)
+            unique.setdefault(key, values)
+
+        if workers > 1 and len(unique) > 1:
+            solved = dict(zip(unique, self.solve_pool(
+                bus_info, list(unique.values()), workers)))
+        else:
+            solved = {}
+            for key, values in unique.items():
+                self.set_parameters(values)
+                solved[key] = self.solve_current(bus_info)
+        logger.info(f"Solved {len(solved)} unique of {len(steps)} forecast steps")
+        return [solved[key] for key in keys]
+
+    def solve_pool(self, bus_info: dict, steps: list, workers: int) -> list:
+        """Solve the steps in a process pool, returning results in step order.
+
+        The network is sent to each worker once, where it builds its own copy
+        of the model; the tasks only carry the parameter values.
+        """
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(steps)),
+            mp_context=context,
+            initializer=init_forecast_worker,
+            initargs=(self.branch_info, self.bus_info, bus_info,
+                      self.source_bus, self.control, self.pf_flag, self.solver)
+        ) as pool:
+            return list(pool.map(solve_forecast_step, steps))
+
+    def solve_current(self, bus_info: dict):
+        """Solve the OPF with the parameter values already set.
+
+        Raises OPFSolveError when the solver finds no optimal solution.
+        """
+        if self.solver is Solver.HIGHS:
+            x, status = self.solve_linprog()
+        else:
+            self.prob.solve(solver=self.solver.value,
+                            warm_start=True, verbose=False)
+            x, status = self.x.value, self.prob.status
+        logger.info(status)
+
+        if status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            raise OPFSolveError(
+                f"{self.solver.value} returned {status}. Check for limits. Power flow didn't converge")
+
+        return self.results(x, bus_info)
+
+    def solve_linprog(self):
+        """Solve the LP with HiGHS through scipy, returning (x, status)."""
+        inv_base_z = self.inv_base_z.value
+        if inv_base_z != self.linprog_base_z:
+            self.linprog_A_eq = (self.A_eq + inv_base_z * self.Z_eq).tocsr()
+            self.linprog_base_z = inv_base_z
+
+        res = linprog(
+            self.q_obj_vector,
+            A_ub=self.A_ineq,
+            b_ub=self.b_ineq + self.pv_limit_map @ self.pv_limit.value,
+            A_eq=self.linprog_A_eq,
+            b_eq=self.b_eq + self.load_map @ self.load.value
+            + self.source_map @ self.source_v.value,
+            bounds=(None, None),
+            method="highs",
+        )
+        if res.status != 0:
+            return None, res.message
+        return res.x, cp.OPTIMAL
+
+    def results(self, x: np.ndarray, bus_info: dict):
+        """Convert a solution vector into voltage, flow and control dicts."""
+        BASE_S = self.BASE_S
+        nbus_ABC = self.nbus_ABC
+        nbranch_ABC = self.nbranch_ABC
+        nbus_s1s2 = self.nbus_s1s2
+
+        name = list(self.branch_info)
+
+        i = 0
+        mul = 1 / (BASE_S * 1000)
+        line_flow = {}
+        n_flow_ABC = (nbus_ABC * 3 + nbus_s1s2) + \
+            (nbus_ABC * 6 + nbus_s1s2 * 2)
+        for k in range(n_flow_ABC, n_flow_ABC + nbranch_ABC):
+            line_flow[name[i]] = {}
+            line_flow[name[i]]['A'] = [x[k] * mul * 1000,
+                                       x[k + nbranch_ABC * 3] * mul * 1000]
+            line_flow[name[i]]['B'] = [x[k + nbranch_ABC] *
+                                       mul * 1000, x[k + nbranch_ABC * 4] * mul * 1000]
+            line_flow[name[i]]['C'] = [x[k + nbranch_ABC * 2] * mul * 1000,
+                                       x[k + nbranch_ABC * 5] * mul * 1000]
+            i += 1
+
+        name = list(bus_info)
+        bus_voltage = {}
+        for k in range(nbus_ABC):
+            bus_voltage[name[k]] = {}
+            bus_voltage[name[k]]['A'] = math.sqrt(abs(x[k]))
+            bus_voltage[name[k]]['B'] = math.sqrt(abs(x[nbus_ABC + k]))
+            bus_voltage[name[k]]['C'] = math.sqrt(
+                abs(x[nbus_ABC * 2 + k]))
+
+        # Monish Edits
+        for key, val_bus in bus_info.items():
+            bus_voltage[key] = {}
+            bus_voltage[key]['A'] = math.sqrt(abs(x[val_bus['idx']]))
+            bus_voltage[key]['B'] = math.sqrt(
+                abs(x[nbus_ABC + val_bus['idx']]))
+            bus_voltage[key]['C'] = math.sqrt(
+                abs(x[nbus_ABC * 2 + val_bus['idx']]))
+
+        if self.control is ControlType.WATT:
+            control_variable_idx_start = self.state_variable_number
+        elif self.control is ControlType.VAR:
+            control_variable_idx_start = self.n_Qdg
+
+        opf_control_variable = {}
+        for key, val_bus in bus_info.items():
+            opf_control_variable[key] = {}
+            opf_control_variable[key]['A'] = x[val_bus['idx'] +
+                                               control_variable_idx_start]
+            opf_control_variable[key]['B'] = x[nbus_ABC +
+                                               val_bus['idx'] + control_variable_idx_start]
+            opf_control_variable[key]['C'] = x[nbus_ABC *
+                                               2 + val_bus['idx'] + control_variable_idx_start]
+
+        kw_converter = 1 / BASE_S / 1000
+
+        return bus_voltage, line_flow, opf_control_variable, kw_converter
 
-    # Reactive power as a function of real power and inverter rating
-    countineq = 0
 
-    for keyb, val_bus in bus_info.items():
-        if val_bus['base_kv'] < PRIMARY_V:
+def optimal_power_flow(branch_info: dict, bus_info: dict, source_bus: str, control: ControlType, pf_flag: bool):
+    model = LinDistFlowModel(branch_info, bus_info, source_bus, control, pf_flag)
+    return model.solve(bus_info)
 
-            A_eq[counteq, n_Qdg + nbus_ABC * 2 + val_bus['idx']] = 1
-            b_eq[counteq] = 0. * val_bus['s_rated'] * BASE_S
-            counteq += 1
 
-    # Constraints for all bound within Maximum Capacity values
-    # Only P_dg control Variable:
-    if control is ControlType.WATT:
-        for k in range(n_bus):
-            A_ineq[countineq, state_variable_number + k] = 1
-            b_ineq[countineq] = DG_up_lim[k, 0]
-            countineq += 1
-
-        for k in range(n_bus):
-            A_ineq[countineq, state_variable_number + k] = -1
-            b_ineq[countineq] = 0.0
-            countineq += 1
-
-    # Only Q_dg control Variable:
-    elif control is ControlType.VAR:
-        for k in range(n_bus):
-            A_ineq[countineq, n_Qdg + k] = 1
-            b_ineq[countineq] = DG_up_lim[k, 0]
-            countineq += 1
-
-        for k in range(n_bus):
-            A_ineq[countineq, n_Qdg + k] = -1
-            b_ineq[countineq] = DG_up_lim[k, 0]
-            countineq += 1
-
-    # Constraint 3: 0.95^2 <= V <= 1.05^2 (For those nodes where voltage constraint exist)
-    # print("Formulating voltage limit constraints")
-    v_idxs = list(set(v_lim))
-    # # Does the vmin make sense here?
-    if pf_flag is True:
-        vmax = 1.5
-        vmin = 0.1
-    else:
-        vmax = 1.05
-        vmin = 0.95
-
-    for k in range(nbus_ABC):
-        if k in v_idxs:
-            # Upper bound
-            A_ineq[countineq, k] = 1
-            b_ineq[countineq] = vmax ** 2
-            countineq += 1
-            A_ineq[countineq, k + nbus_ABC] = 1
-            b_ineq[countineq] = vmax ** 2
-            countineq += 1
-            A_ineq[countineq, k + nbus_ABC * 2] = 1
-            b_ineq[countineq] = vmax ** 2
-            countineq += 1
-            # Lower Bound
-            A_ineq[countineq, k] = -1
-            b_ineq[countineq] = - vmin ** 2
-            countineq += 1
-            A_ineq[countineq, k + nbus_ABC] = -1
-            b_ineq[countineq] = - vmin ** 2
-            countineq += 1
-            A_ineq[countineq, k + nbus_ABC * 2] = -1
-            b_ineq[countineq] = - vmin ** 2
-            countineq += 1
-
-    prob = cp.Problem(cp.Minimize(q_obj_vector.T @ x),
-                      [A_ineq @ x <= b_ineq,
-                       A_eq @ x == b_eq])
-
-    prob.solve(solver=cp.ECOS, verbose=True)
-    logger.info(prob.status)
-
-    if prob.status == 'infeasible_or_unbounded' or prob.status == 'infeasible':
-        logger.debug("Check for limits. Power flow didn't converge")
-        exit()
-
-    from_bus = []
-    to_bus = []
-    name = []
-
-    for key, val_br in branch_info.items():
-        from_bus.append(val_br['fr_bus'])
-        to_bus.append(val_br['to_bus'])
-        name.append(key)
-
-    i = 0
-    mul = 1 / (BASE_S * 1000)
-    line_flow = {}
-    n_flow_ABC = (nbus_ABC * 3 + nbus_s1s2) + (nbus_ABC * 6 + nbus_s1s2 * 2)
-    for k in range(n_flow_ABC, n_flow_ABC + nbranch_ABC):
-        line_flow[name[i]] = {}
-        line_flow[name[i]]['A'] = [x.value[k] * mul * 1000,
-                                   x.value[k + nbranch_ABC * 3] * mul * 1000]
-        line_flow[name[i]]['B'] = [x.value[k + nbranch_ABC] *
-                                   mul * 1000, x.value[k + nbranch_ABC * 4] * mul * 1000]
-        line_flow[name[i]]['C'] = [x.value[k + nbranch_ABC * 2] * mul * 1000,
-                                   x.value[k + nbranch_ABC * 5] * mul * 1000]
-        i += 1
-
-    n_flow_s1s2 = (nbus_ABC * 3 + nbus_s1s2) + \
-        (nbus_ABC * 6 + nbus_s1s2 * 2) + nbranch_ABC * 6
-    name = []
-    for key, val_br in bus_info.items():
-        name.append(key)
-    bus_voltage = {}
-    i = 0
-    for k in range(nbus_ABC):
-        bus_voltage[name[k]] = {}
-        bus_voltage[name[k]]['A'] = math.sqrt(abs(x.value[k]))
-        bus_voltage[name[k]]['B'] = math.sqrt(abs(x.value[nbus_ABC + k]))
-        bus_voltage[name[k]]['C'] = math.sqrt(abs(x.value[nbus_ABC * 2 + k]))
-        i += 1
-
-    # Monish Edits
-    for key, val_bus in bus_info.items():
-        # volt.append(
-        #     [name[k], '{:.4f}'.format(math.sqrt(abs(x.value[k]))),
-        #      '{:.4f}'.format(math.sqrt(abs(x.value[nbus_ABC + k]))),
-        #      '{:.4f}'.format(math.sqrt(abs(x.value[nbus_ABC * 2 + k])))])
-        bus_voltage[key] = {}
-        bus_voltage[key]['A'] = math.sqrt(abs(x.value[val_bus['idx']]))
-        bus_voltage[key]['B'] = math.sqrt(
-            abs(x.value[nbus_ABC + val_bus['idx']]))
-        bus_voltage[key]['C'] = math.sqrt(
-            abs(x.value[nbus_ABC * 2 + val_bus['idx']]))
-        i += 1
-
-    if control is ControlType.WATT:
-        control_variable_idx_start = state_variable_number
-    elif control is ControlType.VAR:
-        control_variable_idx_start = n_Qdg
-
-    generation_output = np.zeros((nbus_ABC, 3))
-    for k in range(nbus_ABC * 3):
-        # injection.append([name[k], '{:.4f}'.format((x.value[k + state_variable_number]))])
-        if DG_up_lim[k, 0]:
-            if k < nbus_ABC:
-                generation_output[k, 0] = (
-                    x.value[k + control_variable_idx_start])
-            elif k < (nbus_ABC * 2):
-                generation_output[k - nbus_ABC,
-                                  1] = (x.value[k + control_variable_idx_start])
-            else:
-                generation_output[k - (nbus_ABC * 2),
-                                  2] = (x.value[k + control_variable_idx_start])
-    # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-
-    opf_control_variable = {}
-    for key, val_bus in bus_info.items():
-        opf_control_variable[key] = {}
-        opf_control_variable[key]['A'] = x.value[val_bus['idx'] +
-                                                 control_variable_idx_start]
-        opf_control_variable[key]['B'] = x.value[nbus_ABC +
-                                                 val_bus['idx'] + control_variable_idx_start]
-        opf_control_variable[key]['C'] = x.value[nbus_ABC *
-                                                 2 + val_bus['idx'] + control_variable_idx_start]
-
-    kw_converter = 1 / BASE_S / 1000
-
-    return bus_voltage, line_flow, opf_control_variable, kw_converter
+# Model of the process pool workers, see LinDistFlowModel.solve_pool
+forecast_model = None
+forecast_bus_info = None
+
+
+def init_forecast_worker(branch_info: dict, model_bus_info: dict, bus_info: dict,
+                         source_bus: str, control: ControlType, pf_flag: bool,
+                         solver: Solver) -> None:
+    global forecast_model, forecast_bus_info
+    forecast_model = LinDistFlowModel(
+        branch_info, model_bus_info, source_bus, control, pf_flag, solver)
+    forecast_bus_info = bus_info
+
+
+def solve_forecast_step(values: dict):
+    forecast_model.set_parameters(values)
+    return forecast_model.solve_current(forecast_bus_info)
@@ -1,6 +1,8 @@
+import copy
 import logging
 import helics as h
 import json
+from time import perf_counter
 from pathlib import Path
 from datetime import datetime
 from oedisi.types.data_types import (
@@ -15,6 +17,7 @@ from oedisi.types.data_types import (
 )
 import adapter
 import lindistflow
+from payload import MissingIds, decode
 from area import area_info, check_network_radiality
 import xarray as xr
 
@@ -34,6 +37,8 @@ class StaticConfig(object):
     deltat: float
     control_type: lindistflow.ControlType
     pf_flag: bool
+    forecast_workers: int
+    solver: lindistflow.Solver
 
 
 class Subscriptions(object):
@@ -74,6 +79,14 @@ class OPFFederate(object):
         self.static.control_type = lindistflow.ControlType(
             config["control_type"])
         self.static.pf_flag = config["pf_flag"]
+        if "forecast_workers" in config:
+            self.static.forecast_workers = config["forecast_workers"]
+        else:
+            self.static.forecast_workers = 1
+        if "solver" in config:
+            self.static.solver = lindistflow.Solver(config["solver"].upper())
+        else:
+            self.static.solver = lindistflow.Solver.ECOS
 
     def initilize(self) -> None:
         self.info = h.helicsCreateFederateInfo()
@@ -102,7 +115,7 @@ class OPFFederate(object):
         # Optional subscription: PV forecast
         self.sub.pv_forecast = self.fed.register_subscription(
             self.inputs["pv_forecast"], "")
-        self.sub.pv_forecast.set_default("[]")
+        self.sub.pv_forecast.set_default('{"ids": [], "values": []}')
         self.sub.pv_forecast.option["CONNECTION_OPTIONAL"] = True
 
     def register_publication(self) -> None:
@@ -146,6 +159,7 @@ class OPFFederate(object):
 
         grab_forecast_flag = False
         time_ctr = -1
+        model = None
 
         while granted_time < h.HELICS_TIME_MAXTIME:
 
@@ -155,56 +169,91 @@ class OPFFederate(object):
                 )
                 continue
 
-            topology: Topology = Topology.parse_obj(self.sub.topology.json)
-            [branch_info, bus_info] = adapter.extract_info(topology)
-
-            injections: Injection = Injection.parse_obj(topology.injections)
-            bus_info = adapter.extract_injection(bus_info, injections)
-
-            slack = topology.slack_bus[0]
-            [slack_bus, phase] = slack.split('.')
+            # the network only changes with the topology, so the branch and
+            # bus tables and the OPF model are built once and reused
+            if model is None or self.sub.topology.is_updated():
+                topology: Topology = Topology.parse_obj(
+                    self.sub.topology.json)
+                [branch_info, topology_bus_info] = adapter.extract_info(
+                    topology)
+
+                injections: Injection = Injection.parse_obj(
+                    topology.injections)
+                topology_bus_info = adapter.extract_injection(
+                    topology_bus_info, injections)
+
+                slack = topology.slack_bus[0]
+                [slack_bus, phase] = slack.split('.')
+                model = None
+
+            try:
+                voltages_mag = decode(self.sub.voltages_mag, VoltagesMagnitude)
+                # get the available power in real time
+                available_power = decode(self.sub.available_pv, MeasurementArray)
+            except MissingIds as e:
+                logger.warning(f"Skipping time step {granted_time}: {e}")
+                granted_time = h.helicsFederateRequestTime(
+                    self.fed, h.HELICS_TIME_MAXTIME
+                )
+                continue
 
-            voltages_mag = VoltagesMagnitude.parse_obj(
-                self.sub.voltages_mag.json)
+            bus_info = copy.deepcopy(topology_bus_info)
             bus_info = adapter.extract_voltages(bus_info, voltages_mag)
             bus_info = adapter.update_ratios(bus_info, branch_info)
 
             time = voltages_mag.time
             logger.debug(time)
 
-            with open("bus_info_oedisi_ieee123.json", "w") as outfile:
-                outfile.write(json.dumps(bus_info))
+            if model is None:
+                with open("bus_info_oedisi_ieee123.json", "w") as outfile:
+                    outfile.write(json.dumps(bus_info))
+
+                with open("branch_info_oedisi_ieee123.json", "w") as outfile:
+                    outfile.write(json.dumps(branch_info))
 
-            with open("branch_info_oedisi_ieee123.json", "w") as outfile:
-                outfile.write(json.dumps(branch_info))
+                assert (check_network_radiality(
+                    bus=bus_info, branch=branch_info))
 
-            assert (check_network_radiality(bus=bus_info, branch=branch_info))
+                model = lindistflow.LinDistFlowModel(
+                    branch_info, bus_info, slack_bus,
+                    self.static.control_type, self.static.pf_flag,
+                    self.static.solver
+                )
 
             # evaluate the forecasted PV set points and forecasted curtailment
             if not grab_forecast_flag:
                 pv_forecast = self.sub.pv_forecast.json
                 forecast_setp = {}
                 forecast_curt = {}
-                for k, forecast in enumerate(pv_forecast):
+                forecast_gen = []
+                forecast_steps = []
+                # one row of values per time step, in the order of the ids
+                for k, values in enumerate(pv_forecast["values"]):
                     logger.info(f"Forecasting for time step {k}")
 
-                    forecast_generation = json.loads(forecast)
-                    dict_forecast_gen = dict(zip(
+                    forecast_generation = {
+                        "ids": pv_forecast["ids"], "values": values}
+                    forecast_gen.append(dict(zip(
                         forecast_generation["ids"],
                         forecast_generation["values"]
-                    ))
+                    )))
 
                     # insert forecasted generation values to the PV injection vector
                     bus_info = adapter.extract_forecast(
                         bus_info,
                         forecast_generation
                     )
+                    forecast_steps.append(model.parameters(bus_info))
 
-                    # perform forecast LinDistFlow
-                    voltages, power_flow, forecast_control, conv = lindistflow.optimal_power_flow(
-                        branch_info, bus_info, slack_bus,
-                        self.static.control_type, self.static.pf_flag
-                    )
+                # perform forecast LinDistFlow for the whole horizon
+                start = perf_counter()
+                forecast_results = model.solve_horizon(
+                    bus_info, forecast_steps, self.static.forecast_workers)
+                logger.debug(
+                    f"Forecast solve time: {perf_counter() - start:.3f} s")
+
+                for dict_forecast_gen, forecast_result in zip(forecast_gen, forecast_results):
+                    voltages, power_flow, forecast_control, conv = forecast_result
 
                     # compute the forecatsed set points
                     forecast_setpts = self.get_set_points(
@@ -234,13 +283,12 @@ class OPFFederate(object):
             time = voltages_mag.time
             logger.info(time)
 
-            # get the available power in real time
-            available_power = self.sub.available_pv.json
-            available_power = {available_power["ids"][i]: available_power["values"][i] for i in range(
-                len(available_power["ids"]))}
+            available_power = dict(
+                zip(available_power.ids, available_power.values))
 
-            voltages, power_flow, control, conversion = lindistflow.optimal_power_flow(
-                branch_info, bus_info, slack_bus, self.static.control_type, self.static.pf_flag)
+            start = perf_counter()
+            voltages, power_flow, control, conversion = model.solve(bus_info)
+            logger.debug(f"OPF solve time: {perf_counter() - start:.3f} s")
             real_setpts = self.get_set_points(control, bus_info, conversion)
 
             # Compute the delta change in setpoints and publish
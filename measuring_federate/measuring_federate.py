@@ -7,6 +7,13 @@ from datetime import datetime
 
 from oedisi.types.data_types import MeasurementArray, EquipmentNodeArray
 from oedisi.types.common import BrokerConfig
+from payload import (
+    MissingIds,
+    PayloadPublication,
+    decode_bytes,
+    ids_version,
+    is_binary,
+)
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -19,6 +26,7 @@ class MeasurementConfig(BaseModel):
     multiplicative_noise_stddev: float = 0.0
     measurement_file: str
     run_freq_time_step: float = 1.0
+    binary_payloads: bool = False
 
 
 def get_indices(labelled_array, indices):
@@ -27,21 +35,30 @@ def get_indices(labelled_array, indices):
     return [inv_map[v] for v in labelled_array.ids]
 
 
+# Positions of the reindexed ids, keyed by the versions of both id lists
+REINDEX_POSITIONS = {}
+
+
 def reindex(measurement_array: MeasurementArray, indices):
-    inv_map = {v: i for i, v in enumerate(measurement_array.ids)}
+    key = (ids_version(measurement_array.ids), ids_version(indices))
+    if key not in REINDEX_POSITIONS:
+        inv_map = {v: i for i, v in enumerate(measurement_array.ids)}
+        REINDEX_POSITIONS[key] = [inv_map[i] for i in indices]
+    positions = REINDEX_POSITIONS[key]
+
     if isinstance(measurement_array, EquipmentNodeArray):
         return measurement_array.__class__(
-            values=[measurement_array.values[inv_map[i]] for i in indices],
+            values=[measurement_array.values[p] for p in positions],
             ids=indices,
             units=measurement_array.units,
             equipment_ids=[
-                measurement_array.equipment_ids[inv_map[i]] for i in indices
+                measurement_array.equipment_ids[p] for p in positions
             ],
             time=measurement_array.time,
         )
     else:
         return measurement_array.__class__(
-            values=[measurement_array.values[inv_map[i]] for i in indices],
+            values=[measurement_array.values[p] for p in positions],
             ids=indices,
             units=measurement_array.units,
             time=measurement_array.time,
@@ -96,8 +113,8 @@ class MeasurementRelay:
         )
 
         # TODO: find better way to determine what the name of this federate instance is than looking at the subscription
-        self.pub_measurement = self.vfed.register_publication(
-            "publication", h.HELICS_DATA_TYPE_STRING, ""
+        self.pub_measurement = PayloadPublication(
+            self.vfed, "publication", config.binary_payloads
         )
 
         self.additive_noise_stddev = config.additive_noise_stddev
@@ -122,11 +139,20 @@ class MeasurementRelay:
             self.vfed, h.HELICS_TIME_MAXTIME)
         while granted_time < h.HELICS_TIME_MAXTIME:
             logger.info("start time: " + str(datetime.now()))
-            json_data = self.sub_measurement.json
-            if "equipment_ids" in json_data:
-                measurement = EquipmentNodeArray.parse_obj(json_data)
+            if is_binary(self.sub_measurement):
+                try:
+                    measurement = decode_bytes(self.sub_measurement.bytes)
+                except MissingIds as e:
+                    logger.warning(f"Skipping time step {granted_time}: {e}")
+                    granted_time = h.helicsFederateRequestTime(
+                        self.vfed, h.HELICS_TIME_MAXTIME)
+                    continue
             else:
-                measurement = MeasurementArray.parse_obj(json_data)
+                json_data = self.sub_measurement.json
+                if "equipment_ids" in json_data:
+                    measurement = EquipmentNodeArray.parse_obj(json_data)
+                else:
+                    measurement = MeasurementArray.parse_obj(json_data)
 
             with open(self.measurement_file, "r") as fp:
                 self.measurement = json.load(fp)
@@ -135,7 +161,7 @@ class MeasurementRelay:
             logger.debug("measured transformed")
             logger.debug(measurement_transformed)
 
-            self.pub_measurement.publish(measurement_transformed.json())
+            self.pub_measurement.publish(measurement_transformed)
 
             granted_time = h.helicsFederateRequestTime(
                 self.vfed, h.HELICS_TIME_MAXTIME)
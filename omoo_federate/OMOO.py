@@ -36,6 +36,7 @@ from oedisi.types.data_types import (
     VoltagesMagnitude,
     Command,
 )
+from payload import MissingIds, decode
 from scipy.sparse import csc_matrix, coo_matrix, diags, vstack, hstack
 from scipy.sparse.linalg import svds, inv
 import xarray as xr
@@ -613,17 +614,28 @@ class OMOOFederate:
                 )
                 continue
 
-            voltages_real = VoltagesReal.parse_obj(self.sub_voltages_real.json)
-            voltages_imag = VoltagesImaginary.parse_obj(
-                self.sub_voltages_imaginary.json
-            )
+            try:
+                voltages_real = decode(self.sub_voltages_real, VoltagesReal)
+                voltages_imag = decode(
+                    self.sub_voltages_imaginary, VoltagesImaginary)
+                injections = decode(self.injections, Injection)
+                available_power = decode(
+                    self.sub_available_power, MeasurementArray)
+                power_P = decode(self.sub_power_P, PowersReal)
+                power_Q = decode(self.sub_power_Q, PowersImaginary)
+            except MissingIds as e:
+                logger.warning(f"Skipping time step {granted_time}: {e}")
+                granted_time = h.helicsFederateRequestTime(
+                    self.vfed, h.HELICS_TIME_MAXTIME
+                )
+                continue
+
             voltages = measurement_to_xarray(
                 voltages_real
             ) + 1j * measurement_to_xarray(voltages_imag)
             logger.debug(np.max(np.abs(voltages) / v))
             assert topology.base_voltage_magnitudes.ids == list(voltages.ids.data)
 
-            injections = Injection.parse_obj(self.injections.json)
             power_injections = eqarray_to_xarray(
                 injections.power_real
             ) + 1j * eqarray_to_xarray(injections.power_imaginary)
@@ -631,9 +643,7 @@ class OMOOFederate:
                 power_injections.equipment_ids.str.startswith("PVSystem")
             ]
             _, pv_injections = xr.align(pv_ratings, pv_injections)
-            available_power = measurement_to_xarray(
-                MeasurementArray.parse_obj(self.sub_available_power.json)
-            )
+            available_power = measurement_to_xarray(available_power)
 
             split_power = available_power / pv_injections.ids.groupby(
                 "equipment_ids"
@@ -663,8 +673,6 @@ class OMOOFederate:
             logger.debug("PVframe")
             logger.debug(pv)
 
-            power_P = PowersReal.parse_obj(self.sub_power_P.json)
-            power_Q = PowersImaginary.parse_obj(self.sub_power_Q.json)
             assert topology.base_voltage_magnitudes.ids == power_P.ids
             assert topology.base_voltage_magnitudes.ids == power_Q.ids
             ts = time.time()
@@ -1,7 +1,11 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import pyarrow.feather as feather
+try:
+    from post_process.utils import read_recording
+except ModuleNotFoundError:
+    # run as a script, with post_process/ on the path
+    from utils import read_recording
 from datetime import datetime
 from oedisi.types.data_types import Topology
 import json
@@ -13,8 +17,8 @@ def get_time(x):
         ).time().strftime("%H:%M")
 
 def get_voltage(realV, imagV):
-    voltage_real = feather.read_feather(realV)
-    voltage_imag = feather.read_feather(imagV)
+    voltage_real = read_recording(realV)
+    voltage_imag = read_recording(imagV)
     df_voltages = np.abs(voltage_real.drop("time", axis=1) + 1j * voltage_imag.drop("time", axis=1))
     df_voltages["time"] = voltage_real["time"].apply(get_time)
     return df_voltages.set_index("time")
@@ -70,7 +74,7 @@ if __name__ == "__main__":
     df_true_voltages = get_voltage(realVfile, imagVfile) / base_voltages
     true_voltage_columns = df_true_voltages.columns
 
-    df_OPF_voltages = feather.read_feather(opfVfile)
+    df_OPF_voltages = read_recording(opfVfile)
     df_OPF_voltages["time"] = df_OPF_voltages["time"].apply(get_time)
     df_OPF_voltages = df_OPF_voltages.set_index("time")
     opf_voltage_columns = df_OPF_voltages.columns
@@ -5,7 +5,7 @@ from oedisi.types.data_types import Topology
 import networkx as nx
 import numpy as np
 import json
-import pyarrow.feather as feather
+from post_process.utils import read_recording
 from geopy.distance import geodesic
 from datetime import datetime
 from post_process.errors import errors
@@ -198,15 +198,15 @@ def get_time(x):
         ).time().strftime("%H:%M")
 
 def get_voltage(realV, imagV):
-    voltage_real = feather.read_feather(realV)
-    voltage_imag = feather.read_feather(imagV)
+    voltage_real = read_recording(realV)
+    voltage_imag = read_recording(imagV)
     df_voltages = np.abs(voltage_real.drop("time", axis=1) + 1j * voltage_imag.drop("time", axis=1))
     df_voltages["time"] = voltage_real["time"].apply(get_time)
     return df_voltages.set_index("time")
 
 def get_power(real, imag):
-    p = feather.read_feather(real)
-    q = feather.read_feather(imag)
+    p = read_recording(real)
+    q = read_recording(imag)
     df_power = np.abs(p.drop("time", axis=1) + 1j * q.drop("time", axis=1))
     df_power["time"] = p["time"].apply(get_time)
     return df_power.set_index("time")
@@ -450,7 +450,7 @@ def plot_opf_voltage_comparison(
     true_voltage_columns = df_true_voltages.columns
 
     # opf voltage magnitudes
-    df_opf_voltages = feather.read_feather(opfVfile)
+    df_opf_voltages = read_recording(opfVfile)
     df_opf_voltages["time"] = df_opf_voltages["time"].apply(get_time)
     df_opf_voltages = df_opf_voltages.set_index("time")
     opf_voltage_columns = df_opf_voltages.columns
@@ -686,7 +686,7 @@ def plot_curtail(
         to_file = None, show=True, do_return=False, 
         **kwargs
         ):
-    df_curtail = feather.read_feather(curtail_file)
+    df_curtail = read_recording(curtail_file)
     df_curtail["time"] = df_curtail["time"].apply(get_time)
     df_curtail.set_index("time")
 
@@ -757,13 +757,13 @@ def plot_pv_estimation(
     time=["07:30","12:30","15:30"],
     show=True,
     to_file = None):
-    df_act_p = feather.read_feather(power_real)
+    df_act_p = read_recording(power_real)
     df_act_p["time"] = df_act_p["time"].apply(get_time)
-    df_act_q = feather.read_feather(power_imag)
+    df_act_q = read_recording(power_imag)
     df_act_q["time"] = df_act_q["time"].apply(get_time)
-    df_est_p = feather.read_feather(power_real_est)
+    df_est_p = read_recording(power_real_est)
     df_est_p["time"] = df_est_p["time"].apply(get_time)
-    df_est_q = feather.read_feather(power_imag_est)
+    df_est_q = read_recording(power_imag_est)
     df_est_q["time"] = df_est_q["time"].apply(get_time)
     
     fig, ax = plt.subplots(layout='constrained')
@@ -4,3 +4,62 @@ import math
 from dataclasses import dataclass
 from oedisi.types.data_types import MeasurementArray, AdmittanceMatrix, Topology
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from pathlib import Path
+
+
+def read_table(path, columns=None):
+    if str(path).endswith(".parquet"):
+        return pq.read_table(path, columns=columns)
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+
+def read_schema(path):
+    if str(path).endswith(".parquet"):
+        return pq.read_schema(path)
+    with pa.memory_map(str(path)) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def read_recording(path, ids=None):
+    """Read a recorder output as a frame with one column per id and "time".
+
+    The layout is read from the schema metadata. Wide recordings are read as
+    they are. For the long layout only the rows of the requested ids are
+    pivoted, using the id dictionary file written next to the recording; all
+    ids are pivoted when ids is None.
+    """
+    metadata = read_schema(path).metadata or {}
+    if metadata.get(b"oedisi.layout") != b"long":
+        columns = None if ids is None else list(ids) + ["time"]
+        return read_table(path, columns).to_pandas()
+
+    dictionary_path = Path(path).with_suffix(".ids.json")
+    with open(dictionary_path) as f:
+        dictionary = json.load(f)
+    all_ids = dictionary["ids"]
+    if ids is None:
+        ids = all_ids
+    code = {key: i for i, key in enumerate(all_ids)}
+    position = np.full(len(all_ids), -1)
+    position[[code[key] for key in ids]] = np.arange(len(ids))
+
+    table = read_table(path)
+    time_index = table["time_index"].to_numpy()
+    # a recording closed before its first batch has no chunks
+    id_code = np.concatenate(
+        [chunk.indices.to_numpy() for chunk in table["id_code"].chunks]
+        + [np.empty(0, dtype=np.int32)])
+    value = table["value"].to_numpy()
+
+    column = position[id_code]
+    keep = column >= 0
+    data = np.full((len(dictionary["time"]), len(ids)), np.nan)
+    data[time_index[keep], column[keep]] = value[keep]
+
+    df = pd.DataFrame(data, columns=ids)
+    df["time"] = dictionary["time"]
+    return df
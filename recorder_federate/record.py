@@ -2,21 +2,163 @@ import logging
 import helics as h
 import numpy as np
 from pydantic import BaseModel
-import pandas as pd
 from typing import List
 import json
-import csv
+from pathlib import Path
 import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from datetime import datetime
 from oedisi.types.data_types import MeasurementArray
+from payload import MissingIds, decode
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
 
+class BatchWriter:
+    """Buffers measurements in numpy columns and writes them as record batches.
+
+    Each id gets a column of batch_size values; a batch is written once the
+    buffer is full, or on close. Ids missing from a measurement are recorded
+    as NaN. Writes an Arrow IPC (feather) file, or Parquet when
+    parquet_filename is given.
+    """
+
+    def __init__(self, ids, filename, batch_size=100,
+                 parquet_filename=None, compression="zstd"):
+        self.ids = list(ids)
+        self.index = {key: i for i, key in enumerate(self.ids)}
+        self.batch_size = batch_size
+        self.values = np.empty((len(self.ids), batch_size))
+        self.times = []
+        self.schema = self.make_schema()
+        # an id dictionary left by a long recording of the same name
+        dictionary_filename = id_dictionary_filename(parquet_filename or filename)
+        if self.schema.metadata[LAYOUT_KEY] == b"wide" and Path(
+                dictionary_filename).exists():
+            Path(dictionary_filename).unlink()
+
+        if parquet_filename is not None:
+            self.sink = None
+            self.writer = pq.ParquetWriter(
+                parquet_filename, self.schema, compression=compression)
+        else:
+            self.sink = pa.OSFile(filename, "wb")
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+
+    def make_schema(self):
+        schema_elements = [(key, pa.float64()) for key in self.ids]
+        schema_elements.append(("time", pa.string()))
+        return pa.schema(schema_elements, metadata={LAYOUT_KEY: b"wide"})
+
+    def record_batch(self, n):
+        columns = [pa.array(column[:n]) for column in self.values]
+        columns.append(pa.array(self.times, pa.string()))
+        return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def write(self, ids, values, time):
+        row = len(self.times)
+        if ids == self.ids:
+            self.values[:, row] = values
+        else:
+            self.values[:, row] = np.nan
+            self.values[[self.index[key] for key in ids], row] = values
+        self.times.append(time)
+
+        if len(self.times) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        n = len(self.times)
+        if n == 0:
+            return
+        self.writer.write_batch(self.record_batch(n))
+        self.times = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def id_dictionary_filename(filename):
+    return str(Path(filename).with_suffix(".ids.json"))
+
+
+# schema metadata key naming the layout of a recording
+LAYOUT_KEY = b"oedisi.layout"
+
+
+class LongBatchWriter(BatchWriter):
+    """BatchWriter for the long layout: one (time_index, id_code, value) row per value.
+
+    id_code is dictionary encoded against the recorded ids, so the file stays
+    narrow however many ids a feeder has. The ids and the time of each
+    time_index are written to a separate id dictionary file on close.
+    """
+
+    def __init__(self, ids, filename, batch_size=100,
+                 parquet_filename=None, compression="zstd"):
+        self.dictionary_filename = id_dictionary_filename(
+            parquet_filename or filename)
+        self.dictionary = pa.array(list(ids), pa.string())
+        self.all_times = []
+        super().__init__(ids, filename, batch_size,
+                         parquet_filename, compression)
+
+    def make_schema(self):
+        return pa.schema([
+            ("time_index", pa.int32()),
+            ("id_code", pa.dictionary(pa.int32(), pa.string())),
+            ("value", pa.float64()),
+        ], metadata={LAYOUT_KEY: b"long"})
+
+    def record_batch(self, n):
+        n_ids = len(self.ids)
+        start = len(self.all_times)
+        time_index = np.repeat(
+            np.arange(start, start + n, dtype=np.int32), n_ids)
+        id_code = pa.DictionaryArray.from_arrays(
+            np.tile(np.arange(n_ids, dtype=np.int32), n), self.dictionary)
+        value = self.values[:, :n].T.ravel()
+        self.all_times.extend(self.times)
+        return pa.RecordBatch.from_arrays(
+            [pa.array(time_index), id_code, pa.array(value)],
+            schema=self.schema)
+
+    def close(self):
+        super().close()
+        with open(self.dictionary_filename, "w") as f:
+            json.dump({"ids": self.ids, "time": self.all_times}, f)
+
+
+def export_csv(filename, csv_filename):
+    """Stream a recorded feather or Parquet file to CSV one batch at a time."""
+    if filename.endswith(".parquet"):
+        parquet = pq.ParquetFile(filename)
+        schema = parquet.schema_arrow
+        batches = parquet.iter_batches()
+    else:
+        source = pa.memory_map(filename)
+        reader = pa.ipc.open_file(source)
+        schema = reader.schema
+        batches = (reader.get_batch(i)
+                   for i in range(reader.num_record_batches))
+
+    options = pa_csv.WriteOptions(
+        quoting_style="needed", quoting_header="none")
+    with pa_csv.CSVWriter(csv_filename, schema, write_options=options) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
 class Recorder:
-    def __init__(self, name, feather_filename, csv_filename, input_mapping):
+    def __init__(self, name, feather_filename, csv_filename, input_mapping,
+                 batch_size=100, parquet_filename=None, compression="zstd",
+                 export_csv=False, layout="wide"):
         self.rng = np.random.default_rng(12345)
         deltat = 0.01
         # deltat = 60.
@@ -40,6 +182,11 @@ class Recorder:
             input_mapping["subscription"], "")
         self.feather_filename = feather_filename
         self.csv_filename = csv_filename
+        self.batch_size = batch_size
+        self.parquet_filename = parquet_filename
+        self.compression = compression
+        self.export_csv = export_csv
+        self.layout = layout
 
     def run(self):
         # Enter execution mode #
@@ -47,50 +194,44 @@ class Recorder:
         self.vfed.enter_executing_mode()
         logger.info("Entering execution mode")
 
-        start = True
         granted_time = h.helicsFederateRequestTime(
             self.vfed, h.HELICS_TIME_MAXTIME)
 
-        with pa.OSFile(self.feather_filename, "wb") as sink:
-            writer = None
-            while granted_time < h.HELICS_TIME_MAXTIME:
-                logger.info("start time: " + str(datetime.now()))
-                logger.debug(granted_time)
-                # Check that the data is a MeasurementArray type
-                json_data = self.sub.json
-                json_data["time"] = granted_time
-                measurement = MeasurementArray(**self.sub.json)
-
-                measurement_dict = {
-                    key: value
-                    for key, value in zip(measurement.ids, measurement.values)
-                }
-                measurement_dict["time"] = measurement.time.strftime(
-                    "%Y-%m-%d %H:%M:%S"
+        writer = None
+        while granted_time < h.HELICS_TIME_MAXTIME:
+            logger.info("start time: " + str(datetime.now()))
+            logger.debug(granted_time)
+            # Check that the data is a MeasurementArray type
+            try:
+                measurement = decode(self.sub, MeasurementArray)
+            except MissingIds as e:
+                logger.warning(f"Skipping time step {granted_time}: {e}")
+                granted_time = h.helicsFederateRequestTime(
+                    self.vfed, h.HELICS_TIME_MAXTIME
                 )
-                logger.debug(measurement.time)
+                continue
+            logger.debug(measurement.time)
 
-                if start:
-                    schema_elements = [(key, pa.float64())
-                                       for key in measurement.ids]
-                    schema_elements.append(("time", pa.string()))
-                    schema = pa.schema(schema_elements)
-                    writer = pa.ipc.new_file(sink, schema)
-                    start = False
-                cnt = 0
+            if writer is None:
+                Writer = LongBatchWriter if self.layout == "long" else BatchWriter
+                writer = Writer(
+                    measurement.ids, self.feather_filename, self.batch_size,
+                    self.parquet_filename, self.compression)
 
-                writer.write_batch(
-                    pa.RecordBatch.from_pylist([measurement_dict]))
+            writer.write(
+                measurement.ids, measurement.values,
+                measurement.time.strftime("%Y-%m-%d %H:%M:%S"))
 
-                granted_time = h.helicsFederateRequestTime(
-                    self.vfed, h.HELICS_TIME_MAXTIME
-                )
-                logger.info("end time: " + str(datetime.now()))
+            granted_time = h.helicsFederateRequestTime(
+                self.vfed, h.HELICS_TIME_MAXTIME
+            )
+            logger.info("end time: " + str(datetime.now()))
 
-            if writer is not None:
-                writer.close()
-        data = pd.read_feather(self.feather_filename)
-        data.to_csv(self.csv_filename, header=True, index=False)
+        if writer is not None:
+            writer.close()
+            if self.export_csv:
+                export_csv(self.parquet_filename or self.feather_filename,
+                           self.csv_filename)
         self.destroy()
 
     def destroy(self):
@@ -106,9 +247,15 @@ if __name__ == "__main__":
         name = config["name"]
         feather_path = config["feather_filename"]
         csv_path = config["csv_filename"]
+        batch_size = config["batch_size"] if "batch_size" in config else 100
+        parquet_path = config["parquet_filename"] if "parquet_filename" in config else None
+        compression = config["compression"] if "compression" in config else "zstd"
+        csv_export = config["export_csv"] if "export_csv" in config else False
+        layout = config["layout"] if "layout" in config else "wide"
 
     with open("input_mapping.json") as f:
         input_mapping = json.load(f)
 
-    sfed = Recorder(name, feather_path, csv_path, input_mapping)
+    sfed = Recorder(name, feather_path, csv_path, input_mapping,
+                    batch_size, parquet_path, compression, csv_export, layout)
     sfed.run()
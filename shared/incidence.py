@@ -0,0 +1,24 @@
+"""Bus-to-branch incidence of the LinDistFlow branch and bus tables.
+
+The federates import copies of this module kept identical by
+``shared/sync.py``; edit it in shared/ and run that script.
+"""
+
+
+def bus_incidence(branch_info: dict, bus_info: dict, kv_key: str, primary_v: float) -> dict:
+    """Index the branches incident to each bus.
+
+    Returns a dict keyed by bus idx holding the positions (in branch_info
+    order) of the branches leaving ('from_pri'/'from_sec') and entering
+    ('to_pri'/'to_sec') the bus, split by whether the bus at the other end
+    of the branch is primary or secondary.
+    """
+    primary = {bus['idx']: bus[kv_key] > primary_v for bus in bus_info.values()}
+    incidence = {idx: {'from_pri': [], 'from_sec': [], 'to_pri': [], 'to_sec': []}
+                 for idx in primary}
+    for ind, val_br in enumerate(branch_info.values()):
+        to_level = 'pri' if primary[val_br['to']] else 'sec'
+        fr_level = 'pri' if primary[val_br['from']] else 'sec'
+        incidence[val_br['from']][f'from_{to_level}'].append(ind)
+        incidence[val_br['to']][f'to_{fr_level}'].append(ind)
+    return incidence
@@ -0,0 +1,72 @@
+"""Copy the shared modules into the federate directories that use them.
+
+Each federate directory is copied on its own into the builds and images, so
+it carries a plain copy of every shared module it imports. Edit the module
+in shared/ and run this script to update the copies; with --check it only
+lists the copies that differ and exits with an error if there are any::
+
+    python shared/sync.py --check
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# federate directories that use each shared module
+COPIES = {
+    "payload.py": [
+        "admm_federate",
+        "estimator_federate",
+        "feeder_federate",
+        "lest_federate",
+        "lindistflow_federate",
+        "measuring_federate",
+        "omoo_federate",
+        "recorder_federate",
+    ],
+    "incidence.py": [
+        "admm_federate",
+        "lest_federate",
+        "lindistflow_federate",
+    ],
+}
+
+
+def stale_copies():
+    """Paths of the copies whose bytes differ from their shared module."""
+    stale = []
+    for module, directories in COPIES.items():
+        source = (ROOT / "shared" / module).read_bytes()
+        for directory in directories:
+            copy = ROOT / directory / module
+            if not copy.is_file() or copy.is_symlink() or copy.read_bytes() != source:
+                stale.append(copy)
+    return stale
+
+
+def sync():
+    for copy in stale_copies():
+        source = ROOT / "shared" / copy.name
+        if copy.is_symlink():
+            copy.unlink()
+        copy.write_bytes(source.read_bytes())
+        print(f"Updated {copy.relative_to(ROOT)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy the shared modules into the federate directories")
+    parser.add_argument(
+        "--check", action="store_true",
+        help="only list the copies that differ from shared/",
+    )
+    args = parser.parse_args()
+    if not args.check:
+        sync()
+    stale = stale_copies()
+    for copy in stale:
+        print(f"{copy.relative_to(ROOT)} differs from shared/{copy.name}")
+    if stale:
+        sys.exit(1)